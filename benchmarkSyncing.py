@@ -0,0 +1,401 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from helpingFuncs import getDirSnapshotAndAdapt, fetchExistingDestFiles
+from helpingClasses import BaseFile, SrcDir, SrcFile, hashCache, bulkDeleter
+from helpingClasses import copyOrdering, storageProfile, pathNodes
+import startSyncing
+
+logger = logging.getLogger("main")
+
+def printHelp():
+    print("Benchmarks steps of the syncing on a synthetic directory tree, ", end='')
+    print("created in a temp")
+    print("directory (or under --tmpDir), which is removed afterwards.")
+    print()
+    print("  Usage:", sys.argv[0], "BENCHMARK [--depth N] [--width N] ", end='')
+    print("[--files N] [--fileSize BYTES] [--repeat N] [--workers N] ", end='')
+    print("[--tmpDir DIRECTORY]")
+    print()
+    print("  Benchmarks:")
+    print("    dirfd, scanning src and dest with dir fd relative operations ", end='')
+    print("vs re-resolving")
+    print("        absolute paths for every entry (warm hash cache, i.e. ", end='')
+    print("steady state)")
+    print("    pipeline, a full first sync cycle to an empty dest, ", end='')
+    print("sequential vs async")
+    print("        pipeline (cold hash cache)")
+    print("    delete, removing an obsolete dest tree one path at a time ", end='')
+    print("vs in bulk,")
+    print("        fd relative with --workers concurrent workers (e.g. ", end='')
+    print("a million files:")
+    print("        --depth 3 --width 10 --files 900 --fileSize 8)")
+    print("    rangecopy, copying a single large file (--fileSize, e.g. ", end='')
+    print("1073741824) as one")
+    print("        stream vs as byte ranges by --workers concurrent ", end='')
+    print("workers (cold page")
+    print("        cache only if dropped in between by the caller)")
+    print("    ordering, a full first sync cycle to an empty dest, ", end='')
+    print("reading in path order")
+    print("        vs in physical order (as on a rotational src, see ", end='')
+    print("--storage), from a")
+    print("        tree written in random order (src pages dropped ", end='')
+    print("from the cache")
+    print("        before every cycle)")
+    print("    pathcost, CPU time per file of putting together the src and ", end='')
+    print("dest paths in")
+    print("        the sync loop, joining and normalizing whole paths vs ", end='')
+    print("from interned dir")
+    print("        nodes (see PathNodes); plus the CPU time per file of a ", end='')
+    print("whole sync of a")
+    print("        dest already in sync (warm hash cache)")
+    print()
+    print("    --depth N, levels of sub-dirs in the tree (default 6)")
+    print("    --width N, sub-dirs per dir, on the deepest path only ", end='')
+    print("(default 2)")
+    print("    --files N, files per dir (default 50)")
+    print("    --fileSize BYTES, size of every file (default 1024)")
+    print("    --repeat N, number of timed runs per variant (default 5)")
+    print("    --workers N, hash and copy workers of the async pipeline, ", end='')
+    print("delete workers")
+    print("        (default 4)")
+    sys.exit(0)
+
+def parseArgs(av):
+    '''Returns tuple (benchmark name, dict of options)
+    '''
+    opts = {"depth": 6, "width": 2, "files": 50, "fileSize": 1024,
+            "repeat": 5, "workers": 4, "tmpDir": None}
+    if len(av) < 2 or len(av) % 2 != 0 or av[1] in ("-h", "--help"):
+        printHelp()
+    for i in range(2, len(av), 2):
+        name = av[i][2:]
+        if not(av[i].startswith("--")) or name not in opts:
+            print(f"Unknown argument '{av[i]}'")
+            sys.exit(-1)
+        opts[name] = av[i+1] if name == "tmpDir" else int(av[i+1])
+    return (av[1], opts)
+
+def makeSyntheticTree(rootPath, depth, width, filesPerDir, fileSize,
+                      shuffled=False):
+    '''Creates a tree of directories with long names under rootPath(str),
+    every dir holding filesPerDir files of fileSize bytes each; only the
+    first sub-dir of every dir is branched further, so that paths get deep.
+    shuffled (optional), bool, if True, the files are written in random
+        order, so that their location on disk does not follow their paths
+        (as in a tree which has aged)
+    Returns the number of files created
+    '''
+    content = os.urandom(fileSize)
+    filePaths = []
+    pending = [(rootPath, 0)]
+    while pending:
+        dirPath, lvl = pending.pop()
+        filePaths.extend(os.path.join(dirPath, f"synthetic_file_{i:05d}.dat")
+                         for i in range(filesPerDir))
+        if lvl < depth:
+            for w in range(width):
+                subDir = os.path.join(dirPath,
+                                      f"synthetic_directory_lvl{lvl}_{w:03d}")
+                os.mkdir(subDir)
+                if w == 0 or lvl + 1 == depth:
+                    pending.append((subDir, lvl + 1))
+    if shuffled:
+        random.Random(0).shuffle(filePaths)
+    for created, filePath in enumerate(filePaths):
+        # unique content, so that files are not duplicates of each other
+        with open(filePath, 'wb') as f:
+            f.write(content[:-8] + created.to_bytes(8, "little"))
+    return len(filePaths)
+
+def timeScan(srcPath, destPath):
+    '''Takes a src snapshot (adapting dest) and a dest snapshot, as done at
+    the beginning of a sync cycle. Returns the duration in seconds
+    '''
+    start = time.perf_counter()
+    srcSnap = dict()
+    getDirSnapshotAndAdapt(srcSnap, SrcDir(srcPath, srcPath), 0,
+                           srcPath, destPath)
+    fetchExistingDestFiles(destPath, {}, [])
+    return time.perf_counter() - start
+
+def benchmarkDirFd(rootPath, opts):
+    srcPath = os.path.join(rootPath, "src")
+    destPath = os.path.join(rootPath, "dest")
+    os.mkdir(srcPath)
+    fileCount = makeSyntheticTree(srcPath, opts["depth"], opts["width"],
+                                  opts["files"], opts["fileSize"])
+    shutil.copytree(srcPath, destPath)
+    print(f"Synthetic tree: {fileCount} files in src and in dest")
+    if not(BaseFile.useDirFds):
+        print("Dir fd relative operations are not supported here")
+        return
+    # warm up the hash cache, so that the path lookups dominate
+    timeScan(srcPath, destPath)
+    results = {}
+    for useDirFds in (False, True):
+        BaseFile.useDirFds = useDirFds
+        durations = [timeScan(srcPath, destPath)
+                     for r in range(opts["repeat"])]
+        hashCache.prune()
+        results[useDirFds] = min(durations)
+        variant = "dir fd relative" if useDirFds else "absolute paths "
+        perEntry = results[useDirFds] / (2 * fileCount) * 1e6
+        print(f"  {variant}: best of {opts['repeat']} scans ", end='')
+        print(f"{results[useDirFds]:.3f} s, {perEntry:.1f} us per file")
+    reduction = 1 - results[True] / results[False]
+    print(f"Scan time reduced by {reduction:.1%} with dir fd relative access")
+
+def benchmarkPipeline(rootPath, opts):
+    srcPath = os.path.join(rootPath, "src")
+    destPath = os.path.join(rootPath, "dest")
+    os.mkdir(srcPath)
+    fileCount = makeSyntheticTree(srcPath, opts["depth"], opts["width"],
+                                  opts["files"], opts["fileSize"])
+    print(f"Synthetic tree: {fileCount} files in src, dest empty")
+    variants = {"sequential": {"pipeline": "sequential"},
+                "async": {"pipeline": "async",
+                          "hashWorkers": opts["workers"],
+                          "copyWorkers": opts["workers"]}}
+    results = {}
+    for name, cycleOpts in variants.items():
+        durations = []
+        for r in range(opts["repeat"]):
+            # every run starts from scratch: empty dest, nothing hashed yet
+            if os.path.isdir(destPath):
+                shutil.rmtree(destPath)
+            os.mkdir(destPath)
+            hashCache.entries.clear()
+            start = time.perf_counter()
+            startSyncing.syncCycle(srcPath, [destPath], cycleOpts)
+            durations.append(time.perf_counter() - start)
+        results[name] = min(durations)
+        print(f"  {name:10}: best of {opts['repeat']} cycles ", end='')
+        print(f"{results[name]:.3f} s")
+    reduction = 1 - results["async"] / results["sequential"]
+    print(f"Cycle time reduced by {reduction:.1%} with the async pipeline")
+
+def listTree(rootPath):
+    '''Returns a tuple (list of file abs paths, list of dir abs paths)
+    under rootPath, as tracked for removal after syncing
+    '''
+    files, dirs = [], []
+    for dirPath, dirNames, fileNames in os.walk(rootPath):
+        dirs.extend(os.path.join(dirPath, d) for d in dirNames)
+        files.extend(os.path.join(dirPath, f) for f in fileNames)
+    return (files, dirs)
+
+def benchmarkDelete(rootPath, opts):
+    treePath = os.path.join(rootPath, "obsolete")
+    variants = {"one at a time": (False, 1),
+                f"bulk, {opts['workers']} workers": (BaseFile.useDirFds,
+                                                     opts["workers"])}
+    results = {}
+    useDirFds = BaseFile.useDirFds
+    for name, (variantUseDirFds, workers) in variants.items():
+        durations = []
+        for r in range(opts["repeat"]):
+            os.mkdir(treePath)
+            fileCount = makeSyntheticTree(treePath, opts["depth"],
+                                          opts["width"], opts["files"],
+                                          opts["fileSize"])
+            files, dirs = listTree(treePath)
+            BaseFile.useDirFds = variantUseDirFds
+            bulkDeleter.setWorkers(workers)
+            start = time.perf_counter()
+            bulkDeleter.removeFiles(files)
+            removed = bulkDeleter.removeDirs(dirs + [treePath])
+            durations.append(time.perf_counter() - start)
+            BaseFile.useDirFds = useDirFds
+            if len(removed) != len(dirs) + 1:
+                print(f"  {name}: {len(dirs) + 1 - len(removed)} dirs left")
+                shutil.rmtree(treePath)
+        results[name] = min(durations)
+        print(f"  {name:16}: best of {opts['repeat']} removals of ", end='')
+        print(f"{fileCount} files, {len(dirs)} dirs: {results[name]:.3f} s")
+    first, bulk = results.values()
+    print(f"Removal time reduced by {1 - bulk / first:.1%} in bulk")
+
+def benchmarkRangeCopy(rootPath, opts):
+    srcPath = os.path.join(rootPath, "large")
+    with open(srcPath, "wb") as f:
+        for written in range(0, opts["fileSize"], 1024 ** 2):
+            f.write(os.urandom(min(1024 ** 2, opts["fileSize"] - written)))
+    srcF = SrcFile(srcPath)
+    variants = {"one stream": None,
+                f"ranges, {opts['workers']} workers": 1}
+    results = {}
+    for name, threshold in variants.items():
+        SrcFile.rangeCopyThreshold = threshold
+        SrcFile.rangeCopyWorkers = opts["workers"]
+        durations = []
+        for r in range(opts["repeat"]):
+            destPath = os.path.join(rootPath, "copy")
+            start = time.perf_counter()
+            if not(srcF.cpFile(srcPath, destPath)):
+                print(f"  {name}: copy failed")
+            durations.append(time.perf_counter() - start)
+            os.remove(destPath)
+        results[name] = min(durations)
+        print(f"  {name:18}: best of {opts['repeat']} copies of ", end='')
+        print(f"{opts['fileSize']} bytes: {results[name]:.3f} s")
+    single, ranged = results.values()
+    print(f"Copy time reduced by {1 - ranged / single:.1%} as byte ranges")
+
+def dropCachedPages(filePaths):
+    '''Asks the kernel to drop the cached pages of the files, so that they
+    are read from the storage again (where posix_fadvise is supported)
+    '''
+    if not(hasattr(os, "posix_fadvise")):
+        return
+    for filePath in filePaths:
+        fd = os.open(filePath, os.O_RDONLY)
+        try:
+            os.fdatasync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+def headTravel(filePaths):
+    '''Returns the sum of the distances (bytes) between the physical
+    locations of the files read one after another, or None, if those are
+    not known (see StorageProfile.locationOf)
+    '''
+    locations = [storageProfile.locationOf(p) for p in filePaths]
+    if any(kind != 0 for kind, offset in locations):
+        return None
+    return sum(abs(b[1] - a[1]) for a, b in zip(locations, locations[1:]))
+
+def benchmarkOrdering(rootPath, opts):
+    srcPath = os.path.join(rootPath, "src")
+    destPath = os.path.join(rootPath, "dest")
+    os.mkdir(srcPath)
+    fileCount = makeSyntheticTree(srcPath, opts["depth"], opts["width"],
+                                  opts["files"], opts["fileSize"],
+                                  shuffled=True)
+    filePaths, dirPaths = listTree(srcPath)
+    print(f"Synthetic tree: {fileCount} files in src (written in random ", end='')
+    print("order), dest empty")
+    print(f"Src storage (rotational, queue depth): "
+          f"{storageProfile.detect(srcPath)}")
+    variants = {"path order": ("none", "tree"),
+                "physical order": ("hdd", "physical")}
+    results = {}
+    for name, (storage, copyOrder) in variants.items():
+        storageProfile.setUp(storage, srcPath, [destPath])
+        copyOrdering.setPolicy(copyOrder)
+        durations = []
+        for r in range(opts["repeat"]):
+            # every run starts from scratch: empty dest, nothing hashed yet
+            if os.path.isdir(destPath):
+                shutil.rmtree(destPath)
+            os.mkdir(destPath)
+            hashCache.entries.clear()
+            dropCachedPages(filePaths)
+            start = time.perf_counter()
+            startSyncing.syncCycle(srcPath, [destPath],
+                                   {"pipeline": "sequential"})
+            durations.append(time.perf_counter() - start)
+        results[name] = min(durations)
+        print(f"  {name:14}: best of {opts['repeat']} cycles ", end='')
+        print(f"{results[name]:.3f} s")
+    storageProfile.setUp("none", srcPath)
+    copyOrdering.setPolicy("tree")
+    # the distance the disk head travels reading the files once
+    pathOrder = sorted(filePaths)
+    physicalOrder = sorted(filePaths, key=storageProfile.locationOf)
+    travels = [headTravel(pathOrder), headTravel(physicalOrder)]
+    if None not in travels:
+        print(f"  Head travel reading the src once: "
+              f"{travels[0] / 1024 ** 2:.0f} MiB in path order, "
+              f"{travels[1] / 1024 ** 2:.0f} MiB in physical order")
+    reduction = 1 - results["physical order"] / results["path order"]
+    print(f"Cycle time reduced by {reduction:.1%} in physical order")
+
+def joinedPaths(srcSnap, srcPath, destPath):
+    # the paths of every file, as put together before there were dir nodes:
+    # in the loop of syncSnapshot, then in SrcFile.syncFile
+    for lvl in srcSnap:
+        for srcD in srcSnap[lvl]:
+            for srcF in srcD.getContainedFiles():
+                fAbsPath_new = os.path.join(destPath, srcD.getRelPath(),
+                                            srcF.getName())
+                fAbsPath_new = os.path.normpath(fAbsPath_new)
+                fRelP = os.path.join(srcD.getRelPath(), srcF.getName())
+                curAbsP = os.path.normpath(os.path.join(srcPath, fRelP))
+                newAbsP = os.path.normpath(os.path.join(destPath, fRelP))
+
+def nodePaths(srcSnap, srcPath, destPath):
+    # the same paths, put together from the dir nodes
+    pathNodes.reset()
+    for lvl in srcSnap:
+        for srcD in srcSnap[lvl]:
+            srcNode = pathNodes.dirOf(srcPath, srcD.getRelPath())
+            destNode = pathNodes.dirOf(destPath, srcD.getRelPath())
+            for srcF in srcD.getContainedFiles():
+                fAbsPath_new = destNode.filePath(srcF.getName())
+                curAbsP = srcNode.filePath(srcF.getName())
+                newAbsP = fAbsPath_new
+
+def benchmarkPathCost(rootPath, opts):
+    srcPath = os.path.join(rootPath, "src")
+    destPath = os.path.join(rootPath, "dest")
+    os.mkdir(srcPath)
+    fileCount = makeSyntheticTree(srcPath, opts["depth"], opts["width"],
+                                  opts["files"], opts["fileSize"])
+    shutil.copytree(srcPath, destPath)
+    print(f"Synthetic tree: {fileCount} files in src and in dest")
+    srcSnap = dict()
+    getDirSnapshotAndAdapt(srcSnap, SrcDir(srcPath, srcPath), 0,
+                           srcPath, destPath)
+    # CPU time only, the paths are put together without any syscalls
+    results = {}
+    for name, putTogether in (("joined paths", joinedPaths),
+                              ("dir nodes", nodePaths)):
+        durations = []
+        for r in range(opts["repeat"]):
+            start = time.process_time()
+            putTogether(srcSnap, srcPath, destPath)
+            durations.append(time.process_time() - start)
+        results[name] = min(durations)
+        perFile = results[name] / fileCount * 1e6
+        print(f"  {name:12}: best of {opts['repeat']} runs ", end='')
+        print(f"{results[name]:.4f} s, {perFile:.2f} us per file")
+    reduction = 1 - results["dir nodes"] / results["joined paths"]
+    print(f"Path CPU time reduced by {reduction:.1%} with dir nodes")
+    # the whole steady state cycle, for scale
+    startSyncing.syncCycle(srcPath, [destPath], {"pipeline": "sequential"})
+    durations = []
+    for r in range(opts["repeat"]):
+        start = time.process_time()
+        startSyncing.syncCycle(srcPath, [destPath],
+                               {"pipeline": "sequential"})
+        durations.append(time.process_time() - start)
+    perFile = min(durations) / fileCount * 1e6
+    print(f"  Whole cycle, dest in sync: {perFile:.1f} us CPU per file")
+
+def main():
+    benchmark, opts = parseArgs(sys.argv)
+    benchmarks = {"dirfd": benchmarkDirFd, "pipeline": benchmarkPipeline,
+                  "delete": benchmarkDelete, "rangecopy": benchmarkRangeCopy,
+                  "ordering": benchmarkOrdering, "pathcost": benchmarkPathCost}
+    if benchmark not in benchmarks:
+        print(f"Unknown benchmark '{benchmark}'")
+        sys.exit(-1)
+    # the syncing steps log a lot; only warnings and worse are of interest
+    logger.setLevel(logging.WARNING)
+    rootPath = tempfile.mkdtemp(prefix="syncBenchmark_", dir=opts["tmpDir"])
+    try:
+        benchmarks[benchmark](rootPath, opts)
+    finally:
+        shutil.rmtree(rootPath)
+
+if __name__ == "__main__":
+    main()
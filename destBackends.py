@@ -0,0 +1,980 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import os
+import queue
+import socket
+import stat
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+from helpingClasses import SrcFile, DestFile, hashAlgo
+from helpingClasses import cycleMetrics, hashCache, ioThrottle, syncJournal
+from helpingClasses import changeFeed, copyOrdering, pathFilter
+from helpingFuncs import orderHashing, isHashingOrdered
+
+logger = logging.getLogger(f"main.{__name__}")
+
+# dir under the dest root, where dest files are set aside while they wait
+# to be moved to their new paths (see DestBackend.stageFiles)
+stageDirName = ".syncipy-stage"
+# max number of items (paths) per batch request
+batchSize = 256
+# max number of requests sent to the receiver, before its replies are read
+maxPendingRequests = 32
+# max size of a content frame of a streamed file
+frameSize = 1024 ** 2
+# max number of chunks read ahead of a destination, when the content is
+# written to several destinations (see ContentFanOut)
+fanOutQueueSize = 8
+
+
+def getSrcManifest(srcDirPath):
+    '''Lists and hashes (see SrcFile) the content of the src dir tree.
+    Symbolic links and excluded entries (see PathFilter) are ignored, same
+    as by the local syncing. With a cycle budget or on a rotational src,
+    the files are hashed once all are listed (some may be postponed, see
+    orderHashing).
+    Returns a tuple (dict of {relPath: SrcFile}, set of dir relPaths),
+    where relPaths are relative to srcDirPath and use '/' as separator
+    '''
+    files = {}
+    dirs = set()
+    listed = [] # (SrcFile, abs path of its dir), hashed within the budget
+    pending = [""]
+    while pending:
+        relDir = pending.pop()
+        absDir = os.path.join(srcDirPath, *relDir.split("/"))
+        try:
+            with os.scandir(absDir) as it:
+                entries = list(it)
+        except OSError as e:
+            logger.error(f"Could NOT list src dir '{absDir}'", exc_info=True)
+            continue
+        for entry in entries:
+            relPath = f"{relDir}/{entry.name}" if relDir else entry.name
+            try:
+                if entry.is_symlink():
+                    logger.debug(f"Ignoring link '{entry.path}'")
+                elif relPath == stageDirName:
+                    # reserved for staging in dest, see DestBackend.stageFiles
+                    logger.warning(f"Not syncing '{entry.path}', its name is "
+                                   f"reserved for the staging dir in dest")
+                elif pathFilter.excludes(relPath, entry.is_dir()):
+                    logger.debug(f"Excluded from syncing: '{entry.path}'")
+                elif entry.is_dir():
+                    dirs.add(relPath)
+                    pending.append(relPath)
+                elif entry.is_file():
+                    files[relPath] = SrcFile(
+                        entry.path,
+                        statResult=entry.stat(follow_symlinks=False),
+                        hashNow=not(isHashingOrdered()))
+                    listed.append((files[relPath], absDir))
+            except OSError as e:
+                logger.error(f"Could NOT list src file '{entry.path}'",
+                             exc_info=True)
+    if isHashingOrdered():
+        for srcF, absDir in orderHashing(listed, srcDirPath):
+            try:
+                srcF.hashFile(absDir)
+            except OSError as e:
+                logger.error(f"Could NOT hash src file '{srcF.getName()}' "
+                             f"in '{absDir}'", exc_info=True)
+                srcF.postponed = True
+    return (files, dirs)
+
+def readFileChunks(absPath):
+    '''Yields the content of the file at absPath(str) in chunks (bytes),
+    keeping the read rate within the I/O limits
+    '''
+    ioThrottle.throttleOp()
+    with open(absPath, 'rb') as f:
+        while True:
+            chunk = f.read(frameSize)
+            if not chunk:
+                return
+            ioThrottle.throttleRead(len(chunk))
+            yield chunk
+
+
+class DestBackend(object):
+    '''Interface of a destination, to which syncToBackend syncs the src
+    dir tree. All paths are relative to the dest root and use '/' as the
+    separator. Batch methods take lists of items and return the list of
+    the relPaths, which could NOT be handled (errors are logged by the
+    backend), so a failing item does not stop the rest of a batch.
+    '''
+
+    def open(self):
+        '''Prepares the backend for a sync cycle, e.g. connects
+        '''
+        pass
+
+    def close(self):
+        pass
+
+    def fetchIndex(self):
+        '''Returns a tuple (dict of {file relPath: (hashHex, mode bits)},
+        set of dir relPaths) describing the current content of the dest
+        '''
+        raise NotImplementedError
+
+    def stageFiles(self, relPaths):
+        '''Sets aside the files at relPaths, so that their paths are free,
+        but their content is still available to moveFiles.
+        Returns a dict of {relPath: staged relPath} of the staged files
+        '''
+        raise NotImplementedError
+
+    def removeFiles(self, relPaths):
+        raise NotImplementedError
+
+    def removeDirs(self, relPaths):
+        '''Removes the (empty) dirs at relPaths, the deepest ones first
+        '''
+        raise NotImplementedError
+
+    def makeDirs(self, relPaths):
+        '''Creates dirs at relPaths, the shallowest ones first
+        '''
+        raise NotImplementedError
+
+    def moveFiles(self, items):
+        '''items, list of tuples (from relPath, to relPath, mode bits)
+        '''
+        raise NotImplementedError
+
+    def cloneFiles(self, items):
+        '''Copies files inside the dest, without transferring content
+        items, list of tuples (from relPath, to relPath, mode bits)
+        '''
+        raise NotImplementedError
+
+    def putFiles(self, items):
+        '''Writes new content to the dest.
+        items, list of tuples (relPath, hashHex, mode bits, chunks), where
+            chunks is an iterable of the content (bytes) to be written
+        '''
+        raise NotImplementedError
+
+    def setModes(self, items):
+        '''items, list of tuples (relPath, mode bits)
+        '''
+        raise NotImplementedError
+
+    def finish(self):
+        '''Ends a sync cycle, dropping whatever is left staged
+        '''
+        raise NotImplementedError
+
+
+class LocalDestBackend(DestBackend):
+    '''Destination in the local file system, kept in sync by relative path
+    and hash value only (unlike the default syncing, the dest dir structure
+    is not adapted, files are moved/copied in place instead). This is what
+    the receiver daemon (see SyncReceiver) uses on the dest host.
+    Hash values come from the hash cache, so the receiver keeps its own
+    hash index and dest files are only hashed again if they have changed.
+    '''
+
+    def __init__(self, destDirPath):
+        self.destDirPath = destDirPath
+        self.index = {} # {file relPath: (hashHex, mode bits)}
+        self.stageCount = 0 # staged files so far, used for unique names
+
+    def __str__(self):
+        return f"'{self.destDirPath}'"
+
+    def absPathOf(self, relPath):
+        '''Returns the abs path (str) of relPath(str) in the dest; raises
+        ValueError if relPath would point outside of the dest
+        '''
+        parts = relPath.split("/")
+        for p in parts:
+            if p in ("", ".", "..") or os.sep in p or \
+                    (os.altsep and os.altsep in p):
+                raise ValueError(f"Invalid relative path '{relPath}'")
+        return os.path.join(self.destDirPath, *parts)
+
+    def fetchIndex(self):
+        self.index = {}
+        dirs = set()
+        pending = [""]
+        while pending:
+            relDir = pending.pop()
+            absDir = os.path.join(self.destDirPath, *relDir.split("/"))
+            try:
+                with os.scandir(absDir) as it:
+                    entries = list(it)
+            except OSError as e:
+                logger.error(f"Could NOT list dest dir '{absDir}'",
+                             exc_info=True)
+                continue
+            for entry in entries:
+                relPath = f"{relDir}/{entry.name}" if relDir else entry.name
+                if relPath == stageDirName:
+                    continue
+                if pathFilter.excludes(relPath, entry.is_dir()):
+                    # listed, so that the dirs holding it are kept (see
+                    # prepareBackend), but neither looked into, nor hashed
+                    if entry.is_dir():
+                        dirs.add(relPath)
+                    else:
+                        self.index[relPath] = (None, None)
+                    continue
+                try:
+                    if entry.is_symlink():
+                        logger.debug(f"Ignoring link '{entry.path}'")
+                    elif entry.is_dir():
+                        dirs.add(relPath)
+                        pending.append(relPath)
+                    elif SrcFile.isTempName(entry.name):
+                        # left over by an interrupted copy
+                        os.remove(entry.path)
+                        logger.info(f"Removed unfinished copy '{entry.path}'")
+                    elif entry.is_file():
+                        st = entry.stat(follow_symlinks=False)
+                        destF = DestFile(entry.path, statResult=st)
+                        self.index[relPath] = (destF.getHash(),
+                                               stat.S_IMODE(st.st_mode))
+                except OSError as e:
+                    logger.error(f"Could NOT index dest file '{entry.path}'",
+                                 exc_info=True)
+        return (self.index, dirs)
+
+    def stageFiles(self, relPaths):
+        staged = {}
+        if not(relPaths):
+            return staged
+        os.makedirs(self.absPathOf(stageDirName), exist_ok=True)
+        for relPath in relPaths:
+            self.stageCount += 1
+            stagedRelPath = f"{stageDirName}/{self.stageCount}"
+            try:
+                absPath = self.absPathOf(relPath)
+                stagedAbsPath = self.absPathOf(stagedRelPath)
+                os.rename(absPath, stagedAbsPath)
+                logger.debug(f"Staged file '{absPath}' as '{stagedAbsPath}'")
+                hashCache.move(absPath, stagedAbsPath)
+                changeFeed.record("moved", stagedAbsPath,
+                                  self.index[relPath][0], fromAbsPath=absPath)
+                syncJournal.record("move", to=stagedAbsPath,
+                                   **{"from": absPath})
+                self.index[stagedRelPath] = self.index.pop(relPath)
+                staged[relPath] = stagedRelPath
+            except (OSError, ValueError) as e:
+                logger.error(f"Could NOT stage file '{relPath}'", exc_info=True)
+        return staged
+
+    def removeFiles(self, relPaths):
+        failed = []
+        for relPath in relPaths:
+            try:
+                absPath = self.absPathOf(relPath)
+                ioThrottle.throttleOp()
+                os.remove(absPath)
+                logger.info(f"  File removed from destination, '{absPath}'")
+                cycleMetrics.addChange("removed")
+                hashCache.forget(absPath)
+                syncJournal.record("remove", path=absPath)
+                changeFeed.record("deleted", absPath,
+                                  self.index.pop(relPath, (None,))[0])
+            except (OSError, ValueError) as e:
+                logger.error(f"  File cannot be removed: '{relPath}'",
+                             exc_info=True)
+                failed.append(relPath)
+        return failed
+
+    def removeDirs(self, relPaths):
+        failed = []
+        for relPath in sorted(relPaths, key=lambda p: p.count("/"),
+                              reverse=True):
+            try:
+                absPath = self.absPathOf(relPath)
+                os.rmdir(absPath)
+                logger.info(f"Dir removed from dest: '{absPath}'")
+                cycleMetrics.addChange("dir removed")
+                changeFeed.record("deleted", absPath, isDir=True)
+            except (OSError, ValueError) as e:
+                logger.error(f"Dir cannot be removed: '{relPath}' ",
+                             exc_info=True)
+                failed.append(relPath)
+        return failed
+
+    def makeDirs(self, relPaths):
+        failed = []
+        for relPath in sorted(relPaths, key=lambda p: p.count("/")):
+            try:
+                absPath = self.absPathOf(relPath)
+                os.mkdir(absPath)
+                logger.info(f"Dir created in dest: '{absPath}'")
+                cycleMetrics.addChange("dir created")
+                changeFeed.record("created", absPath, isDir=True)
+            except (OSError, ValueError) as e:
+                logger.error(f"Dir cannot be created: '{relPath}'",
+                             exc_info=True)
+                failed.append(relPath)
+        return failed
+
+    def moveFiles(self, items):
+        failed = []
+        for fromRelPath, toRelPath, mode in items:
+            try:
+                fromAbsPath = self.absPathOf(fromRelPath)
+                toAbsPath = self.absPathOf(toRelPath)
+                destF = DestFile(fromAbsPath, hashNow=False)
+                destF.hashHex = self.index[fromRelPath][0]
+                if not(destF.mvFile(fromAbsPath, toAbsPath)):
+                    raise OSError(f"Move to '{toRelPath}' failed")
+                os.chmod(toAbsPath, mode)
+                self.index[toRelPath] = (destF.hashHex, mode)
+                self.index.pop(fromRelPath)
+            except (OSError, ValueError, KeyError) as e:
+                logger.error(f"FAILED move '{fromRelPath}' -> '{toRelPath}'",
+                             exc_info=True)
+                failed.append(toRelPath)
+        return failed
+
+    def cloneFiles(self, items):
+        failed = []
+        for fromRelPath, toRelPath, mode in items:
+            try:
+                fromAbsPath = self.absPathOf(fromRelPath)
+                toAbsPath = self.absPathOf(toRelPath)
+                srcF = SrcFile(fromAbsPath, hashNow=False)
+                srcF.hashHex = self.index[fromRelPath][0]
+                # a hard link only, if the mode of the clone is the same
+                srcF.mode = stat.S_IFMT(srcF.mode) | mode
+                if not(srcF.cloneFile(fromAbsPath, toAbsPath)):
+                    raise OSError(f"Copy to '{toRelPath}' failed")
+                os.chmod(toAbsPath, mode)
+                self.index[toRelPath] = (srcF.hashHex, mode)
+            except (OSError, ValueError, KeyError) as e:
+                logger.error(f"FAILED clone '{fromRelPath}' -> '{toRelPath}'",
+                             exc_info=True)
+                failed.append(toRelPath)
+        return failed
+
+    def putFiles(self, items):
+        return [relPath for relPath, hashHex, mode, chunks in items
+                if not(self.putFile(relPath, hashHex, mode, chunks))]
+
+    def putFile(self, relPath, hashHex, mode, chunks):
+        '''Writes the content from chunks (iterable of bytes) to a temp file,
+        which is renamed to relPath only if the content matches hashHex.
+        Returns True on success
+        '''
+        tmpAbsPath = None
+        try:
+            absPath = self.absPathOf(relPath)
+            tmpAbsPath = SrcFile.tempPathFor(absPath)
+            hashFunc = hashAlgo()
+            ioThrottle.throttleOp()
+            with open(tmpAbsPath, 'wb') as destF:
+                for chunk in chunks:
+                    ioThrottle.throttleWrite(len(chunk))
+                    hashFunc.update(chunk)
+                    destF.write(chunk)
+                destF.flush()
+                os.fsync(destF.fileno())
+            if hashFunc.hexdigest() != hashHex:
+                raise ValueError("Content received does not match its hash")
+            os.replace(tmpAbsPath, absPath)
+            os.chmod(absPath, mode)
+            logger.info(f"File received: '{absPath}'")
+            cycleMetrics.addChange("copied")
+            received = os.stat(absPath)
+            statKey = (received.st_size, received.st_mtime_ns,
+                       received.st_ino)
+            hashCache.store(absPath, statKey, hashHex)
+            syncJournal.record("copy", path=absPath, key=statKey,
+                               hash=hashHex)
+            changeFeed.record("created", absPath, hashHex)
+            self.index[relPath] = (hashHex, mode)
+            return True
+        except (OSError, ValueError) as e:
+            logger.error(f"Could NOT receive file '{relPath}'", exc_info=True)
+            if tmpAbsPath:
+                try:
+                    os.remove(tmpAbsPath)
+                except OSError:
+                    pass
+            return False
+
+    def setModes(self, items):
+        failed = []
+        for relPath, mode in items:
+            try:
+                absPath = self.absPathOf(relPath)
+                os.chmod(absPath, mode)
+                logger.info(f"Changed mode of '{absPath}' to {oct(mode)}")
+                cycleMetrics.addChange("mode changed")
+                changeFeed.record("metadata", absPath)
+            except (OSError, ValueError) as e:
+                logger.error(f"Could NOT change mode of '{relPath}'",
+                             exc_info=True)
+                failed.append(relPath)
+        return failed
+
+    def finish(self):
+        stageAbsPath = self.absPathOf(stageDirName)
+        if not(os.path.isdir(stageAbsPath)):
+            return
+        leftOver = [f"{stageDirName}/{name}"
+                    for name in os.listdir(stageAbsPath)]
+        self.removeFiles(leftOver)
+        try:
+            os.rmdir(stageAbsPath)
+        except OSError as e:
+            logger.error(f"Could NOT remove '{stageAbsPath}'", exc_info=True)
+
+
+class RemoteDestBackend(DestBackend):
+    '''Destination on another host, served by a receiver daemon (see
+    SyncReceiver) over TCP. Requests are JSON lines, replied to by JSON
+    lines in the same order. Requests are pipelined: up to
+    maxPendingRequests are sent, before the replies are read. The content
+    of a file follows its 'put' request as frames (4 byte length, then the
+    bytes), ended by an empty frame, so a file can be streamed without
+    knowing its final size upfront.
+    '''
+
+    def __init__(self, host, port, timeout=300):
+        self.host = host
+        self.port = port
+        self.timeout = timeout # seconds, for connecting and every reply
+        self.sock = None
+        self.reader = None
+        self.writer = None
+        self.pending = 0 # requests sent, their replies not yet read
+        self.replies = [] # replies read, not yet collected
+
+    def __str__(self):
+        return f"tcp://{self.host}:{self.port}"
+
+    def open(self):
+        self.sock = socket.create_connection((self.host, self.port),
+                                             timeout=self.timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = self.sock.makefile('rb')
+        self.writer = self.sock.makefile('wb')
+        self.pending = 0
+        self.replies = []
+        logger.info(f"Connected to receiver {self.host}:{self.port}")
+
+    def close(self):
+        for f in (self.reader, self.writer, self.sock):
+            if f is not None:
+                try:
+                    f.close()
+                except OSError:
+                    pass
+        self.sock = self.reader = self.writer = None
+
+    def request(self, op, args, chunks=None):
+        '''Sends a request, without waiting for its reply (see collect)
+        chunks (optional), iterable of bytes, the content streamed after
+            the request
+        '''
+        while self.pending >= maxPendingRequests:
+            self.replies.append(self.receive())
+        line = json.dumps({"op": op, "args": args}) + "\n"
+        self.writer.write(line.encode("utf-8"))
+        if chunks is not None:
+            try:
+                for chunk in chunks:
+                    self.writer.write(struct.pack(">I", len(chunk)))
+                    self.writer.write(chunk)
+            except OSError as e:
+                # the content is cut short, so the receiver is going to
+                # reject it as not matching its hash
+                logger.error(f"Could NOT read content of '{args['path']}'",
+                             exc_info=True)
+            self.writer.write(struct.pack(">I", 0))
+        self.pending += 1
+
+    def receive(self):
+        self.writer.flush()
+        line = self.reader.readline()
+        if not(line):
+            raise ConnectionError("Receiver closed the connection")
+        self.pending -= 1
+        reply = json.loads(line)
+        if "error" in reply:
+            raise RuntimeError(f"Receiver failed a request: {reply['error']}")
+        return reply["result"]
+
+    def collect(self):
+        '''Waits for the replies of all sent requests.
+        Returns the list of their results, in the order of the requests
+        '''
+        while self.pending:
+            self.replies.append(self.receive())
+        replies, self.replies = self.replies, []
+        return replies
+
+    def batchRequest(self, op, items):
+        '''Sends items in batches of batchSize, returns the list of results
+        '''
+        for i in range(0, len(items), batchSize):
+            self.request(op, {"items": items[i:i+batchSize]})
+        return self.collect()
+
+    def failedBatchRequest(self, op, items, metricsKind=None):
+        failed = []
+        for result in self.batchRequest(op, items):
+            failed.extend(result)
+        if metricsKind and len(items) > len(failed):
+            cycleMetrics.addChange(metricsKind, len(items) - len(failed))
+        for relPath in failed:
+            logger.error(f"Receiver could NOT {op} '{relPath}'")
+        return failed
+
+    def fetchIndex(self):
+        files = {}
+        dirs = set()
+        start = 0
+        while start is not None:
+            self.request("index", {"start": start})
+            result = self.collect()[0]
+            for relPath, hashHex, mode in result["files"]:
+                files[relPath] = (hashHex, mode)
+            dirs.update(result["dirs"])
+            start = result["next"]
+        return (files, dirs)
+
+    def stageFiles(self, relPaths):
+        staged = {}
+        for result in self.batchRequest("stage", relPaths):
+            staged.update(result)
+        return staged
+
+    def removeFiles(self, relPaths):
+        return self.failedBatchRequest("removeFiles", relPaths, "removed")
+
+    def removeDirs(self, relPaths):
+        # sent at once, so that the receiver orders them by depth
+        self.request("removeDirs", {"items": relPaths})
+        failed = self.collect()[0]
+        if len(relPaths) > len(failed):
+            cycleMetrics.addChange("dir removed", len(relPaths) - len(failed))
+        return failed
+
+    def makeDirs(self, relPaths):
+        self.request("makeDirs", {"items": relPaths})
+        failed = self.collect()[0]
+        if len(relPaths) > len(failed):
+            cycleMetrics.addChange("dir created", len(relPaths) - len(failed))
+        return failed
+
+    def moveFiles(self, items):
+        return self.failedBatchRequest("move", items, "moved")
+
+    def cloneFiles(self, items):
+        return self.failedBatchRequest("clone", items, "copied")
+
+    def putFiles(self, items):
+        for relPath, hashHex, mode, chunks in items:
+            self.request("put", {"path": relPath, "hash": hashHex,
+                                 "mode": mode}, chunks)
+            logger.debug(f"Streamed '{relPath}' to the receiver")
+        failed = [item[0] for item, ok in zip(items, self.collect())
+                  if not(ok)]
+        if len(items) > len(failed):
+            cycleMetrics.addChange("copied", len(items) - len(failed))
+        for relPath in failed:
+            logger.error(f"Receiver could NOT store '{relPath}'")
+        return failed
+
+    def setModes(self, items):
+        return self.failedBatchRequest("chmod", items, "mode changed")
+
+    def finish(self):
+        self.request("finish", {})
+        self.collect()
+
+
+class ContentFanOut(object):
+    '''Reads the content missing in several destinations once, handing
+    every chunk to each of the destinations needing it (see
+    syncToBackends). Every destination consumes its share in its own
+    thread, through a bounded queue, so that at most fanOutQueueSize chunks
+    per destination are held in memory, and the slowest destination sets
+    the pace of the reading.
+    '''
+
+    endOfContent = None # queued after the last chunk of a content
+
+    def __init__(self, srcDirPath, count):
+        '''count, int, number of destinations
+        '''
+        self.srcDirPath = srcDirPath
+        self.queues = [queue.Queue(maxsize=fanOutQueueSize)
+                       for i in range(count)]
+        self.failed = [False] * count # destinations, which stopped reading
+        self.contents = [] # list of (src relPath, destination numbers)
+
+    def add(self, srcRelPath, destNums):
+        '''Adds a content to be read, returns its number, see branch
+        '''
+        self.contents.append((srcRelPath, destNums))
+        return len(self.contents) - 1
+
+    def branch(self, destNum, contentNum):
+        '''Yields the chunks (bytes) of content contentNum for destination
+        destNum. Chunks of earlier contents, which the destination has not
+        read to the end (e.g. after a write error), are skipped.
+        '''
+        while True:
+            num, chunk = self.queues[destNum].get()
+            if num < contentNum:
+                continue
+            if chunk is self.endOfContent:
+                return
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+
+    def hand(self, destNum, item):
+        while not(self.failed[destNum]):
+            try:
+                self.queues[destNum].put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def run(self):
+        '''Reads the contents one after another, handing them to the
+        destinations; to be run alongside the destination threads
+        '''
+        for contentNum, (srcRelPath, destNums) in enumerate(self.contents):
+            absPath = os.path.join(self.srcDirPath, *srcRelPath.split("/"))
+            try:
+                for chunk in readFileChunks(absPath):
+                    for destNum in destNums:
+                        self.hand(destNum, (contentNum, chunk))
+            except OSError as e:
+                # the destinations are going to reject the content cut short
+                logger.error(f"Could NOT read content of '{absPath}'",
+                             exc_info=True)
+                for destNum in destNums:
+                    self.hand(destNum, (contentNum, e))
+            for destNum in destNums:
+                self.hand(destNum, (contentNum, self.endOfContent))
+
+
+def prepareBackend(srcFiles, srcDirs, backend, untouched=()):
+    '''Steps 1. to 3. of syncToBackends for a single destination, up to
+    the moves of the staged files.
+    untouched (optional), iterable of relPaths, whose dest files are left as
+        they are (src files being written, see FileStability)
+    Returns a dict of {hashHex: list of (src relPath, mode bits)} of the
+    content missing in the dest, and lists of the clones (see
+    DestBackend.cloneFiles) and mode fixes (see DestBackend.setModes) to
+    be done once that content is there
+    '''
+    backend.open()
+    logger.info(f"Fetching the index of the destination {backend}")
+    destFiles, destDirs = backend.fetchIndex()
+    holding = set() # dest dirs holding excluded entries, never removed
+    for relPath in untouched:
+        destFiles.pop(relPath, None)
+    if pathFilter.isActive():
+        # a receiver lists everything; excluded entries are left alone
+        excluded = [p for p in destFiles if pathFilter.excludesTree(p)]
+        excluded += [p for p in destDirs if pathFilter.excludesTree(p, True)]
+        for relPath in excluded:
+            destFiles.pop(relPath, None)
+            destDirs.discard(relPath)
+            parent = relPath.rpartition("/")[0]
+            while parent and parent not in holding:
+                holding.add(parent)
+                parent = parent.rpartition("/")[0]
+
+    # src files with the same content at the same path stay untouched
+    kept = {relPath for relPath, srcF in srcFiles.items()
+            if destFiles.get(relPath, ("",))[0] == srcF.getHash()}
+    missing = {} # {hashHex: list of src relPaths needing it}
+    for relPath, srcF in srcFiles.items():
+        if relPath not in kept:
+            missing.setdefault(srcF.getHash(), []).append(relPath)
+    toStage = {} # {hashHex: dest relPath}, one per needed content
+    toRemove = []
+    for relPath, (hashHex, mode) in destFiles.items():
+        if relPath in kept:
+            continue
+        if hashHex in missing and hashHex not in toStage:
+            toStage[hashHex] = relPath
+        else:
+            toRemove.append(relPath)
+    logger.info(f"Dest plan for {backend}: {len(kept)} files in place, "
+                f"{len(toStage)} to move, {len(toRemove)} to remove")
+
+    staged = backend.stageFiles(list(toStage.values()))
+    backend.removeFiles(toRemove)
+    backend.removeDirs(sorted(destDirs - srcDirs - holding))
+    backend.makeDirs(sorted(srcDirs - destDirs))
+
+    present = {destFiles[relPath][0]: relPath for relPath in kept}
+    moves, puts, clones = [], {}, []
+    for hashHex, relPaths in missing.items():
+        modes = [stat.S_IMODE(srcFiles[p].mode) for p in relPaths]
+        stagedRelPath = staged.get(toStage.get(hashHex))
+        if stagedRelPath:
+            moves.append((stagedRelPath, relPaths[0], modes[0]))
+        elif hashHex in present:
+            clones.append((present[hashHex], relPaths[0], modes[0]))
+        else:
+            puts[hashHex] = (relPaths[0], modes[0])
+        # further paths with the same content are cloned from the first
+        clones.extend((relPaths[0], p, m)
+                      for p, m in zip(relPaths[1:], modes[1:]))
+    backend.moveFiles(moves)
+    modeFixes = [(relPath, stat.S_IMODE(srcFiles[relPath].mode))
+                 for relPath in kept
+                 if stat.S_IMODE(srcFiles[relPath].mode) !=
+                 destFiles[relPath][1]]
+    return (puts, clones, modeFixes)
+
+def finishBackend(backend, puts, clones, modeFixes):
+    '''Step 3. and 4. of syncToBackends for a single destination, once
+    prepared (see prepareBackend)
+    puts, list of tuples, see DestBackend.putFiles
+    Returns the list of the relPaths, which could NOT be put
+    '''
+    logger.info(f"Writing {len(puts)} files missing in the dest {backend}")
+    failed = backend.putFiles(puts)
+    backend.cloneFiles(clones)
+    backend.setModes(modeFixes)
+    backend.finish()
+    return failed
+
+def syncToBackends(srcDirPath, backends):
+    '''Runs a sync cycle from srcDirPath(str) to every destination in
+    backends (list of DestBackend):
+        1. lists and hashes the src dir, once, then, for every dest
+            concurrently, fetches its index;
+        2. sets aside (stages) the dest files, whose content is needed at
+            another path, removes the other dest files not matching the
+            src, as well as the dest dirs missing in src, and creates the
+            dirs missing in dest;
+        3. moves the staged files to their new paths, writes the content
+            missing in dest, then clones the content needed at more than
+            one path within the dest (no content transferred);
+        4. fixes the mode of the files, which were already in place.
+    Content missing in several destinations is read from src once and
+    written to all of them (see ContentFanOut). Content is written in the
+    order of the copy order policy (see CopyOrdering).
+    Unlike the local syncing, naming conflicts are resolved by removing or
+    staging whatever is in the way, not by renaming. If a destination
+    fails (e.g. its connection), the cycle is ended for that destination
+    only, and its next cycle starts over.
+    '''
+    logger.info("Getting snapshot of the source dir")
+    srcFiles, srcDirs = getSrcManifest(srcDirPath)
+    # files being written are left for the next cycle (see FileStability),
+    # and so are their dest counterparts; same for postponed files (see
+    # CycleBudget)
+    unstable = [relPath for relPath, srcF in srcFiles.items()
+                if srcF.unstable or srcF.postponed]
+    for relPath in unstable:
+        if srcFiles[relPath].unstable:
+            logger.info(f"'{relPath}' is being written, left for the next "
+                        f"cycle")
+        del srcFiles[relPath]
+    fanOut = ContentFanOut(srcDirPath, len(backends))
+
+    def prepare(destNum):
+        try:
+            return prepareBackend(srcFiles, srcDirs, backends[destNum],
+                                  unstable)
+        except (OSError, RuntimeError, ValueError) as e:
+            logger.error(f"Sync to the destination {backends[destNum]} "
+                         f"interrupted", exc_info=True)
+            backends[destNum].close()
+            return None
+
+    def finish(destNum, puts, clones, modeFixes):
+        try:
+            failed = set(finishBackend(backends[destNum], puts, clones,
+                                       modeFixes))
+            for relPath, hashHex, mode, chunks in puts:
+                if relPath not in failed:
+                    cycleMetrics.addLag(srcFiles[relPath].mtimeNs)
+            logger.info(f"Source files considered synced to "
+                        f"{backends[destNum]}, see log file for details")
+        except (OSError, RuntimeError, ValueError) as e:
+            logger.error(f"Sync to the destination {backends[destNum]} "
+                         f"interrupted", exc_info=True)
+        finally:
+            fanOut.failed[destNum] = True # reads nothing more
+            backends[destNum].close()
+
+    def ordered(contents):
+        # contents, iterable of tuples (hashHex, (src relPath, ...))
+        return sorted(contents, key=lambda t: copyOrdering.sortKey(
+            srcFiles[t[1][0]], t[1][0],
+            os.path.join(srcDirPath, *t[1][0].split("/"))))
+
+    with ThreadPoolExecutor(max_workers=len(backends)) as pool:
+        plans = list(pool.map(prepare, range(len(backends))))
+        if len(backends) == 1:
+            if plans[0]:
+                puts, clones, modeFixes = plans[0]
+                finish(0, [(relPath, hashHex, mode,
+                            readFileChunks(os.path.join(
+                                srcDirPath, *relPath.split("/"))))
+                           for hashHex, (relPath, mode)
+                           in ordered(puts.items())],
+                       clones, modeFixes)
+            return
+        # every content missing anywhere is read once, in the same order
+        # for all the destinations
+        needing = {} # {hashHex: list of destination numbers}
+        for destNum, plan in enumerate(plans):
+            for hashHex in (plan[0] if plan else {}):
+                needing.setdefault(hashHex, []).append(destNum)
+        destPuts = [[] for b in backends]
+        for hashHex, (srcRelPath, destNums) in ordered(
+                (h, (plans[nums[0]][0][h][0], nums))
+                for h, nums in needing.items()):
+            contentNum = fanOut.add(srcRelPath, destNums)
+            for destNum in destNums:
+                relPath, mode = plans[destNum][0][hashHex]
+                destPuts[destNum].append(
+                    (relPath, hashHex, mode,
+                     fanOut.branch(destNum, contentNum)))
+        if len(needing):
+            logger.info(f"Reading {len(needing)} files missing in "
+                        f"destinations once for all of them")
+        finishing = [pool.submit(finish, destNum, destPuts[destNum],
+                                 plan[1], plan[2])
+                     for destNum, plan in enumerate(plans) if plan]
+        fanOut.run()
+        for f in finishing:
+            f.result()
+
+def syncToBackend(srcDirPath, backend):
+    '''Runs a sync cycle from srcDirPath(str) to backend(DestBackend), see
+    syncToBackends
+    '''
+    syncToBackends(srcDirPath, [backend])
+
+
+class SyncReceiver(object):
+    '''TCP receiver daemon, applying the requests of a sender (see
+    RemoteDestBackend) to a local dest dir through a LocalDestBackend.
+    Senders are served one at a time. There is no authentication, nor
+    encryption, so the receiver should only listen on trusted networks.
+    '''
+    # files per reply to an 'index' request
+    indexPageSize = 1000
+
+    def __init__(self, destDirPath, host, port):
+        self.backend = LocalDestBackend(destDirPath)
+        self.server = socket.create_server((host, port))
+        self.indexEntries = [] # listed by the last 'index' request
+        self.indexDirs = []
+        self.handlers = {"index": self.handleIndex,
+                         "stage": self.backend.stageFiles,
+                         "removeFiles": self.backend.removeFiles,
+                         "removeDirs": self.backend.removeDirs,
+                         "makeDirs": self.backend.makeDirs,
+                         "move": self.backend.moveFiles,
+                         "clone": self.backend.cloneFiles,
+                         "chmod": self.backend.setModes}
+
+    def serveForever(self):
+        while True:
+            conn, address = self.server.accept()
+            logger.info(f"Sender connected from {address}")
+            cycleMetrics.reset()
+            try:
+                with conn:
+                    finished = self.serveSender(conn)
+            except (OSError, ValueError) as e:
+                logger.error("Session with the sender failed", exc_info=True)
+                finished = False
+            if finished:
+                hashCache.prune()
+                syncJournal.checkpoint()
+                logger.info(f"Sync session finished, changes done: "
+                            f"{cycleMetrics}")
+            else:
+                logger.warning("Sender disconnected before finishing")
+            changeFeed.commit()
+
+    def serveSender(self, conn):
+        '''Handles the requests of a single connection, until the sender
+        closes it. Returns True, if the sender finished a sync cycle
+        '''
+        reader = conn.makefile('rb')
+        writer = conn.makefile('wb')
+        finished = False
+        while True:
+            line = reader.readline()
+            if not(line):
+                return finished
+            request = json.loads(line)
+            op = request.get("op")
+            args = request.get("args", {})
+            try:
+                if op == "put":
+                    chunks = self.readFrames(reader)
+                    try:
+                        result = self.backend.putFile(
+                            args["path"], args["hash"], args["mode"], chunks)
+                    finally:
+                        for chunk in chunks: # whatever was not consumed
+                            pass
+                elif op == "finish":
+                    self.backend.finish()
+                    finished = True
+                    result = None
+                elif op in self.handlers:
+                    result = self.handlers[op](args.get("items", args))
+                else:
+                    raise ValueError(f"Unknown request '{op}'")
+                reply = {"result": result}
+            except (KeyError, TypeError, ValueError) as e:
+                logger.error(f"Invalid request '{op}'", exc_info=True)
+                reply = {"error": str(e)}
+            except ConnectionError:
+                raise # the requests after it cannot be read any more
+            except OSError as e:
+                # e.g. permission denied, disk full: the sender gets the
+                # error, the requests it sent after this one are served
+                logger.error(f"Request '{op}' failed", exc_info=True)
+                reply = {"error": str(e)}
+            writer.write((json.dumps(reply) + "\n").encode("utf-8"))
+            writer.flush()
+
+    def readFrames(self, reader):
+        '''Yields the content frames (bytes) of a file, see
+        RemoteDestBackend
+        '''
+        while True:
+            header = reader.read(4)
+            if len(header) < 4:
+                raise ConnectionError("Connection closed inside a file")
+            frameLen = struct.unpack(">I", header)[0]
+            if frameLen == 0:
+                return
+            chunk = reader.read(frameLen)
+            if len(chunk) < frameLen:
+                raise ConnectionError("Connection closed inside a file")
+            yield chunk
+
+    def handleIndex(self, args):
+        start = args["start"]
+        if start == 0:
+            files, dirs = self.backend.fetchIndex()
+            self.indexEntries = [[relPath, hashHex, mode] for relPath,
+                                 (hashHex, mode) in files.items()]
+            self.indexDirs = sorted(dirs)
+        end = start + self.indexPageSize
+        return {"files": self.indexEntries[start:end],
+                "dirs": self.indexDirs if start == 0 else [],
+                "next": end if end < len(self.indexEntries) else None}
@@ -1,9 +1,26 @@
 # -*- coding: utf-8 -*-
 
+import bisect
+import datetime as dt
+import errno
+import fnmatch
+import json
 import logging
 import os
+import re
+import stat
+import struct
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from hashlib import sha256 as hashAlgo
-from shutil import copyfile as shutil_copyfile
+from shutil import copyfileobj as shutil_copyfileobj
+
+try:
+    import fcntl # posix only, used for reflinks (see SrcFile.cloneFile)
+except ImportError:
+    fcntl = None
 
 logger = logging.getLogger(f"main.{__name__}")
 
@@ -12,6 +29,866 @@ def userHasWritePermForDir(absPathName):
     return True
 
 
+class CycleMetrics(object):
+    '''Keeps count of the changes done in the destination directory during
+    a single sync cycle, i.e. files copied, moved or removed, mode/ownership
+    changes and so on. A single module level object (cycleMetrics) is shared
+    by the file/dir classes and the main sync loop; it is reset at the start
+    of every cycle.
+    It also keeps the replication lag of the copied files: the time from
+    the modification of a src file to the availability of its copy.
+    onChange (optional), function called with (kind, count) for every change
+        added, e.g. to report progress; it may be called by worker threads
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock() # changes may be added by worker threads
+        self.onChange = None
+        self.reset()
+
+    def reset(self):
+        self.changes = {}
+        self.throttledSeconds = 0.0 # time spent waiting for the I/O limits
+        self.lagCount = 0
+        self.lagTotal = 0.0 # seconds
+        self.maxLag = 0.0 # seconds
+
+    def addChange(self, kind, count=1):
+        '''kind, str, describing the change, e.g. 'copied' or 'moved'
+        '''
+        with self.lock:
+            self.changes[kind] = self.changes.get(kind, 0) + count
+        if self.onChange:
+            self.onChange(kind, count)
+
+    def getChangeCount(self):
+        '''Returns an int, the total number of changes done this cycle
+        '''
+        return sum(self.changes.values())
+
+    def addThrottledTime(self, seconds):
+        with self.lock:
+            self.throttledSeconds += seconds
+
+    def asDict(self):
+        '''Returns the metrics of the cycle as a dict, e.g. to be reported
+        '''
+        with self.lock:
+            return {"changes": dict(self.changes),
+                    "throttledSeconds": self.throttledSeconds,
+                    "lagCount": self.lagCount,
+                    "meanLag": self.lagTotal / self.lagCount
+                    if self.lagCount else 0.0,
+                    "maxLag": self.maxLag}
+
+    def addLag(self, mtimeNs):
+        '''Notes the replication lag of a file copied just now
+        mtimeNs, int, modification time (ns) of the src file
+        '''
+        lag = max(0.0, time.time() - mtimeNs / 1e9)
+        with self.lock:
+            self.lagCount += 1
+            self.lagTotal += lag
+            self.maxLag = max(self.maxLag, lag)
+
+    def __str__(self):
+        if not self.changes:
+            res = "no changes"
+        else:
+            res = ", ".join(f"{k}: {v}" for k, v in sorted(self.changes.items()))
+        if self.throttledSeconds:
+            res += f"; time throttled: {self.throttledSeconds:.1f} s"
+        if self.lagCount:
+            res += (f"; replication lag: mean "
+                    f"{self.lagTotal / self.lagCount:.1f} s, max "
+                    f"{self.maxLag:.1f} s ({self.lagCount} files)")
+        return res
+
+
+cycleMetrics = CycleMetrics()
+
+
+class TokenBucket(object):
+    '''Classic token bucket: tokens are added at 'rate' per second, up to
+    'rate' tokens (i.e. at most a one second burst). Consuming more tokens
+    than available makes the caller sleep until the debt is paid off.
+    rate, int/float, tokens per second; None or 0 means unlimited
+    '''
+
+    def __init__(self, rate=None):
+        self.lock = threading.Lock()
+        self.setRate(rate)
+
+    def setRate(self, rate):
+        with self.lock:
+            self.rate = rate
+            self.tokens = rate if rate else 0
+            self.last = time.monotonic()
+
+    def consume(self, amount):
+        '''Takes amount (int) tokens, sleeping if there are not enough.
+        Returns the time slept in seconds (float)
+        '''
+        with self.lock:
+            if not self.rate:
+                return 0.0
+            now = time.monotonic()
+            self.tokens = min(self.rate,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= amount
+            waitTime = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if waitTime:
+            time.sleep(waitTime)
+        return waitTime
+
+
+class IOThrottle(object):
+    '''Limits the read and write bytes per second, as well as the file
+    operations per second (hashing, copying, moving, removing files), for
+    the hashing and copying done by the sync. The limits may differ by time
+    of day window, see setWindows. A single module level object
+    (ioThrottle) is shared by all the file classes; time spent waiting is
+    added to the cycle metrics.
+    '''
+    limitKinds = ("read", "write", "ops")
+
+    def __init__(self):
+        self.windows = [] # list of tuple(startMinute, endMinute, limits)
+        self.buckets = {k: TokenBucket() for k in self.limitKinds}
+        self.activeLimits = None
+        self.lastRefresh = 0.0 # time.monotonic() of last limits refresh
+
+    def setWindows(self, windows):
+        '''windows, list of tuples (startMinute, endMinute, limits), where
+        minutes are counted from midnight, the end is exclusive and may be
+        before the start (window spanning midnight); limits is a dict of
+        {'read'/'write'/'ops': int per second}. The first matching window
+        applies; no limits apply outside all windows.
+        '''
+        self.windows = windows
+        self.activeLimits = None
+        self.refreshLimits()
+
+    def isActive(self):
+        return bool(self.windows)
+
+    def refreshLimits(self):
+        '''Picks the limits of the current time of day window
+        '''
+        self.lastRefresh = time.monotonic()
+        now = dt.datetime.now()
+        minute = now.hour * 60 + now.minute
+        limits = {}
+        for start, end, windowLimits in self.windows:
+            if (start <= minute < end) or \
+                    (end <= start and (minute >= start or minute < end)):
+                limits = windowLimits
+                break
+        if limits != self.activeLimits:
+            logger.info(f"I/O limits now in effect: {limits or 'none'}")
+            self.activeLimits = limits
+            for k in self.limitKinds:
+                self.buckets[k].setRate(limits.get(k))
+
+    def throttle(self, kind, amount=1):
+        if not self.windows:
+            return
+        # long cycles may cross into another time of day window
+        if time.monotonic() - self.lastRefresh > 60:
+            self.refreshLimits()
+        waited = self.buckets[kind].consume(amount)
+        if waited:
+            cycleMetrics.addThrottledTime(waited)
+
+    def throttleRead(self, nBytes):
+        self.throttle("read", nBytes)
+
+    def throttleWrite(self, nBytes):
+        self.throttle("write", nBytes)
+
+    def throttleOp(self):
+        self.throttle("ops")
+
+
+ioThrottle = IOThrottle()
+
+
+class HashCache(object):
+    '''Keeps the hash values of files, which have already been hashed, so
+    that unchanged files are not hashed again in the next cycles. Entries
+    are keyed by the absolute path of a file and are only considered valid
+    as long as the file size, modification time and inode number are the
+    same as when the file was hashed.
+    Entries of paths, which have not been seen during a cycle, are dropped
+    at the end of it (see prune). A single module level object (hashCache)
+    is shared by the file classes, the dest snapshot and the journal.
+    '''
+
+    def __init__(self):
+        self.entries = {} # {absPath: (statKey, hashHex)}
+        self.seen = set() # abs paths looked up/stored this cycle
+
+    def lookUp(self, absPath, statKey):
+        '''Returns the cached hash value (str) of absPath, or None if it is
+        not cached or the file has changed since it was hashed.
+        statKey, tuple(size, mtime in ns, inode), current state of the file
+        '''
+        entry = self.entries.get(absPath)
+        if entry is None or entry[0] != statKey:
+            return None
+        self.seen.add(absPath)
+        return entry[1]
+
+    def store(self, absPath, statKey, hashHex):
+        self.entries[absPath] = (tuple(statKey), hashHex)
+        self.seen.add(absPath)
+
+    def move(self, oldAbsPath, newAbsPath):
+        '''Follows a renamed file, a rename does not change the stat key
+        '''
+        entry = self.entries.pop(oldAbsPath, None)
+        if entry:
+            self.entries[newAbsPath] = entry
+            self.seen.add(newAbsPath)
+
+    def moveTree(self, oldDirAbsPath, newDirAbsPath):
+        '''Follows a renamed dir, moving the entries of all files under it
+        '''
+        prefix = os.path.join(oldDirAbsPath, "")
+        for absPath in list(self.entries):
+            if absPath.startswith(prefix):
+                self.move(absPath, os.path.join(newDirAbsPath,
+                                                absPath[len(prefix):]))
+
+    def forget(self, absPath):
+        self.entries.pop(absPath, None)
+        self.seen.discard(absPath)
+
+    def prune(self):
+        '''Drops the entries not seen since the last pruning (journaled as
+        removed); to be called at the end of a sync cycle.
+        '''
+        for absPath in set(self.entries) - self.seen:
+            del self.entries[absPath]
+            syncJournal.record("remove", path=absPath)
+        self.seen = set()
+
+
+hashCache = HashCache()
+
+
+class SubtreeDigests(object):
+    '''Merkle digests of the synced dir trees, used to skip whole subtrees,
+    which are identical in src and dest, in the dest snapshot and in the
+    syncing loop (a steady-state cycle then only lists and stats src).
+    The digest of a src dir (see digestOf) covers the names, hash values,
+    mode and ownership of its files and the names and digests of its
+    sub-dirs. After a cycle, the digest of every dest dir synced without
+    errors is stored with the dest state key: the dest dir stat key (mtime
+    in ns, inode), which changes whenever an entry is added, removed or
+    renamed in it, and a digest of the stat keys of its files (see
+    destFilesKey), which changes whenever one of them is modified in place,
+    or its mode/owner changed. A subtree is skipped, if the digest of every
+    dir in it is the stored one and the dest dirs are still in the state
+    left by the syncing, so a steady-state cycle lists and stats dest, but
+    neither hashes, nor syncs it.
+    NOTE: content changed in the replica without changing the size and
+    modification time of the file (e.g. bit rot) is not noticed, refer to
+    ReplicaScrubber for catching that.
+    A single module level object (subtreeDigests) is shared by the syncing
+    steps and the journal, which persists the digests between runs.
+    '''
+
+    def __init__(self):
+        self.entries = {} # {dest dir abs path: (digest, dir statKey)}
+        self.skipped = set() # dest abs paths of the skipped subtrees
+        self.dirty = set() # dest dir abs paths, where syncing failed
+
+    def digestOf(self, srcDir, childDigests):
+        '''Returns the digest (str) of srcDir (SrcDir), given the list of
+        tuples (name, digest) of its sub-dirs
+        '''
+        entries = [f"f\0{f.getName()}\0{f.getHash()}\0{f.mode}\0{f.uid}\0"
+                   f"{f.gid}" for f in srcDir.getContainedFiles()]
+        entries += [f"d\0{name}\0{digest}" for name, digest in childDigests]
+        hashFunc = hashAlgo()
+        for entry in sorted(entries):
+            hashFunc.update(entry.encode("utf-8", "surrogateescape") + b"\n")
+        return hashFunc.hexdigest()
+
+    def destFilesKey(self, destAbsPath):
+        '''Returns the digest (str) of the names and stat keys (size,
+        mtime in ns, inode, mode, owning user and group) of the files in the
+        dest dir at destAbsPath(str), or None if it cannot be listed
+        '''
+        entries = []
+        try:
+            with os.scandir(destAbsPath) as dirEntries:
+                for entry in dirEntries:
+                    if entry.is_dir(follow_symlinks=False):
+                        continue # covered by its own entry
+                    st = entry.stat(follow_symlinks=False)
+                    entries.append(f"{entry.name}\0{st.st_size}\0"
+                                   f"{st.st_mtime_ns}\0{st.st_ino}\0"
+                                   f"{st.st_mode}\0{st.st_uid}\0{st.st_gid}")
+        except OSError:
+            return None
+        hashFunc = hashAlgo()
+        for entry in sorted(entries):
+            hashFunc.update(entry.encode("utf-8", "surrogateescape") + b"\n")
+        return hashFunc.hexdigest()
+
+    def destPathOf(self, srcDir, destDirPath):
+        if srcDir.getNewRelPathInDest():
+            return None # not synced to its equivalent path
+        return os.path.normpath(os.path.join(destDirPath,
+                                             srcDir.getRelPath()))
+
+    def walkBottomUp(self, srcSnap):
+        '''Yields tuples (SrcDir, list of its sub-dir SrcDirs), the
+        deepest dirs first
+        '''
+        children = {}
+        for lvl in srcSnap:
+            for srcD in srcSnap[lvl]:
+                if lvl != 0:
+                    parent = os.path.dirname(srcD.getRelPath()) or "."
+                    children.setdefault(parent, []).append(srcD)
+        for lvl in sorted(srcSnap, reverse=True):
+            for srcD in srcSnap[lvl]:
+                yield (srcD, children.get(srcD.getRelPath(), []))
+
+    def findUnchanged(self, srcSnap, destDirPath):
+        '''Calculates the digests of the dirs in srcSnap (dict of {level
+        under src: list(SrcDir objects)}, hashed) and marks the ones, whose
+        subtree is identical in dest, as unchanged.
+        Returns the set of the dest abs paths of the unchanged subtrees
+        '''
+        self.skipped = set()
+        self.dirty = set()
+        for srcD, subDirs in self.walkBottomUp(srcSnap):
+            srcD.digest = self.digestOf(
+                srcD, [(d.getName(), d.digest) for d in subDirs])
+            destAbsPath = self.destPathOf(srcD, destDirPath)
+            destStatKey = srcD.destStatKey
+            if srcD.getRelPath() == "." and destAbsPath:
+                try:
+                    found = os.stat(destAbsPath)
+                    destStatKey = (found.st_mtime_ns, found.st_ino)
+                except OSError:
+                    destStatKey = None
+            # the dest files are only looked at, if all else is unchanged
+            stored = self.entries.get(destAbsPath)
+            srcD.unchanged = bool(destStatKey) and stored is not None and \
+                stored[0] == srcD.digest and \
+                all(d.unchanged for d in subDirs) and \
+                stored[1] == destStatKey + (self.destFilesKey(destAbsPath),)
+            if srcD.unchanged:
+                # sub-dirs are covered by their unchanged parent
+                self.skipped.difference_update(
+                    [self.destPathOf(d, destDirPath) for d in subDirs])
+                self.skipped.add(destAbsPath)
+        if self.skipped:
+            lg1 = f"{len(self.skipped)} subtree(s) unchanged since the last "
+            lg2 = "cycle, skipping them"
+            logger.info(lg1+lg2)
+        return self.skipped
+
+    def markDirty(self, absPath):
+        '''Marks the dir of absPath (a dest file/dir, which could not be
+        synced/removed) as not synced, so no digest is stored for it
+        '''
+        self.dirty.add(os.path.dirname(absPath))
+
+    def recordSynced(self, srcSnap, destDirPath):
+        '''Stores the digests of the dest dirs synced without errors,
+        dropping the ones of the other dest dirs; to be called at the end of
+        a cycle, after findUnchanged
+        '''
+        recorded = {}
+        clean = {}
+        for srcD, subDirs in self.walkBottomUp(srcSnap):
+            destAbsPath = self.destPathOf(srcD, destDirPath)
+            if srcD.digest is None or destAbsPath is None:
+                continue
+            clean[srcD] = destAbsPath not in self.dirty and \
+                all(clean.get(d, False) for d in subDirs)
+            if not(clean[srcD]):
+                continue
+            if srcD.unchanged:
+                recorded[destAbsPath] = self.entries[destAbsPath]
+                continue
+            try:
+                found = os.stat(destAbsPath)
+                filesKey = self.destFilesKey(destAbsPath)
+            except OSError:
+                filesKey = None
+            if filesKey is None:
+                clean[srcD] = False
+                continue
+            recorded[destAbsPath] = (srcD.digest, (found.st_mtime_ns,
+                                                   found.st_ino, filesKey))
+        self.entries = recorded
+        self.skipped = set()
+        self.dirty = set()
+
+
+subtreeDigests = SubtreeDigests()
+
+
+class SyncJournal(object):
+    '''Append-only journal (JSON lines) of the hashing and the operations
+    done in the destination during a sync cycle. At the end of every cycle
+    the changes of the subtree digests and a 'cycle-end' record are
+    appended (see checkpoint), so a steady-state cycle writes a few records
+    only. Once the journal holds compactFactor times more records than
+    there are hash cache entries and digests, it is replaced by a
+    checkpoint of those (see compact).
+    When the script is restarted, the journal is replayed into the hash
+    cache, so an interrupted cycle can be resumed: files hashed before the
+    interruption are not hashed again, and files already copied/moved are
+    recognized in their place, instead of being copied again.
+    Until a journal file is opened, recording does nothing.
+    '''
+
+    # records per hash cache entry/digest, above which the journal is
+    # compacted; and the number of records, below which it never is
+    compactFactor = 2
+    compactMin = 1000
+
+    def __init__(self):
+        self.path = None
+        self.file = None
+        self.lock = threading.Lock() # records may come from worker threads
+        self.recordCount = 0 # records in the journal file
+        self.digests = {} # subtree digests as of the last checkpoint
+
+    def open(self, path):
+        '''Replays an existing journal at path (str) and opens it for
+        appending. Returns a tuple (number of replayed records, bool telling
+        if the last recorded cycle was interrupted)
+        '''
+        self.path = path
+        replayed, interrupted = self.replay()
+        self.recordCount = replayed
+        self.digests = dict(subtreeDigests.entries)
+        self.file = open(path, 'a', encoding="utf-8", buffering=1)
+        return (replayed, interrupted)
+
+    def replay(self):
+        replayed = 0
+        interrupted = False
+        if not(os.path.isfile(self.path)):
+            return (replayed, interrupted)
+        with open(self.path, 'r', encoding="utf-8") as journalFile:
+            for line in journalFile:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    # most likely a partially written last line
+                    logger.warning(f"Skipping corrupt journal line: {line!r}")
+                    continue
+                op = rec.get("op")
+                if op in ("hash", "copy", "link"):
+                    hashCache.entries[rec["path"]] = (tuple(rec["key"]),
+                                                      rec["hash"])
+                elif op == "move":
+                    entry = hashCache.entries.pop(rec["from"], None)
+                    if entry:
+                        hashCache.entries[rec["to"]] = entry
+                elif op == "digest":
+                    subtreeDigests.entries[rec["path"]] = (rec["digest"],
+                                                           tuple(rec["key"]))
+                elif op == "remove-digest":
+                    subtreeDigests.entries.pop(rec["path"], None)
+                elif op == "cursor":
+                    cycleBudget.cursor = rec["path"]
+                    cycleBudget.startNs = rec["since"]
+                elif op == "move-dir":
+                    hashCache.moveTree(rec["from"], rec["to"])
+                elif op == "remove":
+                    hashCache.entries.pop(rec["path"], None)
+                interrupted = (op != "cycle-end")
+                replayed += 1
+        return (replayed, interrupted)
+
+    def record(self, op, **fields):
+        '''Appends a single record; op, str, e.g. 'hash', 'copy', 'move'
+        '''
+        if self.file is None:
+            return
+        fields["op"] = op
+        line = json.dumps(fields) + "\n"
+        with self.lock:
+            self.file.write(line)
+            self.recordCount += 1
+
+    def checkpoint(self):
+        '''Ends a cycle in the journal: appends the subtree digests changed
+        since the last checkpoint (the hash cache changes are journaled as
+        they happen), the cursor of the cycle budget and a 'cycle-end'
+        record, then flushes it to disk; compacts it, if it has grown too
+        long (see compact).
+        '''
+        if self.file is None:
+            return
+        for absPath, (digest, statKey) in subtreeDigests.entries.items():
+            if self.digests.get(absPath) != (digest, statKey):
+                self.record("digest", path=absPath, digest=digest,
+                            key=statKey)
+        for absPath in set(self.digests) - set(subtreeDigests.entries):
+            self.record("remove-digest", path=absPath)
+        self.digests = dict(subtreeDigests.entries)
+        if cycleBudget.isActive():
+            self.record("cursor", path=cycleBudget.cursor,
+                        since=cycleBudget.startNs)
+        self.record("cycle-end")
+        live = len(hashCache.entries) + len(self.digests)
+        if self.recordCount > max(self.compactMin, self.compactFactor * live):
+            self.compact()
+            return
+        with self.lock:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def compact(self):
+        '''Atomically replaces the journal with the current content of the
+        hash cache and the subtree digests, followed by a 'cycle-end' record.
+        '''
+        self.file.close()
+        tmpPath = self.path + ".tmp"
+        with open(tmpPath, 'w', encoding="utf-8") as checkpointFile:
+            for absPath, (statKey, hashHex) in hashCache.entries.items():
+                rec = {"path": absPath, "key": statKey, "hash": hashHex,
+                       "op": "hash"}
+                checkpointFile.write(json.dumps(rec) + "\n")
+            for absPath, (digest, statKey) in subtreeDigests.entries.items():
+                rec = {"path": absPath, "digest": digest, "key": statKey,
+                       "op": "digest"}
+                checkpointFile.write(json.dumps(rec) + "\n")
+            if cycleBudget.isActive():
+                rec = {"path": cycleBudget.cursor,
+                       "since": cycleBudget.startNs, "op": "cursor"}
+                checkpointFile.write(json.dumps(rec) + "\n")
+            checkpointFile.write(json.dumps({"op": "cycle-end"}) + "\n")
+            checkpointFile.flush()
+            os.fsync(checkpointFile.fileno())
+        os.replace(tmpPath, self.path)
+        self.recordCount = len(hashCache.entries) + \
+            len(subtreeDigests.entries) + 2 # with a cursor and cycle end
+        self.file = open(self.path, 'a', encoding="utf-8", buffering=1)
+
+
+syncJournal = SyncJournal()
+
+
+class ChangeFeed(object):
+    '''Machine-readable feed (JSON lines) of the changes done in the
+    destination, for consumers which tail it instead of rescanning the
+    replica after every cycle. The operations done during a cycle are
+    collected as they happen, and coalesced at the end of the cycle (see
+    commit) into one record per changed path, relative to the dest dir, e.g.
+        {"seq": 7, "op": "moved", "path": "b/f", "from": "a/f", "hash": ...}
+    op is one of 'created', 'moved' (from the path in "from"), 'changed'
+    (content, "oldHash" holds the previous hash value, if known),
+    'metadata' (mode/ownership) and 'deleted'; "dir": true marks dirs.
+    E.g. a file edited in src, which is renamed out of the way, copied
+    again and whose old copy is removed, comes out as a single 'changed'.
+    Every cycle ends with a 'cycle-end' record; sequence numbers go on
+    across restarts. Changes of an interrupted cycle are not fed.
+    Until a feed file is opened, recording does nothing.
+    '''
+
+    def __init__(self):
+        self.path = None
+        self.file = None
+        self.rootPath = None
+        self.seq = 0
+        self.lock = threading.Lock() # records may come from worker threads
+        self.reset()
+
+    def reset(self):
+        self.before = {} # {relPath: state at cycle start}, in touch order
+        self.after = {}  # {relPath: current state}
+        self.origin = {} # {relPath: relPath its content was moved from}
+        self.created = set() # relPaths given new content this cycle
+        self.meta = set()    # relPaths with mode/ownership changed
+
+    def open(self, path, rootPath):
+        '''Opens the feed at path (str) for appending; changes are fed
+        relative to rootPath (str), the dest dir
+        '''
+        self.path = path
+        self.rootPath = rootPath
+        self.seq = self.lastSeq()
+        self.file = open(path, 'a', encoding="utf-8")
+
+    def lastSeq(self):
+        '''Returns the sequence number of the last record in the feed file
+        '''
+        if not(os.path.isfile(self.path)):
+            return 0
+        with open(self.path, 'rb') as feedFile:
+            feedFile.seek(0, os.SEEK_END)
+            feedFile.seek(max(0, feedFile.tell() - 65536))
+            lines = feedFile.read().splitlines()
+        for line in reversed(lines):
+            try:
+                return int(json.loads(line)["seq"])
+            except (ValueError, KeyError, TypeError):
+                # e.g. a partially written last line
+                continue
+        return 0
+
+    def record(self, op, absPath, hashHex=None, fromAbsPath=None,
+               isDir=False):
+        '''Notes a single operation done in dest
+        op, str, 'created', 'moved' (from fromAbsPath), 'deleted',
+            'metadata', or 'existing' (absPath is about to be overwritten)
+        hashHex (optional), str, hash value of the content concerned
+        '''
+        if self.file is None:
+            return
+        relPath = os.path.relpath(absPath, self.rootPath)
+        if relPath == os.pardir or relPath.startswith(os.pardir + os.sep):
+            return # another dest, see syncToBackends
+        state = ("dir" if isDir else "file", hashHex)
+        with self.lock:
+            if op == "created":
+                self.before.setdefault(relPath, None)
+                self.after[relPath] = state
+                self.origin.pop(relPath, None)
+                self.created.add(relPath)
+            elif op == "existing":
+                self.before.setdefault(relPath, state)
+            elif op == "deleted":
+                self.before.setdefault(relPath, state)
+                self.after[relPath] = None
+            elif op == "metadata":
+                self.before.setdefault(relPath, state)
+                self.meta.add(relPath)
+            elif op == "moved":
+                fromRelPath = os.path.relpath(fromAbsPath, self.rootPath)
+                self.before.setdefault(fromRelPath, state)
+                self.before.setdefault(relPath, None)
+                current = self.after.get(fromRelPath,
+                                         self.before[fromRelPath])
+                if current is not None and current[1] is None:
+                    current = (current[0], hashHex)
+                self.after[relPath] = current
+                self.after[fromRelPath] = None
+                if fromRelPath in self.created:
+                    self.created.discard(fromRelPath)
+                    self.created.add(relPath)
+                    self.origin.pop(relPath, None)
+                else:
+                    self.created.discard(relPath)
+                    self.origin[relPath] = self.origin.pop(fromRelPath,
+                                                           fromRelPath)
+
+    def coalesce(self):
+        '''Returns the list of records (dicts, without sequence numbers)
+        for the net changes of the cycle
+        '''
+        final = lambda p: self.after.get(p, self.before.get(p))
+        # paths, which appeared and disappeared again within the cycle (e.g.
+        # staged files), and whatever was under such dirs
+        transient = {p for p in self.before
+                     if self.before[p] is None and final(p) is None}
+        def isTransient(relPath):
+            while relPath:
+                if relPath in transient:
+                    return True
+                relPath = os.path.dirname(relPath)
+            return False
+        # content moved from a path, which is gone by the end of the cycle
+        movedFrom = {}
+        for relPath, fromRelPath in self.origin.items():
+            if self.before.get(relPath) is None and \
+                    self.before.get(fromRelPath) is not None and \
+                    final(fromRelPath) is None and \
+                    final(relPath) is not None and \
+                    fromRelPath not in movedFrom.values():
+                movedFrom[relPath] = fromRelPath
+        consumed = set(movedFrom.values())
+        records = []
+        for relPath, start in self.before.items():
+            end = final(relPath)
+            if isTransient(relPath) or relPath in consumed:
+                continue
+            if start is None and end is None:
+                continue
+            rec = {"path": relPath}
+            if start is None:
+                if relPath in movedFrom:
+                    rec.update(op="moved", **{"from": movedFrom[relPath]})
+                else:
+                    rec["op"] = "created"
+            elif end is None:
+                rec["op"] = "deleted"
+            elif start[0] != end[0]:
+                # a file replaced by a dir, or the other way round
+                records.append({"op": "deleted", "path": relPath,
+                                "hash": start[1], "dir": start[0] == "dir"})
+                rec["op"] = "created"
+            elif (relPath in self.created or
+                  self.origin.get(relPath, relPath) != relPath) and \
+                    not(start[1] and start[1] == end[1]):
+                rec.update(op="changed", oldHash=start[1])
+            elif relPath in self.meta:
+                rec["op"] = "metadata"
+            else:
+                continue
+            state = end or start
+            if state[0] == "dir":
+                rec["dir"] = True
+            else:
+                rec["hash"] = state[1]
+            records.append(dict(op=rec.pop("op"), **rec))
+        return records
+
+    def commit(self):
+        '''Appends the coalesced changes of the cycle, followed by a
+        'cycle-end' record, to the feed in a single buffered write; to be
+        called at the end of every cycle
+        '''
+        if self.file is None:
+            return
+        with self.lock:
+            records = self.coalesce()
+            self.reset()
+        records.append({"op": "cycle-end", "changes": len(records),
+                        "time": dt.datetime.now().isoformat()})
+        lines = []
+        for rec in records:
+            self.seq += 1
+            lines.append(json.dumps(dict(seq=self.seq, **rec)) + "\n")
+        self.file.write("".join(lines))
+        self.file.flush()
+
+
+changeFeed = ChangeFeed()
+
+
+def relToDirFd(absPath, dirFd):
+    '''Returns the path argument for an os call done with dir_fd=dirFd:
+    the name of absPath(str), if dirFd(int) is an open fd of its parent
+    directory, otherwise absPath itself (dirFd is None)
+    '''
+    if dirFd is None:
+        return absPath
+    return os.path.basename(absPath)
+
+def pathExistsAt(absPath, dirFd=None):
+    '''Same as os.path.lexists, relative to dirFd if that is given
+    (see relToDirFd)
+    '''
+    try:
+        os.stat(relToDirFd(absPath, dirFd), dir_fd=dirFd,
+                follow_symlinks=False)
+        return True
+    except (OSError, ValueError):
+        return False
+
+def openAt(absPath, dirFd=None, mode='rb'):
+    '''Opens a file in binary mode ('rb' or 'wb'), relative to dirFd if
+    that is given (see relToDirFd). Returns a file object.
+    '''
+    flags = getattr(os, "O_BINARY", 0)
+    if mode == 'wb':
+        flags |= os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+    else:
+        flags |= os.O_RDONLY
+    fd = os.open(relToDirFd(absPath, dirFd), flags, 0o666, dir_fd=dirFd)
+    return open(fd, mode)
+
+def untrackDestFile(absPath, hashHex, destFiles):
+    '''Stops tracking the dest file at absPath(str) with hash hashHex(str)
+    in destFiles, dict of {hashValue:list(tuples(fileAbsPath, File object))};
+    a hash value without any files left is removed from the dict.
+    '''
+    for t in destFiles.get(hashHex, []):
+        if t[0] == absPath:
+            destFiles[hashHex].remove(t)
+            logger.debug(f"Stopped tracking of '{absPath}'")
+            break
+    if hashHex in destFiles and not(destFiles[hashHex]):
+        destFiles.pop(hashHex)
+
+
+class DirNode(object):
+    '''A directory, as a node of a tree of interned nodes (see PathNodes).
+    Its normalized abs path is put together once, when the node is created;
+    a file is then referred to by the node of its parent dir and its name,
+    and the abs path of the file is only put together when it is needed
+    (see filePath), without os.path.join/normpath for every file.
+    absPath, str, normalized absolute path of the directory
+    parent (optional), DirNode of the parent directory, None for a root
+    name (optional), str, name of the directory inside its parent
+    '''
+    __slots__ = ("parent", "name", "absPath", "prefix", "children")
+
+    def __init__(self, absPath, parent=None, name=""):
+        self.parent = parent
+        self.name = name
+        self.absPath = absPath
+        # what the names in the dir are appended to
+        self.prefix = absPath if absPath.endswith(os.sep) else absPath + os.sep
+        self.children = {} # name: DirNode, of the sub-dirs looked up so far
+
+    def child(self, name):
+        '''Returns the (interned) DirNode of the sub-dir name(str)
+        '''
+        node = self.children.get(name)
+        if node is None:
+            node = DirNode(self.prefix + name, self, name)
+            self.children[name] = node
+        return node
+
+    def descend(self, relPath):
+        '''Returns the DirNode of the dir at relPath(str, as in
+        SrcDir.getRelPath, i.e. '.' for self) under self
+        '''
+        node = self
+        for name in relPath.split(os.sep):
+            if name and name != ".":
+                node = node.child(name)
+        return node
+
+    def filePath(self, name):
+        '''Returns the abs path (str) of the file name(str) inside self
+        '''
+        return self.prefix + name
+
+
+class PathNodes(object):
+    '''Interns the DirNodes of the src and dest dirs, so that the sync hot
+    loop puts together a single string per file (see DirNode.filePath),
+    instead of joining and normalizing the whole path again for every file
+    and every step. Nodes are dropped at the start of every sync cycle (see
+    reset), as the dirs may have changed in between.
+    '''
+
+    def __init__(self):
+        self.roots = {} # abs path, as given: DirNode of the main src/dest dir
+
+    def reset(self):
+        self.roots = {}
+
+    def dirOf(self, rootPath, relPath="."):
+        '''Returns the DirNode of the dir at relPath(str, see DirNode.descend)
+        under the main src/dest dir at rootPath(str, abs path)
+        '''
+        root = self.roots.get(rootPath)
+        if root is None:
+            root = DirNode(os.path.normpath(rootPath))
+            self.roots[rootPath] = root
+        return root.descend(relPath)
+
+pathNodes = PathNodes()
+
+
 class BaseFile(object):
     '''This class (under-)defines a file object. It is not aware where it is
     in a file system, so location must always be kept in mind. Typically, it
@@ -23,44 +900,125 @@ class BaseFile(object):
     Those can be refreshed at a later time by specifying the file location.
     pathName, str, this is a path to the file described in this class
     '''
+    # size of the chunks read when hashing/copying file content
+    readChunkSize = 1024 ** 2
+    # whether files and dirs are accessed relative to open dir fds (posix),
+    # rather than by re-resolving absolute paths for every operation
+    useDirFds = all(f in os.supports_dir_fd for f in (os.open, os.stat,
+        os.mkdir, os.rename, os.unlink, os.link, os.chmod)) and \
+        os.scandir in os.supports_fd
     
-    def __init__(self, pathName):
+    def __init__(self, pathName, dirFd=None, statResult=None):
         # pathName is an absolute path to a file
+        # dirFd, optional, open fd of the parent dir, see refreshAttributes
+        # statResult, optional, os.stat_result of the file, if already known
         directory, name = os.path.split(pathName)
         self.name = name # file name, not a path
         self.mode = 0 # mode/permission bits, int?
         self.uid = 0 # owning user id
         self.gid = 0 # owner group id
         self.size = 0 # size in bytes
-        self.refreshAttributes(directory)
+        self.mtimeNs = 0 # modification time in ns
+        self.inode = 0 # inode number
+        self.device = 0 # id of the device containing the file
+        self.nlink = 1 # number of hard links
+        self.blocks = None # 512-byte blocks allocated, None if unknown
+        self.refreshAttributes(directory, dirFd, statResult)
         self.hashHex = "" # only set for SrcFile and DestFile objects
 
-    def refreshAttributes(self, fileLocationPath):
+    def refreshAttributes(self, fileLocationPath, dirFd=None, updated=None):
         """Refreshes the attributes of self (currently unused)
         fileLocationPath, str, an absolute path to the parent dir of self
+        dirFd (optional), int, open fd of the same dir; if given, self is
+            stat-ed relative to it, by name only
+        updated (optional), os.stat_result of self, e.g. from os.scandir,
+            used instead of stat-ing again
         """
-        updated = os.stat(os.path.join(fileLocationPath, self.name))
+        if updated is None:
+            if dirFd is None:
+                updated = os.stat(os.path.join(fileLocationPath, self.name))
+            else:
+                updated = os.stat(self.name, dir_fd=dirFd)
         self.mode = updated.st_mode
         self.uid = updated.st_uid
         self.gid = updated.st_gid
         self.size = updated.st_size
+        self.mtimeNs = updated.st_mtime_ns
+        self.inode = updated.st_ino
+        self.device = updated.st_dev
+        self.nlink = updated.st_nlink
+        self.blocks = getattr(updated, "st_blocks", None) # posix only
 
-    def calculateHash(self, fileLocationPath):
+    def calculateHash(self, fileLocationPath, dirFd=None):
         '''Calculates hash of file content using the imported hashlib algorithm
         Note: chosen algorithm should only do hashing based on byte stream
         fileLocationPath, str, an absolute path to the parent dir of self
+        dirFd (optional), int, open fd of the same dir, see refreshAttributes
         '''
         hashFunc = hashAlgo()
         logger.debug(f"About to hash '{self.name}' using {hashFunc.name}")
         f = os.path.join(fileLocationPath, self.name)
-        with open(f, 'rb') as file:
+        ioThrottle.throttleOp()
+        with openAt(f, dirFd) as file:
             while True:
-                chunk = file.read(hashFunc.block_size)
+                chunk = file.read(self.readChunkSize)
                 if not chunk:
                     break
+                ioThrottle.throttleRead(len(chunk))
+                cycleBudget.noteRead(len(chunk))
                 hashFunc.update(chunk)
         return hashFunc.hexdigest()
 
+    def getOrCalculateHash(self, fileLocationPath, dirFd=None,
+                           checkStable=False):
+        '''Same as calculateHash, however the hash cache is checked first,
+        and a newly calculated hash is stored in the cache and journaled.
+        fileLocationPath, str, an absolute path to the parent dir of self
+        dirFd (optional), int, open fd of the same dir, see refreshAttributes
+        checkStable (optional), bool, if True, self is stat-ed again after
+            hashing, and None is returned (nothing cached), if it was
+            modified in the meantime
+        '''
+        absPath = os.path.join(fileLocationPath, self.name)
+        statKey = self.getStatKey()
+        hashHex = hashCache.lookUp(absPath, statKey)
+        if hashHex is None:
+            hashHex = self.calculateHash(fileLocationPath, dirFd)
+            if checkStable:
+                after = os.stat(relToDirFd(absPath, dirFd), dir_fd=dirFd)
+                if (after.st_size, after.st_mtime_ns, after.st_ino) != statKey:
+                    lg1 = f"'{absPath}' was modified while being hashed"
+                    logger.info(lg1)
+                    return None
+            hashCache.store(absPath, statKey, hashHex)
+            syncJournal.record("hash", path=absPath, key=statKey,
+                               hash=hashHex)
+        else:
+            logger.debug(f"Hash of '{self.name}' taken from the cache")
+        return hashHex
+
+    def getLinkKey(self):
+        '''Returns tuple of device and inode, shared by the hard links of
+        a file, or None if the file has no other hard links
+        '''
+        if self.nlink > 1:
+            return (self.device, self.inode)
+        return None
+
+    def isSparse(self):
+        '''Returns True if less space is allocated for the file than its
+        size and its holes can be found (SEEK_DATA/SEEK_HOLE are supported)
+        '''
+        if self.blocks is None or not(hasattr(os, "SEEK_DATA")):
+            return False
+        return self.blocks * 512 < self.size
+
+    def getStatKey(self):
+        '''Returns tuple of the file size, modification time (ns) and inode,
+        used to tell if a file has changed since it was last hashed
+        '''
+        return (self.size, self.mtimeNs, self.inode) # tuple(int, int, int)
+
     def getHash(self):
         '''Returns a str, the hash value of a file byte content, maybe empty.
         '''
@@ -98,37 +1056,401 @@ class BaseFile(object):
 class SrcFile(BaseFile):
     '''Used to define a file residing in the source directory.
     '''
+    # copies are written to a temp file next to the target, then renamed
+    tempSuffix = ".syncipy-tmp"
+    # files of at least this size (bytes) are copied as byte ranges, by
+    # rangeCopyWorkers threads (see copyContentRanges); None disables it
+    rangeCopyThreshold = 256 * 1024 ** 2
+    rangeCopyWorkers = 4
+    rangeSize = 64 * 1024 ** 2 # max bytes copied by a worker at a time
+    # content already in dest is copied from there (see cloneFile) by
+    # 'reflink' (or an in-kernel copy), by 'link' (hard link), or 'none'
+    cloneMode = "reflink"
+    ficlone = 0x40049409 # FICLONE ioctl request (linux)
     
-    def __init__(self, pathName):
-        BaseFile.__init__(self, pathName)
+    def __init__(self, pathName, dirFd=None, statResult=None, hashNow=True):
+        # hashNow, if False, the file is hashed later on, see hashFile
+        BaseFile.__init__(self, pathName, dirFd, statResult)
         # self.absName = pathName
-        self.hashHex = self.calculateHash(os.path.split(pathName)[0])
+        self.unstable = False # being written, see FileStability
+        self.postponed = False # left for a later cycle, see CycleBudget
+        self.location = None # on the storage, see StorageProfile.locate
+        if hashNow:
+            self.hashFile(os.path.split(pathName)[0], dirFd)
+
+    def hashFile(self, fileLocationPath, dirFd=None):
+        '''Sets the hash value of self, refer to getOrCalculateHash. A file
+        modified too recently, or while being hashed, is marked as unstable
+        instead (with an empty hash value), see FileStability
+        '''
+        if fileStability.isTooRecent(self.mtimeNs):
+            logger.debug(f"'{self.name}' was modified too recently")
+            self.unstable = True
+            return
+        hashHex = self.getOrCalculateHash(fileLocationPath, dirFd,
+                                          checkStable=True)
+        self.unstable = hashHex is None
+        self.hashHex = hashHex or ""
+
+    @classmethod
+    def tempPathFor(cls, absPath):
+        '''Returns the temp path (str) used while copying to absPath
+        '''
+        directory, name = os.path.split(absPath)
+        return os.path.join(directory, "." + name + cls.tempSuffix)
+
+    @classmethod
+    def isTempName(cls, name):
+        '''Returns True, if name (str) has the form of the temp file names
+        (see tempPathFor), i.e. a file left over by an interrupted copy
+        '''
+        return name.startswith(".") and name.endswith(cls.tempSuffix) and \
+            len(name) > len(cls.tempSuffix) + 1
 
-    def cpFile(self, curAbsP, newAbsP):
+    def cpFile(self, curAbsP, newAbsP, srcDirFd=None, destDirFd=None):
         '''Tries to copy the file from curAbsP(str) to newAbsP(str), both
-        absolute paths
+        absolute paths. The copy is written to a temp file, which is flushed
+        to disk and then renamed to newAbsP, so newAbsP never holds a
+        partially copied file.
+        srcDirFd/destDirFd (optional), int, open fds of the parent dirs of
+            curAbsP/newAbsP, see relToDirFd
         Returns True on success
         '''
+        tmpAbsP = self.tempPathFor(newAbsP)
+        newName = relToDirFd(newAbsP, destDirFd)
+        tmpName = relToDirFd(tmpAbsP, destDirFd)
         try:
-            shutil_copyfile(curAbsP, newAbsP)
+            ioThrottle.throttleOp()
+            with openAt(curAbsP, srcDirFd) as srcF, \
+                    openAt(tmpAbsP, destDirFd, 'wb') as destF:
+                if self.isSparse():
+                    self.copyContentSparse(srcF, destF)
+                elif ioThrottle.isActive():
+                    self.copyContentThrottled(srcF, destF)
+                elif self.isForRangeCopy():
+                    self.copyContentRanges(srcF, destF)
+                else:
+                    self.copyContentFast(srcF, destF)
+                destF.flush()
+                os.fsync(destF.fileno())
+            os.replace(tmpName, newName,
+                       src_dir_fd=destDirFd, dst_dir_fd=destDirFd)
             logger.info(f"File copied: '{curAbsP}' -> '{newAbsP}'")
+            cycleMetrics.addChange("copied")
+            copied = os.stat(newName, dir_fd=destDirFd)
+            statKey = (copied.st_size, copied.st_mtime_ns, copied.st_ino)
+            hashCache.store(newAbsP, statKey, self.hashHex)
+            syncJournal.record("copy", src=curAbsP, path=newAbsP,
+                               key=statKey, hash=self.hashHex)
+            changeFeed.record("created", newAbsP, self.hashHex)
             return True
         except Exception as e:
             logger.error(f"Could NOT copy: '{curAbsP}' -> '{newAbsP}'",
                          exc_info=True)
+            try:
+                os.remove(tmpName, dir_fd=destDirFd)
+            except OSError:
+                pass
             return False
 
-    def chmodChownFile(self, absPath):
+    def cloneFile(self, fromAbsP, newAbsP, destDirFd=None):
+        '''Copies the dest file at fromAbsP(str), already holding the content
+        of self, to newAbsP(str), within the dest, so that the src file is
+        not read again: as a hard link with cloneMode 'link' (if mode and
+        owner of fromAbsP match self), otherwise as a reflink (extents
+        shared, where the file system supports it), or else by an in-kernel
+        copy. Like a copy, the clone is written to a temp file first.
+        destDirFd (optional), int, open fd of the parent dir of newAbsP
+        Returns True on success
+        '''
+        tmpAbsP = self.tempPathFor(newAbsP)
+        newName = relToDirFd(newAbsP, destDirFd)
+        tmpName = relToDirFd(tmpAbsP, destDirFd)
+        try:
+            ioThrottle.throttleOp()
+            found = os.stat(fromAbsP)
+            if self.cloneMode == "link" and (found.st_mode, found.st_uid,
+                    found.st_gid) == (self.mode, self.uid, self.gid):
+                os.link(fromAbsP, tmpName, dst_dir_fd=destDirFd)
+                how = "linked"
+            else:
+                with open(fromAbsP, 'rb') as fromF, \
+                        openAt(tmpAbsP, destDirFd, 'wb') as destF:
+                    self.copyContentClone(fromF, destF)
+                    destF.flush()
+                    os.fsync(destF.fileno())
+                how = "cloned"
+            os.replace(tmpName, newName,
+                       src_dir_fd=destDirFd, dst_dir_fd=destDirFd)
+            logger.info(f"File {how} within dest: '{fromAbsP}' -> '{newAbsP}'")
+            cycleMetrics.addChange(how)
+            cloned = os.stat(newName, dir_fd=destDirFd)
+            statKey = (cloned.st_size, cloned.st_mtime_ns, cloned.st_ino)
+            hashCache.store(newAbsP, statKey, self.hashHex)
+            syncJournal.record("copy", src=fromAbsP, path=newAbsP,
+                               key=statKey, hash=self.hashHex)
+            changeFeed.record("created", newAbsP, self.hashHex)
+            return True
+        except Exception as e:
+            logger.error(f"Could NOT clone: '{fromAbsP}' -> '{newAbsP}'",
+                         exc_info=True)
+            try:
+                os.remove(tmpName, dir_fd=destDirFd)
+            except OSError:
+                pass
+            return False
+
+    def copyContentClone(self, fromF, destF):
+        '''Copies the content of fromF to destF (binary file objects, both
+        in dest) as a reflink, where supported, otherwise as a copy
+        '''
+        if fcntl is not None and sys.platform.startswith("linux"):
+            try:
+                fcntl.ioctl(destF.fileno(), self.ficlone, fromF.fileno())
+                return
+            except OSError:
+                pass # e.g. not supported by the file system
+        if ioThrottle.isActive():
+            self.copyContentThrottled(fromF, destF)
+        else:
+            self.copyContentFast(fromF, destF)
+
+    def copyContentFast(self, srcF, destF):
+        '''Copies the content of srcF to destF (binary file objects), inside
+        the kernel where possible (os.copy_file_range, then os.sendfile),
+        otherwise by reading and writing chunks.
+        '''
+        srcFd, destFd = srcF.fileno(), destF.fileno()
+        kernelCopies = []
+        if hasattr(os, "copy_file_range"):
+            kernelCopies.append(lambda n: os.copy_file_range(srcFd, destFd, n))
+        if hasattr(os, "sendfile") and sys.platform.startswith("linux"):
+            kernelCopies.append(lambda n: os.sendfile(destFd, srcFd, None, n))
+        for kernelCopy in kernelCopies:
+            try:
+                # both file positions are advanced by the copied bytes, so
+                # a failing method can be followed by the next one
+                while kernelCopy(8 * self.readChunkSize):
+                    pass
+                return
+            except OSError:
+                continue
+        shutil_copyfileobj(srcF, destF, self.readChunkSize)
+
+    def isForRangeCopy(self):
+        '''Returns True, if self is to be copied by copyContentRanges
+        '''
+        return self.rangeCopyThreshold is not None and \
+            self.rangeCopyWorkers > 1 and \
+            self.size >= self.rangeCopyThreshold and hasattr(os, "pwrite")
+
+    def copyContentRanges(self, srcF, destF):
+        '''Copies the content of srcF to destF (binary file objects) as
+        byte ranges of rangeSize, by rangeCopyWorkers concurrent threads, so
+        that the parallelism of fast storage (NVMe, RAID) can be used for a
+        single large file. destF is preallocated to the size of srcF first.
+        '''
+        srcFd, destFd = srcF.fileno(), destF.fileno()
+        size = os.fstat(srcFd).st_size
+        try:
+            os.posix_fallocate(destFd, 0, size)
+        except (AttributeError, OSError):
+            # not supported by the platform / file system
+            os.ftruncate(destFd, size)
+        # every worker gets at least one range, also below rangeSize
+        step = max(1, min(self.rangeSize, -(-size // self.rangeCopyWorkers)))
+        ranges = [(offset, min(step, size - offset))
+                  for offset in range(0, size, step)]
+        with ThreadPoolExecutor(max_workers=self.rangeCopyWorkers) as pool:
+            # list() re-raises the first failure of a worker, if any
+            list(pool.map(lambda r: self.copyRange(srcFd, destFd, *r),
+                          ranges))
+        lg1 = f"Copied {size} bytes as {len(ranges)} ranges by "
+        logger.debug(lg1 + f"{self.rangeCopyWorkers} workers")
+
+    def copyRange(self, srcFd, destFd, offset, length):
+        '''Copies length bytes at offset from srcFd to the same offset of
+        destFd, inside the kernel where possible (os.copy_file_range),
+        otherwise with os.pread/os.pwrite. The file positions of the fds
+        are not used, so several ranges can be copied at once.
+        '''
+        end = offset + length
+        if hasattr(os, "copy_file_range"):
+            try:
+                while offset < end:
+                    copied = os.copy_file_range(srcFd, destFd, end - offset,
+                                                offset, offset)
+                    if not(copied):
+                        break
+                    offset += copied
+            except OSError:
+                pass # e.g. not supported across these file systems
+        while offset < end:
+            chunk = os.pread(srcFd, min(self.readChunkSize, end - offset),
+                             offset)
+            if not(chunk):
+                break
+            view = memoryview(chunk)
+            while view:
+                written = os.pwrite(destFd, view, offset)
+                view = view[written:]
+                offset += written
+        if offset < end:
+            raise OSError(f"Source file shrank while being copied, "
+                          f"{end - offset} bytes missing at {offset}")
+
+    def copyContentThrottled(self, srcF, destF):
+        '''Copies the content of srcF to destF (binary file objects) chunk
+        by chunk, keeping the read and write rates within the I/O limits
+        '''
+        while True:
+            chunk = srcF.read(self.readChunkSize)
+            if not chunk:
+                break
+            ioThrottle.throttleRead(len(chunk))
+            ioThrottle.throttleWrite(len(chunk))
+            destF.write(chunk)
+
+    def copyContentSparse(self, srcF, destF):
+        '''Copies only the data regions of srcF to destF (binary file
+        objects), found with SEEK_DATA/SEEK_HOLE, so that the holes are
+        preserved in the copy. Keeps the read and write rates within the
+        I/O limits.
+        '''
+        srcFd = srcF.fileno()
+        offset = 0
+        while True:
+            try:
+                dataStart = os.lseek(srcFd, offset, os.SEEK_DATA)
+            except OSError:
+                break # ENXIO, no more data after offset
+            dataEnd = os.lseek(srcFd, dataStart, os.SEEK_HOLE)
+            srcF.seek(dataStart)
+            destF.seek(dataStart)
+            remaining = dataEnd - dataStart
+            while remaining > 0:
+                chunk = srcF.read(min(self.readChunkSize, remaining))
+                if not chunk:
+                    break
+                ioThrottle.throttleRead(len(chunk))
+                ioThrottle.throttleWrite(len(chunk))
+                destF.write(chunk)
+                remaining -= len(chunk)
+            offset = dataEnd
+        # trailing hole, if any
+        destF.truncate(os.fstat(srcFd).st_size)
+        logger.debug("Sparse file copied preserving holes")
+
+    def linkFile(self, linkedAbsP, newAbsP, destFiles, destDirFd=None):
+        '''Replicates a hard link of the source: newAbsP(str) is made a
+        hard link to linkedAbsP(str), a dest file already synced from another
+        source path sharing the same inode as self. A file already at newAbsP
+        is left as is, if it is the same file, otherwise it is replaced
+        (and it stops being tracked in destFiles, the dict of files found in
+        the dest dir). Non-file objects at newAbsP are not replaced.
+        destDirFd (optional), int, open fd of the parent dir of newAbsP
+        Returns newAbsP on success, None otherwise
+        '''
+        newName = relToDirFd(newAbsP, destDirFd)
+        tmpAbsP = self.tempPathFor(newAbsP)
+        tmpName = relToDirFd(tmpAbsP, destDirFd)
+        try:
+            found = os.stat(newName, dir_fd=destDirFd, follow_symlinks=False)
+        except OSError:
+            found = None # nothing there (or not reachable, see below)
+        try:
+            if found is not None and not(stat.S_ISREG(found.st_mode)):
+                logger.debug(f"Cannot replace '{newAbsP}' with a hard link")
+                return None
+            elif found is not None:
+                # hashed by the dest snapshot already, see HashCache
+                occupying = DestFile(newAbsP, destDirFd, found)
+                untrackDestFile(newAbsP, occupying.getHash(), destFiles)
+                linked = os.stat(linkedAbsP)
+                if (linked.st_dev, linked.st_ino) == \
+                        (found.st_dev, found.st_ino):
+                    logger.debug(f"Hard link already in place: '{newAbsP}'")
+                    return newAbsP
+            ioThrottle.throttleOp()
+            os.link(linkedAbsP, tmpName, dst_dir_fd=destDirFd)
+            os.replace(tmpName, newName,
+                       src_dir_fd=destDirFd, dst_dir_fd=destDirFd)
+            logger.info(f"Hard LINKED file: '{linkedAbsP}' -> '{newAbsP}'")
+            cycleMetrics.addChange("linked")
+            linked = os.stat(newName, dir_fd=destDirFd)
+            statKey = (linked.st_size, linked.st_mtime_ns, linked.st_ino)
+            hashCache.store(newAbsP, statKey, self.hashHex)
+            syncJournal.record("link", src=linkedAbsP, path=newAbsP,
+                               key=statKey, hash=self.hashHex)
+            changeFeed.record("created", newAbsP, self.hashHex)
+            return newAbsP
+        except Exception as e:
+            logger.error(f"Could NOT link: '{linkedAbsP}' -> '{newAbsP}'",
+                         exc_info=True)
+            try:
+                os.remove(tmpName, dir_fd=destDirFd)
+            except OSError:
+                pass
+            return None
+
+    def unshareLink(self, absPath, dirFd=None):
+        '''Gives the dest file at absPath(str), holding the content of self,
+        an inode of its own, if it still shares one with other dest paths
+        (e.g. hard linked by cloneMode 'link'), while self has no other hard
+        links. Otherwise, a mode or owner change of absPath would change
+        those other paths too. The content is cloned to a temp file, which
+        then replaces absPath.
+        dirFd (optional), int, open fd of the parent dir of absPath
+        Returns the os.stat_result of the file at absPath
+        '''
+        name = relToDirFd(absPath, dirFd)
+        found = os.stat(name, dir_fd=dirFd)
+        if found.st_nlink < 2 or self.getLinkKey() is not None:
+            return found
+        tmpAbsP = self.tempPathFor(absPath)
+        tmpName = relToDirFd(tmpAbsP, dirFd)
+        try:
+            ioThrottle.throttleOp()
+            with openAt(absPath, dirFd) as fromF, \
+                    openAt(tmpAbsP, dirFd, 'wb') as destF:
+                self.copyContentClone(fromF, destF)
+                destF.flush()
+                os.fsync(destF.fileno())
+            os.replace(tmpName, name, src_dir_fd=dirFd, dst_dir_fd=dirFd)
+            logger.info(f"Hard link of '{absPath}' replaced by its own copy")
+            cycleMetrics.addChange("cloned")
+            unshared = os.stat(name, dir_fd=dirFd)
+            statKey = (unshared.st_size, unshared.st_mtime_ns,
+                       unshared.st_ino)
+            hashCache.store(absPath, statKey, self.hashHex)
+            syncJournal.record("copy", src=absPath, path=absPath,
+                               key=statKey, hash=self.hashHex)
+            return unshared
+        except Exception as e:
+            logger.error(f"Could NOT unshare the hard link of '{absPath}'",
+                         exc_info=True)
+            try:
+                os.remove(tmpName, dir_fd=dirFd)
+            except OSError:
+                pass
+            return found
+
+    def chmodChownFile(self, absPath, dirFd=None):
         '''Tries to change the mode and ownership of a some file with path
         specified by absPath(str), so that they match those of the self file.
+        dirFd (optional), int, open fd of the parent dir of absPath
         '''            
+        name = relToDirFd(absPath, dirFd)
         # current mode, userid, grpid, of the replicated file
-        fileStat = os.stat(absPath)
+        fileStat = os.stat(name, dir_fd=dirFd)
+        # new mode, userid, grpid of an original source file
+        newMode, newUserID, newGrpID = self.getModeAndOwnership()
+        if fileStat.st_nlink > 1 and (fileStat.st_mode, fileStat.st_uid,
+                fileStat.st_gid) != (newMode, newUserID, newGrpID):
+            fileStat = self.unshareLink(absPath, dirFd)
         curMode = fileStat.st_mode
         curUserID = fileStat.st_uid
         curGrpID = fileStat.st_gid
-        # new mode, userid, grpid of an original source file
-        newMode, newUserID, newGrpID = self.getModeAndOwnership()
         
         lg1 = f"Looking into file {absPath}, mode={curMode}, "
         lg2 = f"owning user: {curUserID}, userGrp={curGrpID} for potential "
@@ -137,8 +1459,10 @@ class SrcFile(BaseFile):
         # then chmod
         if curMode != newMode:
             try:
-                os.chmod(absPath, newMode)
+                os.chmod(name, newMode, dir_fd=dirFd)
                 logger.debug("  MODE changed")
+                cycleMetrics.addChange("mode changed")
+                changeFeed.record("metadata", absPath)
             except Exception as e:
                 logger.debug(f"  FAILED mode change, '{absPath}'",
                                 exc_info=True)
@@ -148,27 +1472,49 @@ class SrcFile(BaseFile):
         # then chown
         if (curUserID, curGrpID) != (newUserID, newGrpID):
             try:
-                os.chown(absPath, newUserID, newGrpID)
+                os.chown(name, newUserID, newGrpID, dir_fd=dirFd)
                 logger.debug("  OWNER changed")
+                cycleMetrics.addChange("owner changed")
+                changeFeed.record("metadata", absPath)
             except Exception as e:
                 logger.debug(f"  FAILED ownership change, '{absPath}'",
                                 exc_info=True)
         else:
             logger.debug("No need for ownership change")
 
-    def wrapCpChmodChown(self, currentAbsP, newAbsP):
+    def wrapCpChmodChown(self, currentAbsP, newAbsP,
+                         srcDirFd=None, destDirFd=None):
         '''Combines copy, chmod and chown.
         currentAbsP, str, absolute path of file in source dir
         newAbsPath, str, target path (absolute) of file in replica
+        srcDirFd/destDirFd (optional), int, open fds of the parent dirs of
+            currentAbsP/newAbsP, see relToDirFd
+        Returns newAbsP, if the copy succeeded, None otherwise
+        '''
+        if self.cpFile(currentAbsP, newAbsP, srcDirFd, destDirFd):
+            self.chmodChownFile(newAbsP, destDirFd)
+            cycleMetrics.addLag(self.mtimeNs)
+            cycleBudget.noteRead(self.size, copied=True)
+            return newAbsP
+        return None
+
+    def wrapCloneChmodChown(self, fromAbsP, newAbsP, destDirFd=None):
+        '''Combines clone (see cloneFile), chmod and chown.
+        Returns newAbsP, if the clone succeeded, None otherwise
         '''
-        if self.cpFile(currentAbsP, newAbsP):
-            self.chmodChownFile(newAbsP)
+        if self.cloneFile(fromAbsP, newAbsP, destDirFd):
+            self.chmodChownFile(newAbsP, destDirFd)
+            cycleMetrics.addLag(self.mtimeNs)
+            return newAbsP
+        return None
 
     def syncFile(self, srcD, srcDirPath, destDirPath,
                  destFiles, destDirs,
                  stopTrackingExisting,
                  startTrackingExisting,
-                 pickUniqName):
+                 pickUniqName,
+                 srcDirFd=None, destDirFd=None, copyFile=None,
+                 srcNode=None, destNode=None):
         '''Tries to sync a file in one of the following ways:
             - Same file already exists in main target dir, move accordingly.
             - Same file doesn't exist, so copy the file from source
@@ -193,18 +1539,30 @@ class SrcFile(BaseFile):
             pickUniqName, function from outside class, should accept str and
                 returns same string with appended timestamp (as per current
                 implementation). No validation for the path length is done!
+            srcDirFd/destDirFd (optional), int, open fds of srcD and of its
+                equivalent dir in dest, used instead of abs paths
+            copyFile (optional), function from outside class, does the
+                copying instead of wrapCpChmodChown, e.g. by handing it over
+                to copy workers; takes the same arguments, preceded by self,
+                and returns the abs path the file is (going to be) copied to
+            srcNode/destNode (optional), DirNode of srcD and of its
+                equivalent dir in dest, if already looked up (see PathNodes)
+        Returns the absolute path (str) the file was synced to, None if it
+        could not be synced
         '''
-        fRelP = os.path.join(srcD.getRelPath(), self.getName())
+        if copyFile is None:
+            copyFile = SrcFile.wrapCpChmodChown
+        if srcNode is None:
+            srcNode = pathNodes.dirOf(srcDirPath, srcD.getRelPath())
+        if destNode is None:
+            destNode = pathNodes.dirOf(destDirPath, srcD.getRelPath())
         
-        curAbsP = os.path.join(srcDirPath, fRelP)
-        curAbsP = os.path.normpath(curAbsP)
+        curAbsP = srcNode.filePath(self.getName())
+        newAbsP = destNode.filePath(self.getName())
         
-        newAbsP = os.path.join(destDirPath, fRelP)
-        newAbsP = os.path.normpath(newAbsP)
-        
-        if not(os.path.exists(newAbsP)):
+        if not(pathExistsAt(newAbsP, destDirFd)):
             logger.debug("Copying file, abs path is free")
-            self.wrapCpChmodChown(curAbsP, newAbsP)
+            return copyFile(self, curAbsP, newAbsP, srcDirFd, destDirFd)
         # otherwise, something exists at dest path, handle such case
         else:
             logger.warning("Name conflict detected - absolute path not unique")
@@ -223,6 +1581,9 @@ class SrcFile(BaseFile):
                 stopTrackingExisting(newAbsP, destFiles, destDirs)
                 try:
                     os.rename(newAbsP, newAbsP_uniq)
+                    cycleMetrics.addChange("renamed")
+                    changeFeed.record("moved", newAbsP_uniq,
+                                      fromAbsPath=newAbsP, isDir=True)
                     lg1 = "Existing destination directory renamed because of "
                     lg2 = f"naming conflict: '{newAbsP}' -> '{newAbsP_uniq}'"
                     logger.info(lg1 + lg2)
@@ -252,17 +1613,21 @@ class SrcFile(BaseFile):
                 logger.warning(f"Name conflict with existing file: {newAbsP}")
                 # stop tracking file
                 fHash = BaseFile(newAbsP).calculateHash(os.path.split(newAbsP)[0])
-                for t in destFiles[fHash]:
+                for t in destFiles.get(fHash, ()):
                     if newAbsP == t[0]:
                         logger.debug(f"Stop tracking it, pending renaming")
                         destFiles[fHash].remove(t)
                         break
                 try:
                     os.rename(newAbsP, newAbsP_uniq)
+                    cycleMetrics.addChange("renamed")
                     replacement = DestFile(newAbsP_uniq)
+                    changeFeed.record("moved", newAbsP_uniq,
+                                      replacement.getHash(),
+                                      fromAbsPath=newAbsP)
                     # start tracking again after renaming
-                    destFiles[replacement.getHash()].append((newAbsP_uniq,
-                                                             replacement))
+                    destFiles.setdefault(replacement.getHash(), []).append(
+                        (newAbsP_uniq, replacement))
                     logger.debug(f"Renamed '{newAbsP}' -> '{newAbsP_uniq}'")
                 except Exception as e:
                     logger.error("Renaming on destination side failed",
@@ -270,12 +1635,15 @@ class SrcFile(BaseFile):
                     # renaming failed, start tracking old name again
                     logger.debug(f"Re-start tracking the file")
                     restore = DestFile(newAbsP)
-                    destFiles[restore.getHash()].append((newAbsP, restore))
+                    destFiles.setdefault(restore.getHash(), []).append((newAbsP, restore))
                     mustChangeOriginalNameInDest = True
             # anything else, just rename it
             else:
                 try:
                     os.rename(newAbsP, newAbsP_uniq)
+                    cycleMetrics.addChange("renamed")
+                    changeFeed.record("moved", newAbsP_uniq,
+                                      fromAbsPath=newAbsP)
                     logger.debug(f"Renamed '{newAbsP}' -> '{newAbsP_uniq}'")
                 except Exception as e:
                     logger.error("Renaming on destination side failed!",
@@ -286,10 +1654,11 @@ class SrcFile(BaseFile):
                 lg1 = "Abs path conflict could not be resolved"
                 lg2 = "Changing original file name when copying to dest"
                 logger.error(lg1+lg2)
-                self.wrapCpChmodChown(curAbsP, newAbsP_uniq)
+                return copyFile(self, curAbsP, newAbsP_uniq,
+                                srcDirFd, destDirFd)
             else:
                 logger.debug("Abs path conflict resolved")
-                self.wrapCpChmodChown(curAbsP, newAbsP)
+                return copyFile(self, curAbsP, newAbsP, srcDirFd, destDirFd)
                 # self.wrapMvChmodChown(curAbsP, newAbsP, srcFile)
 
 
@@ -297,6 +1666,14 @@ class DestFile(SrcFile):
     '''Used to define a file residing the replica directory
     '''
     
+    def hashFile(self, fileLocationPath, dirFd=None):
+        '''Sets the hash value of self, refer to getOrCalculateHash. Unlike
+        src files, dest files are hashed whatever their age: a file just
+        copied there is as recent as it gets, and must still be tracked by
+        its hash value, see FileStability
+        '''
+        self.hashHex = self.getOrCalculateHash(fileLocationPath, dirFd)
+
     def mvFile(self, currentAbsP, newAbsP):
         '''Assumes that there is no file/dir at the specified path.
         currentAbsP, str, the absolute path to file
@@ -304,8 +1681,15 @@ class DestFile(SrcFile):
         Returns True, if successful, False otherwise
         '''
         try:
+            ioThrottle.throttleOp()
             os.rename(currentAbsP, newAbsP)
             logger.info(f"MOVED file: '{currentAbsP}' -> '{newAbsP}'")
+            cycleMetrics.addChange("moved")
+            changeFeed.record("moved", newAbsP, self.hashHex,
+                              fromAbsPath=currentAbsP)
+            hashCache.move(currentAbsP, newAbsP)
+            syncJournal.record("move", to=newAbsP, hash=self.hashHex,
+                               **{"from": currentAbsP})
             return True
         except Exception as e:
             logger.error(f"FAILED move '{currentAbsP}' -> '{newAbsP}'",
@@ -323,6 +1707,12 @@ class DestFile(SrcFile):
         curMode, curUserID, curGrpID = self.getModeAndOwnership()
         # new mode, userid, grpid
         newMode, newUserID, newGrpID = srcFile.getModeAndOwnership()
+        if self.nlink > 1 and (curMode, curUserID, curGrpID) != \
+                (newMode, newUserID, newGrpID):
+            # a hard link of other dest paths is not changed with them
+            unshared = srcFile.unshareLink(absPath)
+            self.refreshAttributes(os.path.dirname(absPath), updated=unshared)
+            curMode, curUserID, curGrpID = self.getModeAndOwnership()
         
         lg1 = f"Looking into file {absPath}, mode={curMode}, "
         lg2 = f"owning user: {curUserID}, userGrp={curGrpID} for potential "
@@ -333,6 +1723,8 @@ class DestFile(SrcFile):
             try:
                 os.chmod(absPath, newMode)
                 logger.debug("  MODE changed")
+                cycleMetrics.addChange("mode changed")
+                changeFeed.record("metadata", absPath)
                 self.mode = newMode
             except Exception as e:
                 logger.debug(f"  FAILED mode change, '{absPath}'",
@@ -345,6 +1737,8 @@ class DestFile(SrcFile):
             try:
                 os.chown(absPath, newUserID, newGrpID)
                 logger.debug("  OWNERSHIP changed")
+                cycleMetrics.addChange("owner changed")
+                changeFeed.record("metadata", absPath)
                 self.uid = newUserID
                 self.gid = newGrpID
             except Exception as e:
@@ -359,12 +1753,15 @@ class DestFile(SrcFile):
         newAbsPath, str, target path (absolute) of file in replica
         srcFile, SrcFile object, whose mode, owning user and group id are
         going to be applied to absPath(self)
+        Returns the absolute path (str) where the file is after the move
         '''
         logger.debug(f"Moving file '{currentAbsP}' -> '{newAbsP}'")
         if self.mvFile(currentAbsP, newAbsP):
             self.chmodChownFile(newAbsP, srcFile)
+            return newAbsP
         else:
             self.chmodChownFile(currentAbsP, srcFile)
+            return currentAbsP
 
     def handleMatchingFileSync(self, curAbsP, newAbsP, srcFile,
                                destFiles, destDirs,
@@ -403,6 +1800,7 @@ class DestFile(SrcFile):
             pickUniqName, function from outside class, should accept str and
                 returns same string with appended timestamp (as per current
                 implementation). No validation for the path length is done!
+        Returns the absolute path (str) where the file is after syncing
         '''
         lg1 = f"Src file '{srcFile.getName()}' matches existing file in "
         lg2 = f"dest: '{curAbsP}'"
@@ -410,12 +1808,13 @@ class DestFile(SrcFile):
         if curAbsP == newAbsP:
             logger.debug("No need to move, file already in its place")
             self.chmodChownFile(curAbsP, srcFile)
+            return curAbsP
         # if file needs to move, and nothing exists at new path
         elif not(os.path.exists(newAbsP)):
             lg1 = "Moving file, abs path is free, "
             lg2 = f"'{curAbsP}' -> '{newAbsP}'"
             logger.debug(lg1+lg2)
-            self.wrapMvChmodChown(curAbsP, newAbsP, srcFile)
+            return self.wrapMvChmodChown(curAbsP, newAbsP, srcFile)
         # otherwise, something exists at new path, handle such case
         else:
             # rename whatever is keeping hold of the absolute path
@@ -433,6 +1832,9 @@ class DestFile(SrcFile):
                 stopTrackingExisting(newAbsP, destFiles, destDirs)
                 try:
                     os.rename(newAbsP, newAbsP_uniq)
+                    cycleMetrics.addChange("renamed")
+                    changeFeed.record("moved", newAbsP_uniq,
+                                      fromAbsPath=newAbsP, isDir=True)
                     lg1 = "Existing destination directory renamed because of "
                     lg2 = f"naming conflict: '{newAbsP}' -> '{newAbsP_uniq}'"
                     logger.debug(lg1 + lg2)
@@ -461,14 +1863,18 @@ class DestFile(SrcFile):
             elif os.path.isfile(newAbsP) and not(os.path.islink(newAbsP)):
                 # stop tracking file
                 fHash = BaseFile(newAbsP).calculateHash(os.path.split(newAbsP)[0])
-                for t in destFiles[fHash]:
+                for t in destFiles.get(fHash, ()):
                     if newAbsP == t[0]:
                         destFiles[fHash].remove(t)
                         break
                 try:
                     os.rename(newAbsP, newAbsP_uniq)
+                    cycleMetrics.addChange("renamed")
                     replacement = DestFile(newAbsP_uniq)
-                    destFiles[replacement.getHash()].append((newAbsP_uniq, replacement))
+                    changeFeed.record("moved", newAbsP_uniq,
+                                      replacement.getHash(),
+                                      fromAbsPath=newAbsP)
+                    destFiles.setdefault(replacement.getHash(), []).append((newAbsP_uniq, replacement))
                     logger.debug(f"Renamed '{newAbsP}' -> '{newAbsP_uniq}'")
                 except Exception as e:
                     lg1 = "Existing dest file could not be renamed; "
@@ -477,12 +1883,15 @@ class DestFile(SrcFile):
                     # renaming failed, start tracking old name again
                     restore = DestFile(newAbsP)
                     # key must exist, if nothing changed since snapshot taken
-                    destFiles[restore.getHash()].append((newAbsP, restore))
+                    destFiles.setdefault(restore.getHash(), []).append((newAbsP, restore))
                     mustChangeOriginalNameInDest = True
             # anything else, just rename it
             else:
                 try:
                     os.rename(newAbsP, newAbsP_uniq)
+                    cycleMetrics.addChange("renamed")
+                    changeFeed.record("moved", newAbsP_uniq,
+                                      fromAbsPath=newAbsP)
                     logger.debug(f"Renamed {newAbsP} -> {newAbsP_uniq}")
                 except Exception as e:
                     logger.error("File naming conflict unresolved",
@@ -494,10 +1903,10 @@ class DestFile(SrcFile):
                 lg2 = "changing original file name in dest: "
                 lg3 = f"'{newAbsP}' -> '{newAbsP_uniq}'"
                 logger.error(lg1+lg2+lg3)
-                self.wrapMvChmodChown(curAbsP, newAbsP_uniq, srcFile)
+                return self.wrapMvChmodChown(curAbsP, newAbsP_uniq, srcFile)
             else:
                 logger.debug("   abs path conflict resolved")
-                self.wrapMvChmodChown(curAbsP, newAbsP, srcFile)
+                return self.wrapMvChmodChown(curAbsP, newAbsP, srcFile)
 
 
 class BaseDir(BaseFile):
@@ -508,9 +1917,9 @@ class BaseDir(BaseFile):
     directory of significance, i.e. the main src/replica directory.
     '''
     
-    def __init__(self, pathName, referencePath):
+    def __init__(self, pathName, referencePath, statResult=None):
         # self.size is going to always be 0
-        BaseFile.__init__(self, pathName)
+        BaseFile.__init__(self, pathName, statResult=statResult)
         # self.absPath = pathName
         self.relPath = os.path.relpath(pathName, referencePath)
         self.containedFiles = []
@@ -563,19 +1972,25 @@ class SrcDir(BaseDir):
     Refer to the equivalence check function doc string for more information
     '''
     
-    def __init__(self, pathName, referencePath):
-            BaseDir.__init__(self, pathName, referencePath)
+    def __init__(self, pathName, referencePath, statResult=None):
+            BaseDir.__init__(self, pathName, referencePath, statResult)
             self.hasDestEquivalent = False
             self.destEquivalentReusable = False
             self.newRelPathInDest = ''
+            self.destStatKey = None # (mtime ns, inode) of dest equivalent
+            self.digest = None # see SubtreeDigests
+            self.unchanged = False # identical subtree in dest
             # self.destEquivalenceCheck() # only if it makes sense
     
-    def destEquivalenceCheckAndAdapt(self, mainDestPath, pickUniqName):
+    def destEquivalenceCheckAndAdapt(self, mainDestPath, pickUniqName,
+                                     destParentFd=None):
         '''Check if the equivalen directory/file exists in the dest folder.
         mainDestPath, str, absolute path of the main replica directory
         pickUniqName, function from outside class, should accept str and
             returns same string with appended timestamp (as per current
             implementation). No validation for the path length is done!
+        destParentFd (optional), int, open fd of the dest dir, in which the
+            equivalent is looked for (see relToDirFd)
         
         Side effect1 : if such directory exists, it is assumend that it can
             be written into, so it is going to be used for copying into it.
@@ -586,14 +2001,23 @@ class SrcDir(BaseDir):
         logger.info(f"Check naming conflicts for '{self.getRelPath()}'")
         checkPath = os.path.join(mainDestPath, self.getRelPath()) # abs path
         checkPath = os.path.normpath(checkPath)
+        checkName = relToDirFd(checkPath, destParentFd)
+        try:
+            found = os.stat(checkName, dir_fd=destParentFd,
+                            follow_symlinks=False)
+        except OSError:
+            # e.g. also not accessible, taken as not existing (same as
+            # os.path.lexists)
+            found = None
         # If the same relative dir exists in the mainDestDirectory
-        if os.path.exists(checkPath):
-            # if it's a dir, consider equivalent; care if it is a link?!
-            if os.path.isdir(checkPath) and not(os.path.islink(checkPath)):
+        if found is not None:
+            # if it's a dir (not a link), consider equivalent
+            if stat.S_ISDIR(found.st_mode):
                 lg1 = "Dir in dest exists, which has the same abs path "
                 lg2 = f"needed for syncing: '{checkPath}'"
                 logger.info(lg1+lg2)
                 # LIMITATION: assuming that this directory can be written to
+                self.destStatKey = (found.st_mtime_ns, found.st_ino)
                 self.hasDestEquivalent = True
                 self.destEquivalentReusable = True
                 logger.debug(f"Dir in dest assumed to be reusable")
@@ -606,11 +2030,18 @@ class SrcDir(BaseDir):
                 logger.warning(lg1+lg2)
                 try:
                     renameToPath = pickUniqName(checkPath)
-                    os.rename(checkPath, renameToPath)
+                    os.rename(checkName, relToDirFd(renameToPath, destParentFd),
+                              src_dir_fd=destParentFd,
+                              dst_dir_fd=destParentFd)
+                    cycleMetrics.addChange("renamed")
+                    changeFeed.record("moved", renameToPath,
+                                      fromAbsPath=checkPath)
                     lg1 = "Non-dir file occupying the absolute path was "
                     lg2 = f"renamed '{checkPath}' -> '{renameToPath}'"
                     logger.warning(lg1+lg2)
-                    os.mkdir(checkPath)
+                    os.mkdir(checkName, dir_fd=destParentFd)
+                    cycleMetrics.addChange("dir created")
+                    changeFeed.record("created", checkPath, isDir=True)
                     lg1 = "After name conflict resolution, re-created "
                     lg2 = f"path for dir in dest: '{checkPath}'"
                     logger.info(lg1+lg2)
@@ -626,13 +2057,20 @@ class SrcDir(BaseDir):
                     logger.warning(lg0+lg1+lg2+lg3)
                     newDir = os.path.join(mainDestPath, self.newRelPathInDest)
                     newDir = os.path.normpath(newDir)
-                    os.mkdir(newDir)
+                    os.mkdir(relToDirFd(newDir, destParentFd),
+                             dir_fd=destParentFd)
+                    cycleMetrics.addChange("dir created")
+                    changeFeed.record("created", newDir, isDir=True)
                     logger.info("Therefore, created new dir: '{newDir}'")
         # if abs path is free
         else:
-            # simply create it
-            os.mkdir(checkPath)
-            logger.info(f"Created new dir in dest: '{checkPath}'")
+            # reuse an obsolete dest dir, if the src dir has been renamed,
+            # otherwise simply create it
+            if not(dirRenames.renameInto(self, checkPath, destParentFd)):
+                os.mkdir(checkName, dir_fd=destParentFd)
+                logger.info(f"Created new dir in dest: '{checkPath}'")
+                cycleMetrics.addChange("dir created")
+                changeFeed.record("created", checkPath, isDir=True)
             self.hasDestEquivalent = True
             self.destEquivalentReusable = True
     
@@ -661,3 +2099,1002 @@ class SrcDir(BaseDir):
         else:
             self.newRelPathInDest = pickUniqName(self.relPath)
         self.newRelPathInDest = os.path.normpath(self.newRelPathInDest)
+
+
+class DirRenameDetector(object):
+    '''Detects src dirs, which have been renamed/moved since the last sync,
+    so that their dest equivalents are renamed as a whole (a single
+    os.rename), instead of creating a new dest dir, moving every file into
+    it, and removing the old one entry by entry.
+    A dest dir is taken for the renamed equivalent of a new src dir (one,
+    whose path is free in dest), if its direct entries (names and hash
+    values of the files, names of the sub-dirs) are the same as those of
+    the src dir, and there is no dir in src at its path, i.e. it would be
+    removed otherwise. Sub-dirs are synced as usual afterwards, so
+    differences further down are still taken care of.
+    The index of the dest dirs is only built once per cycle, when the first
+    new src dir is found, so cycles without new dirs do not pay for it. The
+    files of a new src dir are only hashed, if a dest dir has the same
+    entry names, so that e.g. an initial sync does not hash the whole src
+    ahead of the cycle budget (see CycleBudget).
+    A single module level object (dirRenames) is used by SrcDir.
+    '''
+
+    def __init__(self):
+        self.srcDirPath = None
+        self.destDirPath = None
+        self.index = None # {signature: list(dest dir abs paths)}
+        self.nameSets = set() # signatures without the hash values
+
+    def reset(self, srcDirPath, destDirPath):
+        '''To be called at the start of every cycle
+        '''
+        self.srcDirPath = srcDirPath
+        self.destDirPath = destDirPath
+        self.index = None
+        self.nameSets = set()
+
+    @staticmethod
+    def namesOf(signature):
+        '''Returns signature without the hash values, i.e. a frozenset of
+        tuples (entry name, bool telling if it is a file)
+        '''
+        return frozenset((name, hashHex is not None)
+                         for name, hashHex in signature)
+
+    def signatureOf(self, dirAbsPath, fileClass=None):
+        '''Returns a frozenset of the direct entries of dirAbsPath(str),
+        or None if it holds no files. fileClass, SrcFile or DestFile, used
+        to hash the files (cached hash values are used); if not given, the
+        files are not hashed (the hash values are empty)
+        '''
+        entries = set()
+        hasFiles = False
+        with os.scandir(dirAbsPath) as dirEntries:
+            for entry in dirEntries:
+                if entry.is_file(follow_symlinks=False):
+                    if SrcFile.isTempName(entry.name):
+                        continue
+                    if fileClass is None:
+                        entries.add((entry.name, ""))
+                    else:
+                        f = fileClass(entry.path, statResult=entry.stat(
+                            follow_symlinks=False))
+                        entries.add((entry.name, f.getHash()))
+                    hasFiles = True
+                elif entry.is_dir(follow_symlinks=False):
+                    entries.add((entry.name, None))
+        return frozenset(entries) if hasFiles else None
+
+    def buildIndex(self):
+        logger.info("Indexing dest dirs, looking for renamed src dirs")
+        self.index = {}
+        pending = [self.destDirPath]
+        while pending:
+            dirAbsPath = pending.pop()
+            try:
+                with os.scandir(dirAbsPath) as dirEntries:
+                    for entry in dirEntries:
+                        if entry.is_dir(follow_symlinks=False) and \
+                                not(pathFilter.excludes(os.path.relpath(
+                                    entry.path, self.destDirPath), True)):
+                            pending.append(entry.path)
+                            signature = self.signatureOf(entry.path, DestFile)
+                            if signature:
+                                self.index.setdefault(signature, []).append(
+                                    entry.path)
+                                self.nameSets.add(self.namesOf(signature))
+            except OSError as e:
+                logger.error(f"Could NOT index dest dir '{dirAbsPath}'",
+                             exc_info=True)
+
+    def isObsolete(self, destDirAbsPath, targetAbsPath):
+        '''Returns True, if the dest dir can be moved to targetAbsPath: it
+        has no equivalent in src and it is not a parent of targetAbsPath
+        '''
+        relPath = os.path.relpath(destDirAbsPath, self.destDirPath)
+        if os.path.lexists(os.path.join(self.srcDirPath, relPath)):
+            return False
+        return not(targetAbsPath.startswith(os.path.join(destDirAbsPath, "")))
+
+    def forgetTree(self, dirAbsPath):
+        '''Drops dirAbsPath and the dirs under it from the index
+        '''
+        prefix = os.path.join(dirAbsPath, "")
+        for signature in list(self.index):
+            paths = [p for p in self.index[signature]
+                     if p != dirAbsPath and not(p.startswith(prefix))]
+            if paths:
+                self.index[signature] = paths
+            else:
+                del self.index[signature]
+
+    def renameInto(self, srcDir, targetAbsPath, destParentFd=None):
+        '''Looks for a renamed dest equivalent of srcDir (SrcDir) and, if
+        found, renames it to targetAbsPath(str), which must be free.
+        destParentFd (optional), int, open fd of the parent dir of
+            targetAbsPath (see relToDirFd)
+        Returns True, if a dest dir has been renamed
+        '''
+        if self.srcDirPath is None:
+            return False
+        try:
+            srcDirAbsPath = os.path.join(self.srcDirPath, srcDir.getRelPath())
+            signature = self.signatureOf(srcDirAbsPath)
+            if signature is None:
+                return False
+            if self.index is None:
+                self.buildIndex()
+            if self.namesOf(signature) not in self.nameSets:
+                return False
+            signature = self.signatureOf(srcDirAbsPath, SrcFile)
+            candidates = [p for p in self.index.get(signature, [])
+                          if self.isObsolete(p, targetAbsPath)]
+            if not(candidates):
+                return False
+            ioThrottle.throttleOp()
+            os.rename(candidates[0], relToDirFd(targetAbsPath, destParentFd),
+                      dst_dir_fd=destParentFd)
+        except OSError as e:
+            logger.error(f"Could NOT look for/rename a dir into "
+                         f"'{targetAbsPath}'", exc_info=True)
+            return False
+        lg1 = f"MOVED dir (renamed in src): '{candidates[0]}' -> "
+        logger.info(lg1 + f"'{targetAbsPath}'")
+        cycleMetrics.addChange("dir moved")
+        changeFeed.record("moved", targetAbsPath, fromAbsPath=candidates[0],
+                          isDir=True)
+        hashCache.moveTree(candidates[0], targetAbsPath)
+        syncJournal.record("move-dir", to=targetAbsPath,
+                           **{"from": candidates[0]})
+        self.forgetTree(candidates[0])
+        return True
+
+
+dirRenames = DirRenameDetector()
+
+
+class BulkDeleter(object):
+    '''Removes the obsolete dest files and dirs left after syncing, in bulk.
+    Files are grouped by their dir, which is opened once per batch, so that
+    the files are unlinked relative to its fd, by name only (see
+    BaseFile.useDirFds); the batches are handed over to a pool of workers.
+    Dirs are removed bottom-up, one depth level at a time, the deepest
+    first, so every dir is already empty when it is removed; the dirs at
+    the same depth are independent, so those are removed concurrently too.
+    A single module level object (bulkDeleter) is used for the dest.
+    workers, int, number of concurrent workers
+    '''
+    # max number of names per batch, so that a large dir is split up
+    batchSize = 1024
+
+    def __init__(self, workers=4):
+        self.workers = workers
+
+    def setWorkers(self, workers):
+        self.workers = workers
+
+    def makeBatches(self, absPaths):
+        '''Returns a list of tuples (parent dir abs path, list of names)
+        '''
+        groups = {}
+        for absPath in absPaths:
+            parent, name = os.path.split(absPath)
+            groups.setdefault(parent, []).append(name)
+        return [(parent, names[i:i+self.batchSize])
+                for parent, names in groups.items()
+                for i in range(0, len(names), self.batchSize)]
+
+    def runBatches(self, batches, removeBatch):
+        '''Calls removeBatch(parent, names) for every batch, concurrently.
+        Returns the list of the removed abs paths
+        '''
+        removed = []
+        if self.workers <= 1 or len(batches) <= 1:
+            for batch in batches:
+                removed.extend(removeBatch(*batch))
+            return removed
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for done in pool.map(lambda batch: removeBatch(*batch), batches):
+                removed.extend(done)
+        return removed
+
+    def removeBatch(self, parent, names, removeFunc, what):
+        '''Removes names (list of str) from the parent dir (abs path) with
+        removeFunc (os.unlink/os.rmdir). Returns the list of removed paths
+        '''
+        removed = []
+        dirFd = None
+        if BaseFile.useDirFds:
+            try:
+                dirFd = os.open(parent, os.O_RDONLY |
+                                getattr(os, "O_DIRECTORY", 0))
+            except OSError:
+                logger.debug(f"Cannot open dir fd for '{parent}'",
+                             exc_info=True)
+        try:
+            for name in names:
+                absPath = os.path.join(parent, name)
+                try:
+                    ioThrottle.throttleOp()
+                    removeFunc(relToDirFd(absPath, dirFd), dir_fd=dirFd)
+                except OSError as e:
+                    subtreeDigests.markDirty(absPath)
+                    if e.errno == errno.ENOTEMPTY and pathFilter.isActive():
+                        lg1 = f"{what} kept, it holds excluded entries: "
+                        logger.info(lg1 + f"'{absPath}'")
+                        continue
+                    logger.error(f"{what} cannot be removed: '{absPath}'",
+                                 exc_info=True)
+                    continue
+                removed.append(absPath)
+        finally:
+            if dirFd is not None:
+                os.close(dirFd)
+        return removed
+
+    def unlinkBatch(self, parent, names):
+        removed = self.removeBatch(parent, names, os.unlink, "File")
+        for absPath in removed:
+            logger.info(f"  File removed from destination, '{absPath}'")
+            changeFeed.record("deleted", absPath,
+                              hashCache.entries.get(absPath, (None, None))[1])
+            hashCache.forget(absPath)
+            syncJournal.record("remove", path=absPath)
+        if removed:
+            cycleMetrics.addChange("removed", len(removed))
+        return removed
+
+    def rmdirBatch(self, parent, names):
+        removed = self.removeBatch(parent, names, os.rmdir, "Dir")
+        for absPath in removed:
+            logger.info(f"Dir removed from dest: '{absPath}'")
+            changeFeed.record("deleted", absPath, isDir=True)
+        if removed:
+            cycleMetrics.addChange("dir removed", len(removed))
+        return removed
+
+    def removeFiles(self, absPaths):
+        '''Removes the files at absPaths (list of str).
+        Returns the list of the removed abs paths
+        '''
+        return self.runBatches(self.makeBatches(absPaths), self.unlinkBatch)
+
+    def removeDirs(self, absPaths):
+        '''Removes the (emptied) dirs at absPaths (list of normalized abs
+        paths), bottom-up. Returns the list of the removed abs paths
+        '''
+        byDepth = {}
+        for absPath in absPaths:
+            byDepth.setdefault(absPath.count(os.sep), []).append(absPath)
+        removed = []
+        for depth in sorted(byDepth, reverse=True):
+            removed.extend(self.runBatches(self.makeBatches(byDepth[depth]),
+                                           self.rmdirBatch))
+        return removed
+
+
+bulkDeleter = BulkDeleter()
+
+
+class CopyOrdering(object):
+    '''Copies found while syncing a snapshot (see SrcFile.syncFile), held
+    back until the whole snapshot is synced, then done in the order of a
+    policy, so that e.g. a small file modified a moment ago does not wait
+    behind gigabytes of unrelated copies:
+        'tree', the order in which they are found (level by level);
+        'recent', the most recently modified src files first;
+        'smallest', the smallest src files first;
+        'physical', the src files in the order of their location on the
+            storage, which cuts the seeks of a rotational disk (see
+            StorageProfile).
+    Src paths matching one of the priority globs (fnmatch, relative to the
+    src dir) go before all the others, in the order of the globs.
+    A single module level object (copyOrdering) is used by the main loop;
+    with the 'tree' policy and no globs, copies are not held back.
+    '''
+
+    policies = ("tree", "recent", "smallest", "physical")
+
+    def __init__(self, policy="tree", priorityGlobs=()):
+        self.policy = policy
+        self.priorityGlobs = list(priorityGlobs)
+        self.pending = [] # (srcF, curAbsP, newAbsP)
+
+    def setPolicy(self, policy, priorityGlobs=()):
+        self.policy = policy
+        self.priorityGlobs = list(priorityGlobs)
+
+    def isActive(self):
+        return self.policy != "tree" or bool(self.priorityGlobs)
+
+    def sortKey(self, srcF, relPath, absPath=None):
+        '''Returns the key, by which a copy of srcF (SrcFile) to relPath
+        (str, relative to the src/dest dir) is ordered
+        absPath (optional), str, abs path of srcF, for the 'physical' policy
+        '''
+        priority = len(self.priorityGlobs)
+        for i, glob in enumerate(self.priorityGlobs):
+            if fnmatch.fnmatchcase(relPath, glob):
+                priority = i
+                break
+        if self.policy == "recent":
+            return (priority, -srcF.mtimeNs)
+        if self.policy == "smallest":
+            return (priority, srcF.size)
+        if self.policy == "physical":
+            return (priority, storageProfile.locate(srcF, absPath))
+        return (priority, 0)
+
+    def defer(self, srcF, curAbsP, newAbsP, srcDirFd=None, destDirFd=None):
+        '''Holds back a copy; to be passed as the copyFile function of
+        syncSnapshot. Hard linked files are copied right away, as the other
+        links are going to be made to the copy.
+        Returns newAbsP, as expected from SrcFile.wrapCpChmodChown
+        '''
+        if srcF.getLinkKey():
+            return srcF.wrapCpChmodChown(curAbsP, newAbsP, srcDirFd,
+                                         destDirFd)
+        self.pending.append((srcF, curAbsP, newAbsP))
+        return newAbsP
+
+    def takeOrdered(self, srcDirPath):
+        '''Returns the held back copies, as a list of tuples (SrcFile,
+        current abs path, new abs path), in the order of the policy, and
+        empties the queue; ties keep the order in which they were found
+        '''
+        pending, self.pending = self.pending, []
+        return sorted(pending, key=lambda t: self.sortKey(
+            t[0], os.path.relpath(t[1], srcDirPath), t[1]))
+
+    def run(self, srcDirPath):
+        '''Does the held back copies, in the order of the policy; further
+        copies of a content already copied are cloned within dest (see
+        SrcFile.cloneFile)
+        '''
+        placed = {} # hash value: dest abs path of the content copied
+        for srcF, curAbsP, newAbsP in self.takeOrdered(srcDirPath):
+            fromAbsP = placed.get(srcF.getHash())
+            syncedAbsP = None
+            if fromAbsP and SrcFile.cloneMode != "none":
+                syncedAbsP = srcF.wrapCloneChmodChown(fromAbsP, newAbsP)
+            syncedAbsP = syncedAbsP or srcF.wrapCpChmodChown(curAbsP, newAbsP)
+            if syncedAbsP:
+                placed.setdefault(srcF.getHash(), syncedAbsP)
+            else:
+                # not synced (in place), so no digest for this dir
+                subtreeDigests.markDirty(newAbsP)
+
+
+copyOrdering = CopyOrdering()
+
+
+class PathFilter(object):
+    '''Include/exclude rules of the paths to sync, compiled into a single
+    regular expression, so that an entry is matched once, while listing a
+    dir, before it is stat-ed or descended into. An excluded src entry
+    (and everything under it) is not synced; an excluded dest entry is
+    neither used, nor removed.
+    Every rule is a tuple (include, pattern), include a bool; the first
+    matching rule wins, entries matching no rule are included. Paths are
+    relative to the src/dest dir, with '/' as separator and a trailing '/'
+    for dirs. Patterns are either:
+        globs (fnmatch, '*' also matches '/'), matching the name at any
+            depth, or the whole relative path, if they contain a '/'
+            (a leading '/' is ignored); a trailing '/' matches dirs only;
+        regular expressions, when prefixed with 're:', matching the whole
+            relative path.
+    A single module level object (pathFilter) is used by the scanners.
+    '''
+
+    regexPrefix = "re:"
+
+    def __init__(self):
+        self.rules = []
+        self.matcher = None # compiled re.Pattern, None if there are no rules
+
+    @classmethod
+    def translate(cls, pattern):
+        '''Returns the regular expression (str) of a single pattern
+        '''
+        if pattern.startswith(cls.regexPrefix):
+            return f"(?:{pattern[len(cls.regexPrefix):]})"
+        dirsOnly = pattern.endswith("/")
+        glob = pattern.strip("/")
+        anyDepth = "/" not in glob
+        body = fnmatch.translate(glob)
+        if body.endswith("\\Z"):
+            body = body[:-2]
+        return ("(?:.*/)?" if anyDepth else "") + body + \
+            ("/" if dirsOnly else "/?")
+
+    @staticmethod
+    def parseRules(lines):
+        '''Parses lines (iterable of str) of a filter file: '+ PATTERN'
+        includes, '- PATTERN' excludes; empty lines and lines starting with
+        '#' are skipped. Returns a list of tuples (include, pattern);
+        raises ValueError
+        '''
+        rules = []
+        for num, line in enumerate(lines, 1):
+            line = line.rstrip("\r\n")
+            if not(line.strip()) or line.lstrip().startswith("#"):
+                continue
+            if line[:2] not in ("+ ", "- ") or not(line[2:].strip()):
+                raise ValueError(f"line {num} is not '+ PATTERN' or "
+                                 f"'- PATTERN': '{line}'")
+            rules.append((line[0] == "+", line[2:].strip()))
+        return rules
+
+    def setRules(self, rules):
+        '''Compiles rules (list of tuples (include, pattern)); raises
+        ValueError for an invalid regular expression
+        '''
+        self.rules = list(rules)
+        if not(self.rules):
+            self.matcher = None
+            return
+        # alternatives are tried in order, so the group, which matched,
+        # names the first matching rule
+        groups = [f"(?P<{'i' if include else 'x'}{num}>"
+                  f"{self.translate(pattern)})"
+                  for num, (include, pattern) in enumerate(self.rules)]
+        try:
+            self.matcher = re.compile("(?:" + "|".join(groups) + ")\\Z")
+        except re.error as e:
+            raise ValueError(f"invalid pattern: {e}")
+
+    def isActive(self):
+        return self.matcher is not None
+
+    def excludes(self, relPath, isDir=False):
+        '''Returns True, if the entry at relPath (str, relative to the
+        src/dest dir) is excluded by the rules
+        '''
+        if self.matcher is None:
+            return False
+        if os.sep != "/":
+            relPath = relPath.replace(os.sep, "/")
+        found = self.matcher.match(relPath + "/" if isDir else relPath)
+        return found is not None and found.lastgroup[0] == "x"
+
+    def excludesTree(self, relPath, isDir=False):
+        '''Returns True, if the entry at relPath or one of the dirs above it
+        is excluded, i.e. for paths known without listing their parents
+        '''
+        if self.matcher is None:
+            return False
+        parts = relPath.replace(os.sep, "/").split("/")
+        return any(self.excludes("/".join(parts[:i]), True)
+                   for i in range(1, len(parts))) or \
+            self.excludes(relPath, isDir)
+
+
+pathFilter = PathFilter()
+
+
+class FileStability(object):
+    '''Keeps src files, which are being written, from being copied torn (and
+    copied again by every following cycle, while the writing goes on). A
+    src file is unstable, when it was modified less than minAge seconds
+    ago, or when it was modified while being hashed (see
+    SrcFile.hashFile). Its dest counterpart is then left as it is, and the
+    copy is deferred to a follow-up pass at the end of the cycle, which
+    waits for it to settle (up to followUpWait seconds); a file still
+    unstable by then is left for the next cycle.
+    A single module level object (fileStability) is used by the syncing.
+    '''
+
+    def __init__(self, minAge=0, followUpWait=2.0):
+        self.minAge = minAge # seconds
+        self.followUpWait = followUpWait # seconds
+        self.pending = [] # (srcF, curAbsP, newAbsP)
+
+    def setUp(self, minAge, followUpWait):
+        self.minAge = minAge
+        self.followUpWait = followUpWait
+
+    def isTooRecent(self, mtimeNs):
+        '''Returns True, if mtimeNs (int) is less than minAge seconds ago
+        '''
+        return bool(self.minAge) and \
+            time.time() - mtimeNs / 1e9 < self.minAge
+
+    def defer(self, srcF, curAbsP, newAbsP):
+        '''Holds back the copy of the unstable srcF (SrcFile) from curAbsP to
+        newAbsP (abs paths) for the follow-up pass
+        '''
+        logger.info(f"Copy of '{curAbsP}' deferred, it is being written")
+        self.pending.append((srcF, curAbsP, newAbsP))
+
+    def runFollowUp(self):
+        '''Copies the deferred files, which have settled in the meantime.
+        Returns the list of the new abs paths of the files left unsynced
+        '''
+        pending, self.pending = self.pending, []
+        if not(pending) or not(self.followUpWait):
+            return [newAbsP for srcF, curAbsP, newAbsP in pending]
+        # long enough for the youngest file to reach minAge, if possible
+        youngest = max(srcF.mtimeNs for srcF, curAbsP, newAbsP in pending)
+        wait = max(1.0, self.minAge - (time.time() - youngest / 1e9))
+        wait = min(wait, self.followUpWait)
+        lg1 = f"Follow-up pass for {len(pending)} file(s) being written, "
+        logger.info(lg1 + f"in {wait:.1f} s")
+        time.sleep(wait)
+        unsynced = []
+        for srcF, curAbsP, newAbsP in pending:
+            try:
+                srcF = SrcFile(curAbsP)
+            except OSError as e:
+                logger.info(f"Deferred '{curAbsP}' is gone, not copied")
+                continue
+            if srcF.unstable or os.path.isdir(newAbsP):
+                lg1 = f"'{curAbsP}' is still being written, left for the "
+                logger.info(lg1 + "next cycle")
+                unsynced.append(newAbsP)
+                continue
+            if os.path.lexists(newAbsP):
+                changeFeed.record("existing", newAbsP, hashCache.entries.get(
+                    newAbsP, (None, None))[1])
+            if not(srcF.wrapCpChmodChown(curAbsP, newAbsP)):
+                unsynced.append(newAbsP)
+        return unsynced
+
+
+fileStability = FileStability()
+
+
+class CycleBudget(object):
+    '''Caps the work taken in by a sync cycle, by time and/or bytes, so
+    that a huge (e.g. initial) sync is spread over many cycles, instead of
+    a single cycle running for hours, during which newly changed files wait.
+    The budget is spent on the src files, which have to be hashed (new or
+    changed since hashed last), in this order (see orderKey):
+        1. the files modified since the previous cycle started, the most
+            recent first, so that the staleness stays bounded;
+        2. the backlog, by relative path, from the cursor on (wrapping
+            around), so that every cycle goes on where the last one stopped.
+    A file taken in is charged with its size (the bytes to be copied); the
+    time spent is estimated by adding the copies still to be done, at the
+    read rate measured so far. Once the budget is spent, the remaining
+    files are postponed: their dest counterparts are left as they are, and
+    they are taken in by a later cycle. At least one file is taken in by
+    every cycle. Files with a known hash value are never postponed.
+    The cursor is kept in the journal between runs (see SyncJournal).
+    A single module level object (cycleBudget) is used by the syncing.
+    '''
+
+    def __init__(self, seconds=None, maxBytes=None):
+        self.seconds = seconds
+        self.maxBytes = maxBytes
+        self.cursor = "" # relPath of the last backlog file taken in
+        self.startNs = None # wall time the current cycle started at
+        self.lastStartNs = None # wall time the previous cycle started at
+        self.lock = threading.Lock() # reads are noted by worker threads
+        self.resetSpending()
+
+    def setUp(self, seconds, maxBytes):
+        self.seconds = seconds
+        self.maxBytes = maxBytes
+
+    def isActive(self):
+        return self.seconds is not None or self.maxBytes is not None
+
+    def start(self):
+        '''Resets the budget, at the start of every cycle
+        '''
+        if self.startNs is not None:
+            self.lastStartNs = self.startNs
+        self.startNs = time.time_ns()
+        self.resetSpending()
+
+    def resetSpending(self):
+        self.started = time.monotonic()
+        self.charged = 0 # bytes of the files taken in
+        self.readBytes = 0 # bytes read (hashed or copied) so far
+        self.copiedBytes = 0
+        self.taken = 0
+        self.postponed = 0
+        self.spent = False
+        self.lastTaken = None
+
+    def noteRead(self, nBytes, copied=False):
+        with self.lock:
+            self.readBytes += nBytes
+            if copied:
+                self.copiedBytes += nBytes
+
+    def isSpent(self):
+        if self.maxBytes is not None and self.charged >= self.maxBytes:
+            return True
+        if self.seconds is None:
+            return False
+        elapsed = time.monotonic() - self.started
+        if self.readBytes:
+            # copies still to be done, at the read rate measured so far
+            pending = max(0, self.charged - self.copiedBytes)
+            elapsed += pending * elapsed / self.readBytes
+        return elapsed >= self.seconds
+
+    def isRecent(self, mtimeNs):
+        return self.lastStartNs is not None and mtimeNs >= self.lastStartNs
+
+    def orderKey(self, relPath, mtimeNs):
+        '''Returns the sort key of a src file in the order files are taken
+        in, see the class description
+        '''
+        if self.isRecent(mtimeNs):
+            return (0, -mtimeNs, relPath)
+        return (1 if relPath > self.cursor else 2, 0, relPath)
+
+    def orderBy(self):
+        '''Returns a tuple (ORDER BY clause, its parameters) of the same
+        order as orderKey, for a table with path and mtimeNs columns
+        '''
+        sinceNs = self.lastStartNs if self.lastStartNs is not None \
+            else 2 ** 63 - 1
+        return ("CASE WHEN mtimeNs >= ? THEN 0 WHEN path > ? THEN 1 ELSE 2 "
+                "END, CASE WHEN mtimeNs >= ? THEN -mtimeNs ELSE 0 END, path",
+                (sinceNs, self.cursor, sinceNs))
+
+    def take(self, relPath, size, mtimeNs):
+        '''Returns True, if the src file at relPath (to be hashed) is taken
+        in by this cycle, False if it is postponed; to be called in the order
+        of orderKey
+        '''
+        self.spent = self.spent or (self.taken > 0 and self.isSpent())
+        if self.spent:
+            self.postponed += 1
+            return False
+        self.charged += size
+        self.taken += 1
+        if not(self.isRecent(mtimeNs)):
+            self.lastTaken = relPath
+        return True
+
+    def charge(self, nBytes):
+        '''Charges nBytes (int) of work done besides the src files taken in,
+        e.g. scrubbing the replica (see ReplicaScrubber). Returns False,
+        without charging, if the budget is spent already
+        '''
+        if not(self.isActive()):
+            return True
+        self.spent = self.spent or self.isSpent()
+        if self.spent:
+            return False
+        self.charged += nBytes
+        return True
+
+    def admitFiles(self, files, rootPath):
+        '''Yields the tuples (SrcFile, abs path of its dir) of files (list of
+        such tuples, found under rootPath) to be hashed by this cycle: the
+        ones with a known hash value, then the others, as taken in (see
+        take); the others are marked as postponed
+        '''
+        toHash = []
+        for f, dirAbsPath in files:
+            absPath = os.path.join(dirAbsPath, f.getName())
+            if hashCache.lookUp(absPath, f.getStatKey()) is not None:
+                yield (f, dirAbsPath)
+            else:
+                relPath = os.path.relpath(absPath, rootPath)
+                toHash.append((self.orderKey(relPath, f.mtimeNs), relPath,
+                               f, dirAbsPath))
+        toHash.sort(key=lambda t: t[0])
+        for key, relPath, f, dirAbsPath in toHash:
+            if self.take(relPath, f.getSize(), f.mtimeNs):
+                yield (f, dirAbsPath)
+            else:
+                f.postponed = True
+        self.finish()
+
+    def finish(self):
+        '''Moves the cursor past the last backlog file taken in, or back to
+        the start, once nothing is postponed, and journals it
+        '''
+        if self.postponed:
+            self.cursor = self.lastTaken or self.cursor
+            lg1 = f"Cycle budget spent: {self.taken} new/changed src "
+            lg2 = f"files taken in, {self.postponed} postponed, resuming "
+            logger.info(lg1 + lg2 + f"after '{self.cursor}'")
+        else:
+            self.cursor = ""
+        syncJournal.record("cursor", path=self.cursor, since=self.startNs)
+
+
+cycleBudget = CycleBudget()
+
+
+class SyncScheduler(object):
+    '''Picks the waiting time between the end of a sync cycle and the start
+    of the next one. Two modes are supported:
+        'fixed', cycles start at every n*syncPeriod second, as measured from
+            the start of the cycle, which has just ended (i.e. a cycle running
+            a second longer than the period loses almost a whole period);
+        'adaptive', the next cycle start is measured from the start of the
+            last one, without rounding up to a multiple of the period. After a
+            cycle which found changes, the next one starts after half the
+            period. Every consecutive cycle which found nothing doubles the
+            interval, up to maxPeriod.
+    In both modes, durations of the recent cycles are tracked, and a warning
+    is logged when those consistently overrun the sync period.
+    syncPeriod, int, seconds between two sync cycle starts
+    mode, str, 'fixed' or 'adaptive'
+    maxPeriod, int, ceiling of the interval in adaptive mode (seconds)
+    overrunWindow, int, number of consecutive overrunning cycles after which
+        a warning is logged
+    '''
+
+    def __init__(self, syncPeriod, mode="fixed", maxPeriod=None,
+                 overrunWindow=3):
+        self.syncPeriod = syncPeriod
+        self.mode = mode
+        self.maxPeriod = maxPeriod if maxPeriod else 8 * syncPeriod
+        self.overrunWindow = overrunWindow
+        self.recentDurations = [] # seconds, floats, most recent last
+        self.idleCycles = 0 # consecutive cycles which found no changes
+        self.interval = syncPeriod # seconds between two cycle starts
+
+    def nextWaitingTime(self, cycleDuration, changesFound):
+        '''Records the just finished cycle and calculates the waiting time
+        cycleDuration, float, duration of the cycle in seconds
+        changesFound, int, number of changes done during the cycle
+        Returns the waiting time in seconds (int) until next sync cycle start
+        '''
+        self.recentDurations.append(cycleDuration)
+        self.recentDurations = self.recentDurations[-self.overrunWindow:]
+        self.checkForOverruns()
+
+        if self.mode != "adaptive":
+            return self.syncPeriod - (int(cycleDuration) % self.syncPeriod)
+
+        if changesFound:
+            self.idleCycles = 0
+            self.interval = max(1, self.syncPeriod // 2)
+            lg1 = f"Last cycle found {changesFound} changes, next cycle "
+            lg2 = f"is scheduled {self.interval} s after its start"
+        else:
+            self.idleCycles += 1
+            self.interval = min(self.maxPeriod,
+                                self.syncPeriod * 2 ** (self.idleCycles - 1))
+            lg1 = f"{self.idleCycles} consecutive cycle(s) without changes, "
+            lg2 = f"backing off to an interval of {self.interval} s"
+        logger.info(lg1+lg2)
+        # start right away, if the cycle took longer than the interval
+        return max(0, int(self.interval - cycleDuration + 0.5))
+
+    def checkForOverruns(self):
+        '''Logs a warning, if the last few cycles have all taken longer than
+        the sync period.
+        '''
+        if len(self.recentDurations) < self.overrunWindow:
+            return
+        if min(self.recentDurations) > self.syncPeriod:
+            avg = sum(self.recentDurations) / len(self.recentDurations)
+            lg1 = f"The last {self.overrunWindow} cycles overran the sync "
+            lg2 = f"period of {self.syncPeriod} s (average duration "
+            lg3 = f"{avg:.1f} s); consider a longer sync period"
+            logger.warning(lg1+lg2+lg3)
+
+
+class ReplicaScrubber(object):
+    '''Guards against silent corruption of the replica, which the hash cache
+    does not notice (a cached hash is trusted as long as the size,
+    modification time and inode of a file are the same). After every cycle,
+    a share of the synced dest files is read and hashed again (see
+    BaseFile.calculateHash), in rotating order of their paths, continuing
+    where the last cycle stopped. Dest files no longer matching the hash of
+    their src file are copied again.
+    The whole replica is so verified every 1/fraction cycles, without
+    reading all of it in any single cycle.
+    fraction, float, share of the total size of the synced files per cycle
+    byteBudget, int, bytes per cycle, used instead of fraction if given
+    At least a single file is scrubbed per cycle, unless the cycle budget
+    is spent (the bytes scrubbed are charged to it, see CycleBudget.charge).
+    Src files not synced by the cycle (being written, or postponed by the
+    cycle budget) are left out, as their dest counterparts are left as
+    they are.
+    '''
+
+    def __init__(self, fraction=None, byteBudget=None):
+        self.fraction = fraction
+        self.byteBudget = byteBudget
+        self.cursor = "" # relPath of the last scrubbed file
+        self.passes = 0 # completed passes over the whole replica
+
+    def scrub(self, srcSnap, srcDirPath, destDirPath):
+        '''Scrubs the next share of the dest files, to be called after the
+        syncing of srcSnap, dict of {level under src: list(SrcDir objects)}
+        '''
+        synced = []
+        for lvl in srcSnap:
+            for srcD in srcSnap[lvl]:
+                for srcF in srcD.getContainedFiles():
+                    if srcF.unstable or srcF.postponed:
+                        continue
+                    relPath = os.path.join(srcD.getRelPath(), srcF.getName())
+                    synced.append((os.path.normpath(relPath), srcF))
+        if not(synced):
+            return
+        synced.sort(key=lambda t: t[0])
+        totalBytes = sum(srcF.getSize() for relPath, srcF in synced)
+        budget = self.byteBudget or self.fraction * totalBytes
+        # continue right after the last scrubbed file
+        start = bisect.bisect_right([t[0] for t in synced], self.cursor)
+        scrubbed = mismatches = readBytes = 0
+        for i in range(len(synced)):
+            index = (start + i) % len(synced)
+            relPath, srcF = synced[index]
+            if scrubbed and readBytes + srcF.getSize() > budget:
+                break
+            if not(cycleBudget.charge(srcF.getSize())):
+                logger.info("Cycle budget spent, scrub left for later")
+                break
+            scrubbed += 1
+            readBytes += srcF.getSize()
+            self.cursor = relPath
+            if not(self.scrubFile(relPath, srcF, srcDirPath, destDirPath)):
+                mismatches += 1
+            if index == len(synced) - 1:
+                self.passes += 1
+                logger.info(f"Whole replica verified (pass {self.passes})")
+        lg1 = f"Scrubbed {scrubbed} of {len(synced)} replica files "
+        lg2 = f"({readBytes} bytes), {mismatches} not matching the source"
+        logger.info(lg1+lg2)
+
+    def scrubFile(self, relPath, srcF, srcDirPath, destDirPath):
+        '''Hashes the dest file at relPath(str) and copies srcF (SrcFile)
+        again, if it does not match. Returns False on a mismatch
+        '''
+        srcAbsPath = os.path.join(srcDirPath, relPath)
+        destAbsPath = os.path.join(destDirPath, relPath)
+        try:
+            destF = DestFile(destAbsPath, hashNow=False)
+            hashHex = destF.calculateHash(os.path.dirname(destAbsPath))
+        except OSError as e:
+            # e.g. synced under another name, because of a naming conflict
+            logger.debug(f"Replica file not scrubbed: '{destAbsPath}'")
+            return True
+        if hashHex == srcF.getHash():
+            logger.debug(f"Replica file intact: '{destAbsPath}'")
+            return True
+        lg1 = f"Replica file '{destAbsPath}' does not match its source "
+        lg2 = "(silent corruption?), copying it again"
+        logger.warning(lg1+lg2)
+        hashCache.forget(destAbsPath)
+        changeFeed.record("existing", destAbsPath, hashHex)
+        if srcF.cpFile(srcAbsPath, destAbsPath):
+            srcF.chmodChownFile(destAbsPath)
+        return False
+
+
+class StorageProfile(object):
+    '''Characteristics of the storage, which the src and dest dirs are on,
+    read from /sys/block (linux): whether it is rotational (a hard disk) and
+    its queue depth (the requests it takes at a time). The I/O is adapted:
+        - on a rotational src, the files are hashed and copied in the order
+            of their physical location (see locationOf), instead of the
+            order of the paths, to cut the seeks;
+        - on non-rotational src and dests (SSD, NVMe), the default number
+            of concurrent workers is raised with the queue depth (see
+            workersFor), to keep the device queue busy.
+    A single module level object (storageProfile) is used by the syncing;
+    until it is set up, the I/O is not adapted.
+    '''
+
+    modes = ("auto", "hdd", "ssd", "none")
+    sysDevBlockPath = "/sys/dev/block"
+    fiemap = 0xC020660B # FS_IOC_FIEMAP ioctl request (linux)
+    ssdQueueDepth = 64 # assumed, if not detected
+    maxWorkers = 32
+
+    def __init__(self):
+        self.mode = "none"
+        self.rotational = False # src on rotational storage
+        self.queueDepth = None # of non-rotational src and dests only
+
+    @classmethod
+    def detect(cls, path):
+        '''Returns a tuple (rotational, queue depth) of the block device
+        holding path (str), each None, if not known (e.g. not on linux, on
+        a virtual file system, or rotational on a virtio disk)
+        '''
+        try:
+            dev = os.stat(path).st_dev
+            devPath = os.path.realpath(os.path.join(
+                cls.sysDevBlockPath, f"{os.major(dev)}:{os.minor(dev)}"))
+        except (OSError, AttributeError) as e:
+            return (None, None)
+        # a partition has no queue of its own, the queue of its disk is used
+        for queuePath in (os.path.join(devPath, "queue"),
+                          os.path.join(os.path.dirname(devPath), "queue")):
+            if os.path.isdir(queuePath):
+                break
+        else:
+            return (None, None)
+        values = []
+        for name in ("rotational", "nr_requests"):
+            try:
+                with open(os.path.join(queuePath, name)) as f:
+                    values.append(int(f.read()))
+            except (OSError, ValueError) as e:
+                values.append(None)
+        rotational, queueDepth = values
+        if "/virtio" in devPath:
+            # virtual disks are flagged rotational, whatever backs them
+            rotational = None
+        return (None if rotational is None else bool(rotational), queueDepth)
+
+    def setUp(self, mode, srcDirPath, destDirPaths=()):
+        '''mode, str, one of modes: 'auto' detects the storage of
+        srcDirPath and of the local destDirPaths, 'hdd' and 'ssd' take it
+        as given, 'none' leaves the I/O as it is
+        '''
+        self.mode = mode
+        self.rotational = False
+        self.queueDepth = None
+        if mode == "none":
+            return
+        detected = [self.detect(p) for p in [srcDirPath] + list(destDirPaths)]
+        if mode == "hdd":
+            self.rotational = True
+        elif mode == "ssd" or all(r is False for r, q in detected):
+            depths = [q for r, q in detected if q]
+            self.queueDepth = min(depths) if depths else self.ssdQueueDepth
+        else:
+            self.rotational = detected[0][0] is True
+        logger.info(f"Storage detected (rotational, queue depth): {detected}")
+
+    def workersFor(self, workers):
+        '''Returns the number of concurrent workers (int) to use instead of
+        the default number workers (int)
+        '''
+        if not(self.queueDepth):
+            return workers
+        return max(workers, min(self.maxWorkers, self.queueDepth // 8))
+
+    def locationOf(self, absPath, inode=0):
+        '''Returns a sort key (tuple) of the physical location of the file
+        at absPath (str): the offset of its first extent on the device, as
+        reported by FIEMAP, or else its inode number (files created together
+        tend to be allocated together)
+        '''
+        if fcntl is not None and absPath is not None:
+            # struct fiemap, mapping a single extent, see linux/fiemap.h
+            request = bytearray(struct.pack("=QQIIII", 0, 2 ** 64 - 1, 0, 0,
+                                            1, 0) + bytes(56))
+            try:
+                with open(absPath, "rb") as f:
+                    fcntl.ioctl(f.fileno(), self.fiemap, request, True)
+                if struct.unpack_from("=I", request, 20)[0]:
+                    return (0, struct.unpack_from("=Q", request, 40)[0])
+            except OSError:
+                pass
+        return (1, inode)
+
+    def locate(self, srcF, absPath):
+        '''Same as locationOf, for srcF (SrcFile) at absPath; a file is
+        located once, for the hashing and the copy ordering
+        '''
+        if srcF.location is None:
+            srcF.location = self.locationOf(absPath, srcF.inode)
+        return srcF.location
+
+    def orderReads(self, files):
+        '''Returns files (list of tuples (SrcFile, abs path of its dir)) in
+        the order to hash them: on a rotational src, by physical location
+        (the ones with a cached hash value, i.e. not read, first), otherwise
+        as given
+        '''
+        if not(self.rotational):
+            return files
+        def key(t):
+            f, dirAbsPath = t
+            absPath = os.path.join(dirAbsPath, f.getName())
+            if hashCache.lookUp(absPath, f.getStatKey()) is not None:
+                return (-1, 0)
+            return self.locate(f, absPath)
+        return sorted(files, key=key)
+
+
+storageProfile = StorageProfile()
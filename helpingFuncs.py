@@ -7,7 +7,10 @@ from time import time as timestamp
 import os
 import sys
 
-from helpingClasses import SrcFile, DestFile, SrcDir
+from helpingClasses import BaseFile, SrcFile, DestFile, SrcDir, CopyOrdering
+from helpingClasses import cycleMetrics, dirRenames, relToDirFd, changeFeed
+from helpingClasses import PathFilter, pathFilter, cycleBudget
+from helpingClasses import StorageProfile, storageProfile, pathNodes
 
 logger = logging.getLogger(f"main.{__name__}")
 
@@ -32,35 +35,219 @@ def printHelp():
     print("--syncPeriod INTEGER_NUMBER --logFile FILE")
     print()
     print("    --src DIRECTORY, the absolute path of the source directory")
-    print("    --dest DIRECTORY, the absolute path to the replica directory")
+    print("    --dest DIRECTORY, the absolute path to the replica directory,")
+    print("        or tcp://HOST:PORT of a receiver daemon on another host ", end='')
+    print("(see receiveSyncing.py);")
+    print("        may be given more than once, the source is then ", end='')
+    print("hashed and read once")
+    print("        per cycle for all the destinations")
     print("    --syncPeriod INTEGER_NUMBER, duration of sync cycle (seconds)")
     print("    --logFile FILE, path to log file - file will be overwritten!")
+    print()
+    print("  Optional arguments:")
+    print("    --scheduler fixed|adaptive, how the next cycle start is picked;")
+    print("        fixed (default) starts cycles at every n*syncPeriod second,")
+    print("        adaptive starts early after cycles which found changes and")
+    print("        backs off after consecutive cycles which found nothing")
+    print("    --maxSyncPeriod INTEGER_NUMBER, ceiling (seconds) for the ", end='')
+    print("adaptive back off, defaults to 8*syncPeriod")
+    print("    --journal FILE|none, journal of the hashing/copying done, ", end='')
+    print("used to resume")
+    print("        an interrupted cycle after a restart, defaults to the log ", end='')
+    print("file path")
+    print("        with '.journal' appended; 'none' disables journaling")
+    print("    --ioLimit SPEC, limits for the hashing/copying I/O, as ", end='')
+    print("';'-separated")
+    print("        windows 'HH:MM-HH:MM=LIMITS' (or '*=LIMITS' for all day), ", end='')
+    print("where LIMITS")
+    print("        is a ','-separated list of read:BYTES, write:BYTES and ", end='')
+    print("ops:NUMBER per")
+    print("        second; BYTES may end with K, M or G, e.g.")
+    print("        '08:00-20:00=read:20M,write:10M,ops:200;*=read:200M'")
+    print("    --pipeline sequential|async, sequential (default) runs ", end='')
+    print("the cycle steps")
+    print("        one after another; async overlaps listing, hashing, ", end='')
+    print("syncing and copying")
+    print("    --hashWorkers INTEGER_NUMBER, concurrent hashing in async ", end='')
+    print("pipeline (default 4,")
+    print("        more on SSDs, see --storage)")
+    print("    --copyWorkers INTEGER_NUMBER, concurrent copies in async ", end='')
+    print("pipeline (default 4,")
+    print("        more on SSDs, see --storage)")
+    print("    --deleteWorkers INTEGER_NUMBER, concurrent removal of ", end='')
+    print("obsolete dest files")
+    print("        and dirs (default 4, more on SSDs, see --storage)")
+    print("    --scrub PERCENT%|BYTES, re-reads this share of the replica ", end='')
+    print("every cycle")
+    print("        (in rotating order), re-copying files which no longer ", end='')
+    print("match the source,")
+    print("        e.g. '5%' verifies the whole replica every 20 cycles; ", end='')
+    print("BYTES may end")
+    print("        with K, M or G; disabled by default")
+    print("    --indexThreshold INTEGER_NUMBER, number of source files ", end='')
+    print("and dirs above")
+    print("        which cycles run on an on-disk (SQLite) index of the ", end='')
+    print("snapshots instead")
+    print("        of in memory ones, kept at the log file path with ", end='')
+    print("'.index' appended;")
+    print("        disabled by default")
+    print("    --changeFeed FILE, appends the changes done in the ", end='')
+    print("destination by every")
+    print("        cycle to FILE, as JSON lines with sequence numbers; ", end='')
+    print("disabled by default")
+    print("    --copyOrder tree|recent|smallest|physical, order of ", end='')
+    print("the copies of a")
+    print("        cycle; tree (default) copies in the order found, ", end='')
+    print("recent the most")
+    print("        recently modified files first, smallest the ", end='')
+    print("smallest files first,")
+    print("        physical in the order of their location on disk ", end='')
+    print("(the default on a")
+    print("        rotational src, see --storage)")
+    print("    --priorityPaths GLOB[,GLOB...], src paths (relative, ", end='')
+    print("fnmatch globs)")
+    print("        copied before all others, e.g. 'urgent/*,*.db'")
+    print("    --lagTarget SECONDS, warns when the replication lag ", end='')
+    print("(time from the")
+    print("        modification of a src file to its copy being in ", end='')
+    print("place) exceeds it")
+    print("    --rangeCopyThreshold BYTES|none, files of at least this ", end='')
+    print("size are copied")
+    print("        as byte ranges by concurrent workers (default 256M); ", end='')
+    print("BYTES may end")
+    print("        with K, M or G; 'none' disables it")
+    print("    --rangeCopyWorkers INTEGER_NUMBER, concurrent workers ", end='')
+    print("copying the ranges")
+    print("        of a single file (default 4, more on SSDs, see --storage)")
+    print("    --exclude PATTERN[,PATTERN...], src/dest paths which are ", end='')
+    print("neither synced,")
+    print("        nor removed from the dest, nor looked into; globs ", end='')
+    print("match the name at")
+    print("        any depth (or the relative path, if containing '/'), ", end='')
+    print("a trailing '/'")
+    print("        matches dirs only, 're:REGEX' matches the whole ", end='')
+    print("relative path, e.g.")
+    print("        '.git/,__pycache__/,*.tmp,re:build/.*\\.o'")
+    print("    --include PATTERN[,PATTERN...], paths synced even when ", end='')
+    print("matching --exclude")
+    print("    --filterFile FILE, rules read from FILE, one per line, ", end='')
+    print("'+ PATTERN' to")
+    print("        include, '- PATTERN' to exclude, the first matching ", end='')
+    print("rule wins; applied")
+    print("        after --include and --exclude")
+    print("    --minFileAge SECONDS, src files modified more recently ", end='')
+    print("are treated as")
+    print("        being written, same as files modified while being ", end='')
+    print("hashed: their copy")
+    print("        is deferred to a follow-up pass, and their dest ", end='')
+    print("counterpart kept")
+    print("        (default 0, i.e. only the check while hashing)")
+    print("    --followUpWait SECONDS, max wait before the follow-up ", end='')
+    print("pass at the end of a")
+    print("        cycle (default 2); 0 leaves such files for the next cycle")
+    print("    --cloneMode reflink|link|none, how a src file, whose ", end='')
+    print("content is already in")
+    print("        dest, is copied from there instead of from src: ", end='')
+    print("reflink (default)")
+    print("        shares extents where supported, else copies in the ", end='')
+    print("kernel; link makes")
+    print("        a hard link, if mode and owner match; none reads src ", end='')
+    print("again")
+    print("    --cycleBudget time:SECONDS,bytes:BYTES, caps the work of a ", end='')
+    print("cycle (either or")
+    print("        both); new/changed src files beyond it are left for ", end='')
+    print("later cycles, which")
+    print("        go on where the last one stopped, recently modified ", end='')
+    print("files first;")
+    print("        BYTES may end with K, M or G, e.g. 'time:600,bytes:50G'; ", end='')
+    print("disabled by")
+    print("        default")
+    print("    --storage auto|hdd|ssd|none, adapts the I/O to the storage ", end='')
+    print("of src and dest;")
+    print("        on a rotational (hdd) src, files are hashed and copied ", end='')
+    print("in the order of")
+    print("        their location on disk, on ssd the default number of ", end='')
+    print("workers is raised")
+    print("        with the queue depth; auto (default) detects it ", end='')
+    print("from /sys/block")
     sys.exit(0)
 
+# prefix of a --dest value naming a receiver daemon (see parseRemoteDest)
+remoteDestPrefix = "tcp://"
+
+# optional command line arguments, mapped to their default values
+optionalArgs = {"--scheduler": "fixed",
+                "--maxSyncPeriod": None,
+                "--journal": None,
+                "--ioLimit": None,
+                "--pipeline": "sequential",
+                "--hashWorkers": None,
+                "--copyWorkers": None,
+                "--deleteWorkers": None,
+                "--scrub": None,
+                "--indexThreshold": None,
+                "--changeFeed": None,
+                "--copyOrder": "tree",
+                "--priorityPaths": None,
+                "--lagTarget": None,
+                "--rangeCopyThreshold": "256M",
+                "--rangeCopyWorkers": None,
+                "--exclude": None,
+                "--include": None,
+                "--filterFile": None,
+                "--minFileAge": "0",
+                "--followUpWait": "2",
+                "--cloneMode": "reflink",
+                "--cycleBudget": None,
+                "--storage": "auto"}
+
+# workers, when not supplied, see StorageProfile.workersFor
+defaultWorkers = 4
+
 def validateInput(av):
     '''Validates command line arguments, refer to printHelp for
     details. Creates the dest dir, if it doesn't exist.
-    Returns a tuple of the values (sourceDirAbsPath, destinationDirAbsPath,\
-                                   syncPeriod, logFilePath, destDirCreatedNow)
+    --dest may be supplied more than once, for several destinations.
+    Returns a tuple of the values (sourceDirAbsPath, list of destination
+    dir abs paths (or remote dests), syncPeriod, logFilePath, list of the
+    dest dirs created now)
+    Optional arguments are only checked for their names here, refer to
+    validateOptionalInput for their values.
     '''
     # validating pre-defined args
     c = av[0] # invoked as command 'c'
-    # validating number of arguments
-    if len(av) != 9:
+    # validating number of arguments, those come in pairs of (arg, value)
+    if len(av) < 9 or len(av) % 2 != 1:
         print("Number of arguments incorrect.")
         invInput(c)
     mandatoryArgs = ["--dest", "--logFile", "--src", "--syncPeriod"] # sorted
     # validating arguments, hard-coded ones should be at odd indices:
-    cmdArgs = sorted([av[i] for i in range(1, 9, 2)])
-    if cmdArgs != mandatoryArgs:
+    cmdArgs = [av[i] for i in range(1, len(av), 2)]
+    if sorted(set(a for a in cmdArgs if a in mandatoryArgs)) != mandatoryArgs:
         print("Mandatory arguments supplied incorrectly")
         invInput(c)
+    for a in cmdArgs:
+        if a not in mandatoryArgs and a not in optionalArgs:
+            print(f"Unknown argument '{a}'")
+            invInput(c)
+        elif cmdArgs.count(a) > 1 and a != "--dest":
+            print(f"Argument '{a}' supplied more than once")
+            invInput(c)
 
     # extracting user input - find at which index a mandator arg is
     # and return the elementent having the following index
     dest, logF, src, p = map((lambda v: av[av.index(v)+1]), mandatoryArgs)
+    dests = [av[i+1] for i in range(1, len(av), 2) if av[i] == "--dest"]
     src = os.path.normpath(src)
-    dest = os.path.normpath(dest)
+    for i, dest in enumerate(dests):
+        if dest.startswith(remoteDestPrefix):
+            try:
+                parseRemoteDest(dest)
+            except ValueError as e:
+                print(e)
+                invInput(c)
+        else:
+            dests[i] = os.path.normpath(dest)
     logF = os.path.normpath(logF)
 
     # validate user input:
@@ -98,31 +285,333 @@ def validateInput(av):
         invInput(c)
         
     # if dest doesn't exist, it should be created
-    destCreatedNow = False
-    if os.path.isdir(dest):
-        dest = os.path.realpath(dest)
-        if os.path.islink(dest):
-            print("Dest cannot be a link")
+    destsCreatedNow = []
+    for i, dest in enumerate(dests):
+        if dest.startswith(remoteDestPrefix):
+            continue # the receiver checks its dest dir
+        elif os.path.isdir(dest):
+            dest = os.path.realpath(dest)
+            if os.path.islink(dest):
+                print("Dest cannot be a link")
+                invInput(c)
+        else:
+            try:
+                os.makedirs(dest) # logged in main, see destsCreatedNow
+                dest = os.path.realpath(dest)
+                destsCreatedNow.append(dest)
+            except Exception as e:
+                print(e)
+                print("Replica dir doesn't exist and could not be created")
+                sys.exit(-1)
+        dests[i] = dest
+
+    # log file not in dest/src, and dest/src not each other's parent
+    # (a remote dest is a dir on the receiver's host, which checks it):
+    localDests = [dest for dest in dests if parseRemoteDest(dest) is None]
+    for dest in [src] + localDests:
+        if isInside(logFileLocation, dest):
+            print("Log file cannot be located in the src or dest directories")
+            sys.exit(-1)
+    for dest in localDests:
+        if isInside(dest, src) or isInside(src, dest):
+            print("Source directory cannot be inside destination, and vice versa")
+            sys.exit(-1)
+    for i, dest in enumerate(dests):
+        for other in dests[i+1:]:
+            remote, otherRemote = parseRemoteDest(dest), parseRemoteDest(other)
+            if remote is None and otherRemote is None:
+                nested = isInside(dest, other) or isInside(other, dest)
+            else:
+                nested = remote == otherRemote
+            if nested:
+                print("Destination directories cannot be inside each other")
+                sys.exit(-1)
+
+    return (src, dests, p, logF, destsCreatedNow)
+
+def isInside(path, dirPath):
+    '''Returns True, if path(str) is dirPath(str) or a path inside it,
+    comparing whole path components (relative paths are taken as relative
+    to the current dir)
+    '''
+    path, dirPath = os.path.abspath(path), os.path.abspath(dirPath)
+    return os.path.commonpath([path, dirPath]) == dirPath
+
+def parseRemoteDest(dest):
+    '''Parses dest (str) of the form tcp://HOST:PORT.
+    Returns a tuple (host, port), or None if dest is a local directory;
+    raises ValueError if dest is an invalid remote destination
+    '''
+    if not(dest.startswith(remoteDestPrefix)):
+        return None
+    host, sep, port = dest[len(remoteDestPrefix):].rpartition(":")
+    try:
+        port = int(port)
+        if not(sep and host and 0 < port < 65536):
+            raise ValueError("Missing host or port out of range")
+    except ValueError:
+        raise ValueError(f"Remote dest should be {remoteDestPrefix}HOST:PORT")
+    return (host.strip("[]"), port)
+
+def validateOptionalInput(av, src, dests, syncPeriod, logF):
+    '''Validates the values of the optional command line arguments, refer
+    to printHelp for details. Expected to be called after validateInput.
+    src, dests, syncPeriod, logF, the already validated mandatory arguments
+    Returns a dict of {argument name without leading dashes: value}, with
+    default values for the arguments not supplied by the user
+    '''
+    c = av[0]
+    opts = {a[2:]: optionalArgs[a] for a in optionalArgs}
+    for i in range(1, len(av), 2):
+        if av[i] in optionalArgs:
+            opts[av[i][2:]] = av[i+1]
+
+    if opts["scheduler"] not in ("fixed", "adaptive"):
+        print("Scheduler should be either 'fixed' or 'adaptive'")
+        invInput(c)
+    if opts["maxSyncPeriod"] is None:
+        opts["maxSyncPeriod"] = 8 * syncPeriod
+    else:
+        try:
+            opts["maxSyncPeriod"] = int(opts["maxSyncPeriod"])
+            if opts["maxSyncPeriod"] < syncPeriod:
+                raise ValueError("Max period is shorter than sync period")
+        except:
+            print("Supplied max period should be an int >= syncPeriod")
             invInput(c)
+
+    # journal: location exists and is not in src/dest, same as the log file
+    if opts["journal"] is None:
+        opts["journal"] = logF + ".journal"
+    elif opts["journal"].lower() == "none":
+        opts["journal"] = None
     else:
+        opts["journal"] = os.path.abspath(opts["journal"])
+        journalLocation = os.path.split(opts["journal"])[0]
+        if not(os.path.isdir(journalLocation)):
+            print("Journal file directory doesn't exist")
+            sys.exit(-1)
+        journalLocation = os.path.realpath(journalLocation)
+        if any(isInside(journalLocation, d) for d in [src] + dests
+               if parseRemoteDest(d) is None):
+            print("Journal cannot be located in the src or dest directories")
+            sys.exit(-1)
+
+    if opts["changeFeed"] is not None:
+        opts["changeFeed"] = os.path.abspath(opts["changeFeed"])
+        feedLocation = os.path.split(opts["changeFeed"])[0]
+        if not(os.path.isdir(feedLocation)):
+            print("Change feed file directory doesn't exist")
+            sys.exit(-1)
+        feedLocation = os.path.realpath(feedLocation)
+        if any(isInside(feedLocation, d) for d in [src] + dests
+               if parseRemoteDest(d) is None):
+            print("Change feed cannot be located in the src or dest directories")
+            sys.exit(-1)
+
+    if opts["ioLimit"] is not None:
         try:
-            os.makedirs(dest) # logged in main, relevant flag is below
-            dest = os.path.realpath(dest)
-            destCreatedNow = True
+            opts["ioLimit"] = parseIOLimits(opts["ioLimit"])
         except Exception as e:
-            print(e)
-            print("Replica dir doesn't exist and could not be created")
-            sys.exit(-1)
-            
-    # log file not in dest/src, and dest/src not each other's parent:
-    if src in logFileLocation or dest in logFileLocation:
-        print("Log file cannot be located in the src or dest directories")
-        sys.exit(-1)
-    if dest in src or src in dest:
-        print("Source directory cannot be inside destination, and vice versa")
-        sys.exit(-1)
-    
-    return (src, dest, p, logF, destCreatedNow)
+            print(f"Supplied I/O limits are invalid: {e}")
+            invInput(c)
+
+    if opts["pipeline"] not in ("sequential", "async"):
+        print("Pipeline should be either 'sequential' or 'async'")
+        invInput(c)
+    for workers in ("hashWorkers", "copyWorkers", "deleteWorkers",
+                    "rangeCopyWorkers"):
+        if opts[workers] is None:
+            continue # picked with the storage, see Syncer.setUp
+        try:
+            opts[workers] = int(opts[workers])
+            if opts[workers] <= 0:
+                raise ValueError("Number of workers is non-positive int")
+        except:
+            print(f"Supplied {workers} should be a positive int")
+            invInput(c)
+
+    if opts["scrub"] is not None:
+        try:
+            opts["scrub"] = parseScrubBudget(opts["scrub"])
+        except Exception as e:
+            print(f"Supplied scrub budget is invalid: {e}")
+            invInput(c)
+
+    if opts["indexThreshold"] is not None:
+        try:
+            opts["indexThreshold"] = int(opts["indexThreshold"])
+            if opts["indexThreshold"] < 0:
+                raise ValueError("Index threshold is negative int")
+        except:
+            print("Supplied index threshold should be a non-negative int")
+            invInput(c)
+
+    if opts["copyOrder"] not in CopyOrdering.policies:
+        print(f"Copy order should be one of {CopyOrdering.policies}")
+        invInput(c)
+    if opts["priorityPaths"] is None:
+        opts["priorityPaths"] = []
+    else:
+        opts["priorityPaths"] = [g.strip() for g in
+                                 opts["priorityPaths"].split(",") if g.strip()]
+    if opts["lagTarget"] is not None:
+        try:
+            opts["lagTarget"] = float(opts["lagTarget"])
+            if opts["lagTarget"] <= 0:
+                raise ValueError("Lag target is non-positive")
+        except:
+            print("Supplied lag target should be a positive number (seconds)")
+            invInput(c)
+
+    if opts["rangeCopyThreshold"].lower() == "none":
+        opts["rangeCopyThreshold"] = None
+    else:
+        try:
+            opts["rangeCopyThreshold"] = parseByteSize(
+                opts["rangeCopyThreshold"])
+            if opts["rangeCopyThreshold"] <= 0:
+                raise ValueError("Range copy threshold is non-positive")
+        except:
+            print("Supplied range copy threshold should be a positive size")
+            invInput(c)
+
+    # included first, so that --include overrides --exclude
+    opts["filterRules"] = [
+        (include, pattern.strip())
+        for include, patterns in ((True, opts["include"]),
+                                  (False, opts["exclude"]))
+        if patterns is not None
+        for pattern in patterns.split(",") if pattern.strip()]
+    if opts["filterFile"] is not None:
+        try:
+            with open(opts["filterFile"], encoding="utf-8") as f:
+                opts["filterRules"] += PathFilter.parseRules(f)
+        except (OSError, ValueError) as e:
+            print(f"Supplied filter file cannot be used: {e}")
+            invInput(c)
+    try:
+        PathFilter().setRules(opts["filterRules"])
+    except ValueError as e:
+        print(f"Supplied include/exclude rules are invalid: {e}")
+        invInput(c)
+
+    for seconds in ("minFileAge", "followUpWait"):
+        try:
+            opts[seconds] = float(opts[seconds])
+            if opts[seconds] < 0:
+                raise ValueError("Number of seconds is negative")
+        except:
+            print(f"Supplied {seconds} should be a non-negative number")
+            invInput(c)
+    if opts["cloneMode"] not in ("reflink", "link", "none"):
+        print("Clone mode should be one of 'reflink', 'link' or 'none'")
+        invInput(c)
+    if opts["cycleBudget"] is None:
+        opts["cycleBudget"] = (None, None)
+    else:
+        try:
+            opts["cycleBudget"] = parseCycleBudget(opts["cycleBudget"])
+        except Exception as e:
+            print(f"Supplied cycle budget is invalid: {e}")
+            invInput(c)
+    if opts["storage"] not in StorageProfile.modes:
+        print(f"Storage should be one of {StorageProfile.modes}")
+        invInput(c)
+    return opts
+
+def parseIOLimits(spec):
+    '''Parses the I/O limits specification, refer to printHelp for details
+    spec, str, e.g. '08:00-20:00=read:20M,write:10M;*=read:200M'
+    Returns a list of tuples (startMinute, endMinute, limits dict), as
+    expected by IOThrottle.setWindows; raises ValueError if spec is invalid
+    '''
+    toMinute = lambda hhmm: int(hhmm[0]) * 60 + int(hhmm[1])
+    windows = []
+    for window in spec.split(";"):
+        if not window.strip():
+            continue
+        timeRange, limitsSpec = window.split("=")
+        timeRange = timeRange.strip()
+        if timeRange == "*":
+            start, end = 0, 24 * 60
+        else:
+            start, end = [toMinute(t.strip().split(":"))
+                          for t in timeRange.split("-")]
+            if not(0 <= start < 24 * 60 and 0 <= end <= 24 * 60):
+                raise ValueError(f"time out of range in '{timeRange}'")
+        limits = {}
+        for limit in limitsSpec.split(","):
+            kind, value = [v.strip() for v in limit.split(":")]
+            if kind not in ("read", "write", "ops"):
+                raise ValueError(f"unknown limit '{kind}'")
+            limits[kind] = parseByteSize(value)
+            if limits[kind] <= 0:
+                raise ValueError(f"limit '{kind}' should be positive")
+        windows.append((start, end, limits))
+    return windows
+
+def parseByteSize(value):
+    '''Parses value (str), a number optionally ending with K, M or G
+    (binary units), e.g. '20M'. Returns an int; raises ValueError
+    '''
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    value = value.strip()
+    factor = units.get(value[-1:].upper(), 1)
+    if value[-1:].upper() in units:
+        value = value[:-1]
+    return int(float(value) * factor)
+
+def parseScrubBudget(spec):
+    '''Parses the scrub budget, refer to printHelp for details
+    spec, str, a percentage of the replica size (e.g. '5%') or BYTES
+    Returns a tuple (fraction or None, bytes or None), as expected by
+    ReplicaScrubber; raises ValueError if spec is invalid
+    '''
+    spec = spec.strip()
+    if spec.endswith("%"):
+        fraction = float(spec[:-1]) / 100
+        if not(0 < fraction <= 1):
+            raise ValueError("percentage should be in (0, 100]")
+        return (fraction, None)
+    budget = parseByteSize(spec)
+    if budget <= 0:
+        raise ValueError("byte budget should be positive")
+    return (None, budget)
+
+def parseCycleBudget(spec):
+    '''Parses the cycle budget, refer to printHelp for details
+    spec, str, e.g. 'time:600,bytes:50G'
+    Returns a tuple (seconds or None, bytes or None), as expected by
+    CycleBudget.setUp; raises ValueError if spec is invalid
+    '''
+    budget = {"time": None, "bytes": None}
+    for limit in spec.split(","):
+        kind, value = [v.strip() for v in limit.split(":")]
+        if kind not in budget:
+            raise ValueError(f"unknown limit '{kind}'")
+        budget[kind] = float(value) if kind == "time" \
+            else parseByteSize(value)
+        if budget[kind] <= 0:
+            raise ValueError(f"limit '{kind}' should be positive")
+    return (budget["time"], budget["bytes"])
+
+def orderHashing(listed, rootPath):
+    '''Returns the files listed (list of tuples (SrcFile, abs path of its
+    dir), found under rootPath) to be hashed by the cycle, in the order to
+    hash them: by physical location on a rotational src (see
+    StorageProfile), within the cycle budget (see CycleBudget)
+    '''
+    listed = storageProfile.orderReads(listed)
+    if cycleBudget.isActive():
+        return cycleBudget.admitFiles(listed, rootPath)
+    return listed
+
+def isHashingOrdered():
+    '''Returns True, if the src files are to be hashed once all are listed,
+    in the order of orderHashing
+    '''
+    return cycleBudget.isActive() or storageProfile.rotational
 
 def pickNewName(currentName):
     '''Currently implemented to append a timestamp after a filename.
@@ -137,143 +626,265 @@ def getCurrentTime():
     currentTime = dt.datetime.now()
     return currentTime
 
-def endSyncCycle(cycleStart, syncPeriod):
+def endSyncCycle(cycleStart, syncPeriod, scheduler=None, changesFound=0):
     '''Ends the cycle and calculates the waiting time till next cycle start
     cycleStart - datetime object marking the sync cycle start
     syncPeriod - int, seconds between two sync cycle starts/ends
+    scheduler (optional) - SyncScheduler object, which picks the waiting
+        time instead, based on the measured cycle durations and changes
+    changesFound (optional) - int, number of changes done during the cycle
     Returns the waiting time in seconds untill next sync cycle start
     '''
     endTime = getCurrentTime()
     timeDelta = endTime - cycleStart
-    # waitingTime = syncPeriod - (timeDelta.seconds % syncPeriod)
-    return (syncPeriod - (timeDelta.seconds % syncPeriod))
+    if scheduler is None:
+        # waitingTime = syncPeriod - (timeDelta.seconds % syncPeriod)
+        return (syncPeriod - (timeDelta.seconds % syncPeriod))
+    return scheduler.nextWaitingTime(timeDelta.total_seconds(), changesFound)
+
+def openDirFd(absPath, name, parentDirFd=None):
+    '''Opens a directory for fd-relative operations (see os.fwalk).
+    absPath, str, absolute path of the directory
+    name, str, name of the directory inside its parent directory
+    parentDirFd, int, open fd of the parent directory; if given, the
+        directory is opened relative to it, by name only
+    Returns the dir fd (int), or None if dir fds are not used/supported,
+    or the directory cannot be opened (abs paths are used then instead)
+    '''
+    if not(BaseFile.useDirFds):
+        return None
+    flags = os.O_RDONLY | getattr(os, "O_DIRECTORY", 0)
+    try:
+        if parentDirFd is None:
+            return os.open(absPath, flags)
+        return os.open(name, flags, dir_fd=parentDirFd)
+    except OSError:
+        logger.debug(f"Cannot open dir fd for '{absPath}'", exc_info=True)
+        return None
+
+def closeDirFd(dirFd):
+    if dirFd is not None:
+        os.close(dirFd)
 
 def getDirSnapshotAndAdapt(dirsDict, curSrcDir, lvlFromSrc, 
-                           topLevelAbsPath, mainDestAbsPath):
+                           topLevelAbsPath, mainDestAbsPath,
+                           srcParentFd=None, destParentFd=None,
+                           deferHashing=None):
     '''Argument directory of type BaseDir/SrcDir
+    srcParentFd/destParentFd (optional), int, open fds of the parent dirs
+        of curSrcDir in src and of its equivalent in dest; curSrcDir and
+        everything under it are then accessed relative to dir fds, instead
+        of re-resolving absolute paths for every entry
+    deferHashing (optional), function, if given, files are not hashed
+        during the snapshot; instead the function is called with every file
+        found (SrcFile object) and the abs path of its dir, e.g. to hand it
+        over to hashing workers
     '''
     logger.debug(f"Add '{curSrcDir.getRelPath()}' to snap lvl '{lvlFromSrc}'")
+    if lvlFromSrc == 0:
+        dirRenames.reset(topLevelAbsPath, mainDestAbsPath)
     if lvlFromSrc in dirsDict:
         dirsDict[lvlFromSrc].append(curSrcDir)
     else:
         dirsDict[lvlFromSrc] = [curSrcDir]
         
-    curAbsPath = os.path.join(topLevelAbsPath, curSrcDir.getRelPath())
-    curAbsPath = os.path.normpath(curAbsPath)
+    srcNode = pathNodes.dirOf(topLevelAbsPath, curSrcDir.getRelPath())
+    curAbsPath = srcNode.absPath
+    destRelPath = curSrcDir.getNewRelPathInDest() or curSrcDir.getRelPath()
+    destAbsPath = pathNodes.dirOf(mainDestAbsPath, destRelPath).absPath
+    srcDirFd = openDirFd(curAbsPath, curSrcDir.getName(), srcParentFd)
+    destDirFd = openDirFd(destAbsPath, os.path.basename(destAbsPath),
+                          destParentFd)
     logger.debug(f"Looking for dirs/files in '{curAbsPath}'")
-    with os.scandir(curAbsPath) as dirEntries:
-        for entry in dirEntries:
-            foundPath = os.path.normpath(entry.path)
-            if entry.is_file(follow_symlinks=False):
-                foundFile = SrcFile(foundPath)
-                lg1 = f"Found file  in '{curAbsPath}': "
-                lg2 = f" '{foundFile.getName()}' added to src snapshot"
-                logger.debug(lg1+lg2)
-                curSrcDir.addFileToDir(foundFile)
-            elif entry.is_dir(follow_symlinks=False):
-                newSrcDir = SrcDir(foundPath, topLevelAbsPath)
-                logger.debug(f"Src sub-dir found, '{newSrcDir.getName()}'")
-                if curSrcDir.getNewRelPathInDest():
-                    newSrcDir.setNewRelPathInDest(curSrcDir)
-                    lg0 = "Parent dir set up for different name in dest. "
-                    lg1 = "Therefore, this will be synced with different name "
-                    lg2 = "in the dest because of inherited naming conflict; "
-                    lg3 = f"original name: '{newSrcDir.getRelPath()}' "
-                    lg4 = f"-> '{newSrcDir.getNewRelPathInDest()}'"
-                    logger.error(lg0+lg1+lg2+lg3+lg4)
-                    newD = (os.path.join(mainDestAbsPath, 
-                                         newSrcDir.getNewRelPathInDest()))
-                    try:
-                        os.mkdir(newD)
-                        logger.info(f"Created dir '{newD}'")
-                    except Exception as e:
-                        lg1 = f"Syncing of '{foundPath}' expected to fail "
-                        lg2 = "because of unsolvable naming conflict"
-                        logger.critical(lg1+lg2, exc_info=True)
+    try:
+        with os.scandir(curAbsPath if srcDirFd is None else srcDirFd) \
+                as dirEntries:
+            for entry in dirEntries:
+                # entry names have no separators, see DirNode.filePath
+                foundPath = srcNode.filePath(entry.name)
+                if pathFilter.isActive() and pathFilter.excludes(
+                        entry.name if curSrcDir.getRelPath() == "." else
+                        os.path.join(curSrcDir.getRelPath(), entry.name),
+                        entry.is_dir(follow_symlinks=False)):
+                    logger.debug(f"Excluded from syncing: '{foundPath}'")
+                    continue
+                if entry.is_file(follow_symlinks=False):
+                    foundFile = SrcFile(foundPath, srcDirFd,
+                                        entry.stat(follow_symlinks=False),
+                                        hashNow=(deferHashing is None))
+                    if deferHashing:
+                        deferHashing(foundFile, curAbsPath)
+                    lg1 = f"Found file  in '{curAbsPath}': "
+                    lg2 = f" '{foundFile.getName()}' added to src snapshot"
+                    logger.debug(lg1+lg2)
+                    curSrcDir.addFileToDir(foundFile)
+                elif entry.is_dir(follow_symlinks=False):
+                    newSrcDir = SrcDir(foundPath, topLevelAbsPath,
+                                       entry.stat(follow_symlinks=False))
+                    logger.debug(f"Src sub-dir found, '{newSrcDir.getName()}'")
+                    if curSrcDir.getNewRelPathInDest():
+                        newSrcDir.setNewRelPathInDest(pickNewName, curSrcDir)
+                        lg0 = "Parent dir set up for different name in dest. "
+                        lg1 = "Therefore, this will be synced with different "
+                        lg2 = "name in the dest because of inherited naming "
+                        lg3 = f"conflict; original name: "
+                        lg4 = f"'{newSrcDir.getRelPath()}' -> "
+                        lg5 = f"'{newSrcDir.getNewRelPathInDest()}'"
+                        logger.error(lg0+lg1+lg2+lg3+lg4+lg5)
+                        newD = (os.path.join(mainDestAbsPath, 
+                                             newSrcDir.getNewRelPathInDest()))
+                        try:
+                            os.mkdir(relToDirFd(newD, destDirFd),
+                                     dir_fd=destDirFd)
+                            logger.info(f"Created dir '{newD}'")
+                            cycleMetrics.addChange("dir created")
+                            changeFeed.record("created", newD, isDir=True)
+                        except Exception as e:
+                            lg1 = f"Syncing of '{foundPath}' expected to fail "
+                            lg2 = "because of unsolvable naming conflict"
+                            logger.critical(lg1+lg2, exc_info=True)
+                    else:
+                        newSrcDir.destEquivalenceCheckAndAdapt(mainDestAbsPath,
+                                                               pickNewName,
+                                                               destDirFd)
+                    getDirSnapshotAndAdapt(dirsDict, newSrcDir,
+                                           lvlFromSrc + 1, topLevelAbsPath,
+                                           mainDestAbsPath,
+                                           srcDirFd, destDirFd, deferHashing)
                 else:
-                    newSrcDir.destEquivalenceCheckAndAdapt(mainDestAbsPath,
-                                                           pickNewName)
-                getDirSnapshotAndAdapt(dirsDict, newSrcDir, lvlFromSrc + 1, 
-                                       topLevelAbsPath, mainDestAbsPath)
-            else:
-                lg1 = "Found object is neither a file (unless link), "
-                lg2 = f"nor a dir: '{foundPath}' -> not added to snap!!!"
-                logger.warning(lg1+lg2)
+                    lg1 = "Found object is neither a file (unless link), "
+                    lg2 = f"nor a dir: '{foundPath}' -> not added to snap!!!"
+                    logger.warning(lg1+lg2)
+    finally:
+        closeDirFd(srcDirFd)
+        closeDirFd(destDirFd)
 
-def fetchExistingDestFiles(dirAbsPath, existingFiles, existingDirs):
+def fetchExistingDestFiles(dirAbsPath, existingFiles, existingDirs,
+                           parentDirFd=None, deferHashing=None, skipDirs=None,
+                           rootPath=None):
     '''Creates a dictionary, whose keys are hashed contents of files,
     and the values are tuples of (relativePath, fileOwner, owningUserGrp, \
                                   permission bits)
+    parentDirFd (optional), int, open fd of the parent dir of dirAbsPath;
+        if given, dirAbsPath is opened relative to it
+    deferHashing (optional), function, if given, files are neither hashed,
+        nor added to existingFiles; instead the function is called with every
+        file found (DestFile object) and the abs path of its dir
+    skipDirs (optional), set of dir abs paths, which are neither tracked,
+        nor looked into (unchanged subtrees, see SubtreeDigests)
+    rootPath (optional), str, abs path of the dest dir, which the paths
+        matched by pathFilter are relative to; dirAbsPath, if not given
+    Entries excluded by pathFilter are neither tracked, nor looked into, so
+    they are never removed.
     '''
+    rootPath = rootPath or dirAbsPath
+    if skipDirs and dirAbsPath in skipDirs:
+        logger.debug(f"Skipping unchanged '{dirAbsPath}'")
+        return
     logger.debug(f"Looking for dir/files in '{dirAbsPath}'")
-    with os.scandir(dirAbsPath) as dirEntries:
-        for entry in dirEntries:
-            foundPath = os.path.normpath(entry.path)
-            if entry.is_file(follow_symlinks=False):
-                fileFound = DestFile(foundPath)
-                logger.debug(f"File found, '{fileFound.getName()}'")
-                logger.debug(f"   at '{foundPath}'")
-                newKey = fileFound.getHash()
-                if newKey not in existingFiles:
-                    logger.debug("File is unique so far")
-                    existingFiles[newKey] = []
-                else:
-                    logger.debug("File is a duplicate of already found one(s)")
-                # logger.debug(f"Fild about to be added fro tracking: '{foundPath}'")
-                # apparently the string from inside the tupples inside the
-                # dict values get r'the path' at time of adding/retreiving?
-                existingFiles[newKey].append((foundPath, fileFound))
-                lg1 = "   File appended for tracking; "
-                lg2 = f"updated list:\n     {existingFiles[newKey]}\n"
-                logger.debug(lg1+lg2)
-            elif entry.is_dir(follow_symlinks=False):
-                logger.debug(f"Dir found, '{foundPath}', following it")
-                existingDirs.append(foundPath)
-                logger.debug(f"Dir appended for tracking:\n    {existingDirs}")
-                fetchExistingDestFiles(foundPath, existingFiles,
-                                       existingDirs)
-
-def clearExistingDestFiles(dirAbsPath, existingFiles, existingDirs):
+    dirFd = openDirFd(dirAbsPath, os.path.basename(dirAbsPath), parentDirFd)
+    try:
+        with os.scandir(dirAbsPath if dirFd is None else dirFd) as dirEntries:
+            for entry in dirEntries:
+                foundPath = os.path.join(dirAbsPath, entry.name)
+                if pathFilter.isActive() and pathFilter.excludes(
+                        foundPath[len(rootPath) + 1:],
+                        entry.is_dir(follow_symlinks=False)):
+                    logger.debug(f"Excluded, left in place: '{foundPath}'")
+                    continue
+                if entry.is_file(follow_symlinks=False) and \
+                        SrcFile.isTempName(entry.name):
+                    # left over by an interrupted copy, never a complete file
+                    lg1 = f"Removing temp file of an interrupted copy: "
+                    logger.warning(lg1 + f"'{foundPath}'")
+                    try:
+                        os.remove(relToDirFd(foundPath, dirFd), dir_fd=dirFd)
+                    except Exception as e:
+                        lg1 = f"Temp file cannot be removed: '{foundPath}'"
+                        logger.error(lg1, exc_info=True)
+                elif entry.is_file(follow_symlinks=False) and deferHashing:
+                    fileFound = DestFile(foundPath, dirFd,
+                                         entry.stat(follow_symlinks=False),
+                                         hashNow=False)
+                    deferHashing(fileFound, dirAbsPath)
+                elif entry.is_file(follow_symlinks=False):
+                    fileFound = DestFile(foundPath, dirFd,
+                                         entry.stat(follow_symlinks=False))
+                    logger.debug(f"File found, '{fileFound.getName()}'")
+                    logger.debug(f"   at '{foundPath}'")
+                    newKey = fileFound.getHash()
+                    if newKey not in existingFiles:
+                        logger.debug("File is unique so far")
+                        existingFiles[newKey] = []
+                    else:
+                        lg1 = "File is a duplicate of already found one(s)"
+                        logger.debug(lg1)
+                    # logger.debug(f"Fild about to be added fro tracking: '{foundPath}'")
+                    # apparently the string from inside the tupples inside the
+                    # dict values get r'the path' at time of adding/retreiving?
+                    existingFiles[newKey].append((foundPath, fileFound))
+                    lg1 = "   File appended for tracking; "
+                    lg2 = f"updated list:\n     {existingFiles[newKey]}\n"
+                    logger.debug(lg1+lg2)
+                elif entry.is_dir(follow_symlinks=False):
+                    if skipDirs and foundPath in skipDirs:
+                        logger.debug(f"Skipping unchanged '{foundPath}'")
+                        continue
+                    logger.debug(f"Dir found, '{foundPath}', following it")
+                    existingDirs.append(foundPath)
+                    logger.debug(f"Dir appended for tracking:\n    {existingDirs}")
+                    fetchExistingDestFiles(foundPath, existingFiles,
+                                           existingDirs, dirFd, deferHashing,
+                                           skipDirs, rootPath)
+    finally:
+        closeDirFd(dirFd)
+
+def clearExistingDestFiles(dirAbsPath, existingFiles, existingDirs,
+                           parentDirFd=None):
     '''Goes through a directory and it's children and stops tracking all
     paths (files and dirs) in existingFiles and existingDirs
     dirAbsPath, string - abs path to some tracked sub-dir in dest dir
     existingFiles, dict of {hashValue:list(tuples(fileAbsPath, File object))}
     existingDirs, list(destination dir relative paths)
+    parentDirFd (optional), int, open fd of the parent dir of dirAbsPath
     '''
     logger.debug(f"Chosing objects to stop tracking from '{dirAbsPath}'")
-    with os.scandir(dirAbsPath) as dirEntries:
-        for entry in dirEntries:
-            foundPath = os.path.normpath(entry.path)
-            if entry.is_file(follow_symlinks=False):
-                logger.debug(f"File found at '{foundPath}'")
-                fileFound = DestFile(foundPath)
-                h = fileFound.getHash()
-                toPop = []
-                try:
-                    for i in range(len(existingFiles[h])):
-                        # lg1 = f"About to compare dirAbsPath={dirAbsPath} with "
-                        # lg2 = f" path from file dict: {existingFiles[h][i]}\n"
-                        # lg3 = f"{os.path.normpath(dirAbsPath)}    vs     "
-                        # lg4 = f"{os.path.normpath(existingFiles[h][i][0])}"
-                        # logger.debug(lg1+lg2+lg3+lg4)
-                        logger.debug(f"Compare with {existingFiles[h][i]}")
-                        if dirAbsPath in os.path.normpath(existingFiles[h][i][0]):
-                            lg1 = "Picked for untracking: "
-                            logger.debug(lg1 + f"'{existingFiles[h][i][0]}'")
-                            toPop.append(i)
-                    for i in toPop:
-                        untracked = existingFiles[h].pop(i)[0]
-                        logger.debug(f"Stopped tracking of '{untracked}'")
-                        # logger.debug("Nothing cleared, probably cleared before")
-                except Exception as e:
-                    lg1 = "A file has been modified during syncing: "
-                    logger.critical(lg1 + f"'{foundPath}'", exc_info=True)
-            elif entry.is_dir(follow_symlinks=False):
-                # if sub dir is found remove it from tracked and look inside
-                lg1 = f"Dir found, stop tracking it and follow '{foundPath}'"
-                logger.debug(lg1)
-                existingDirs.remove(foundPath)
-                clearExistingDestFiles(foundPath, existingFiles, existingDirs)
+    dirFd = openDirFd(dirAbsPath, os.path.basename(dirAbsPath), parentDirFd)
+    try:
+        with os.scandir(dirAbsPath if dirFd is None else dirFd) as dirEntries:
+            for entry in dirEntries:
+                foundPath = os.path.join(dirAbsPath, entry.name)
+                if entry.is_file(follow_symlinks=False):
+                    logger.debug(f"File found at '{foundPath}'")
+                    fileFound = DestFile(foundPath, dirFd,
+                                         entry.stat(follow_symlinks=False))
+                    h = fileFound.getHash()
+                    toPop = []
+                    try:
+                        for i in range(len(existingFiles[h])):
+                            logger.debug(f"Compare with {existingFiles[h][i]}")
+                            if dirAbsPath in os.path.normpath(existingFiles[h][i][0]):
+                                lg1 = "Picked for untracking: "
+                                logger.debug(lg1 + f"'{existingFiles[h][i][0]}'")
+                                toPop.append(i)
+                        for i in reversed(toPop):
+                            untracked = existingFiles[h].pop(i)[0]
+                            logger.debug(f"Stopped tracking of '{untracked}'")
+                    except Exception as e:
+                        lg1 = "A file has been modified during syncing: "
+                        logger.critical(lg1 + f"'{foundPath}'", exc_info=True)
+                elif entry.is_dir(follow_symlinks=False):
+                    if foundPath not in existingDirs:
+                        # never tracked, e.g. excluded (see PathFilter)
+                        continue
+                    # if sub dir is found remove it from tracked and look inside
+                    lg1 = f"Dir found, stop tracking it and follow '{foundPath}'"
+                    logger.debug(lg1)
+                    existingDirs.remove(foundPath)
+                    clearExistingDestFiles(foundPath, existingFiles,
+                                           existingDirs, dirFd)
+    finally:
+        closeDirFd(dirFd)
 
 
 def timeString(timestamp):
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+
+from helpingFuncs import invInput
+from helpingClasses import syncJournal, changeFeed
+from destBackends import SyncReceiver
+from startSyncing import setUpLogging
+
+def printHelp():
+    print("Receives the content synced by startSyncing.py run with ", end='')
+    print("'--dest tcp://HOST:PORT',")
+    print("and keeps the destination directory on this host in sync.")
+    print("There is no authentication, nor encryption; only listen on ", end='')
+    print("trusted networks.")
+    print()
+    print("  Usage:", sys.argv[0], "--dest DIRECTORY --port INTEGER_NUMBER ", end='')
+    print("--logFile FILE")
+    print()
+    print("    --dest DIRECTORY, the path to the replica directory")
+    print("    --port INTEGER_NUMBER, TCP port to listen on")
+    print("    --logFile FILE, path to log file - file will be overwritten!")
+    print()
+    print("  Optional arguments:")
+    print("    --bind ADDRESS, address to listen on (default 127.0.0.1)")
+    print("    --journal FILE|none, journal of the hashing/copying done, ", end='')
+    print("keeping the hash")
+    print("        index of the destination across restarts, defaults to ", end='')
+    print("the log file path")
+    print("        with '.journal' appended; 'none' disables journaling")
+    print("    --changeFeed FILE, appends the changes done in the ", end='')
+    print("destination by every")
+    print("        session to FILE, as JSON lines with sequence numbers")
+    sys.exit(0)
+
+def validateReceiverInput(av):
+    '''Validates command line arguments, refer to printHelp for details.
+    Creates the dest dir, if it doesn't exist.
+    Returns a dict of {argument name without leading dashes: value}
+    '''
+    c = av[0]
+    opts = {"dest": None, "port": None, "logFile": None,
+            "bind": "127.0.0.1", "journal": None, "changeFeed": None}
+    if len(av) % 2 != 1:
+        print("Number of arguments incorrect.")
+        invInput(c)
+    for i in range(1, len(av), 2):
+        name = av[i][2:]
+        if not(av[i].startswith("--")) or name not in opts:
+            print(f"Unknown argument '{av[i]}'")
+            invInput(c)
+        opts[name] = av[i+1]
+    if None in (opts["dest"], opts["port"], opts["logFile"]):
+        print("Mandatory arguments supplied incorrectly")
+        invInput(c)
+    try:
+        opts["port"] = int(opts["port"])
+        if not(0 < opts["port"] < 65536):
+            raise ValueError("Port out of range")
+    except ValueError:
+        print("Supplied port should be an int in 1..65535")
+        invInput(c)
+    opts["dest"] = os.path.realpath(opts["dest"])
+    try:
+        os.makedirs(opts["dest"], exist_ok=True)
+    except OSError as e:
+        print(e)
+        print("Replica dir doesn't exist and could not be created")
+        sys.exit(-1)
+    opts["logFile"] = os.path.abspath(opts["logFile"])
+    logFileLocation = os.path.realpath(os.path.split(opts["logFile"])[0])
+    if opts["dest"] in logFileLocation:
+        print("Log file cannot be located in the dest directory")
+        sys.exit(-1)
+    if opts["changeFeed"] is not None:
+        opts["changeFeed"] = os.path.abspath(opts["changeFeed"])
+        if opts["dest"] in os.path.realpath(os.path.split(
+                opts["changeFeed"])[0]):
+            print("Change feed cannot be located in the dest directory")
+            sys.exit(-1)
+    if opts["journal"] is None:
+        opts["journal"] = opts["logFile"] + ".journal"
+    elif opts["journal"].lower() == "none":
+        opts["journal"] = None
+    return opts
+
+def main():
+    if "-h" in sys.argv or "--help" in sys.argv:
+        printHelp()
+    opts = validateReceiverInput(sys.argv)
+    logger = setUpLogging(opts["logFile"])
+    logger.info(f"  Destination directory for the sync: '{opts['dest']}'")
+    logger.info(f"  Listening on {opts['bind']}:{opts['port']}")
+    if opts["journal"]:
+        logger.info(f"  Journal: '{opts['journal']}'")
+        replayed, interrupted = syncJournal.open(opts["journal"])
+        if replayed:
+            logger.info(f"Hash index restored from journal ({replayed} records)")
+    if opts["changeFeed"]:
+        logger.info(f"  Change feed: '{opts['changeFeed']}'")
+        changeFeed.open(opts["changeFeed"], opts["dest"])
+    receiver = SyncReceiver(opts["dest"], opts["bind"], opts["port"])
+    receiver.serveForever()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,588 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import sqlite3
+import stat
+
+try:
+    import resource # posix only, used to report the peak memory use
+except ImportError:
+    resource = None
+
+from helpingClasses import SrcFile, DestFile, bulkDeleter, cycleMetrics
+from helpingClasses import hashCache, ioThrottle, changeFeed, copyOrdering
+from helpingClasses import pathFilter, fileStability, cycleBudget
+from helpingClasses import storageProfile
+from destBackends import stageDirName
+
+logger = logging.getLogger(f"main.{__name__}")
+
+# rows per insert/update batch, every batch is a single transaction
+batchSize = 10000
+# page cache of the index db (KiB); together with batchSize, this is what
+# bounds the memory used by an indexed cycle, whatever the tree size
+cacheSizeKiB = 64 * 1024
+
+schema = \
+'''CREATE TABLE IF NOT EXISTS files (side TEXT, path TEXT, hash TEXT,
+    size INTEGER, mtimeNs INTEGER, inode INTEGER, mode INTEGER, uid INTEGER,
+    gid INTEGER, PRIMARY KEY (side, path));
+CREATE INDEX IF NOT EXISTS filesByHash ON files (side, hash, size);
+CREATE TABLE IF NOT EXISTS dirs (side TEXT, path TEXT, depth INTEGER,
+    PRIMARY KEY (side, path));
+CREATE TABLE IF NOT EXISTS scan (path TEXT PRIMARY KEY, hash TEXT,
+    size INTEGER, mtimeNs INTEGER, inode INTEGER, mode INTEGER, uid INTEGER,
+    gid INTEGER);
+CREATE VIEW IF NOT EXISTS srcMissing AS SELECT s.* FROM files s
+    WHERE s.side = 'src' AND NOT EXISTS (SELECT 1 FROM files d
+    WHERE d.side = 'dest' AND d.path = s.path AND d.hash = s.hash);
+CREATE VIEW IF NOT EXISTS destObsolete AS SELECT d.* FROM files d
+    WHERE d.side = 'dest' AND NOT EXISTS (SELECT 1 FROM files s
+    WHERE s.side = 'src' AND s.path = d.path AND s.hash = d.hash);
+'''
+
+# the plan of a cycle, materialized (on disk) before anything is changed
+planSchema = \
+'''DROP TABLE IF EXISTS temp.planStage;
+DROP TABLE IF EXISTS temp.planRemove;
+DROP TABLE IF EXISTS temp.planRmdir;
+DROP TABLE IF EXISTS temp.planMkdir;
+DROP TABLE IF EXISTS temp.planModes;
+CREATE TEMP TABLE planStage AS SELECT hash, MIN(path) AS path,
+    NULL AS staged FROM destObsolete
+    WHERE hash IN (SELECT hash FROM srcMissing) GROUP BY hash;
+CREATE INDEX temp.planStageByHash ON planStage (hash);
+CREATE TEMP TABLE planRemove AS SELECT path FROM destObsolete
+    WHERE path NOT IN (SELECT path FROM planStage);
+CREATE TEMP TABLE planRmdir AS SELECT path, depth FROM dirs d
+    WHERE d.side = 'dest' AND NOT EXISTS (SELECT 1 FROM dirs s
+    WHERE s.side = 'src' AND s.path = d.path) ORDER BY depth DESC;
+CREATE TEMP TABLE planMkdir AS SELECT path, depth FROM dirs s
+    WHERE s.side = 'src' AND NOT EXISTS (SELECT 1 FROM dirs d
+    WHERE d.side = 'dest' AND d.path = s.path) ORDER BY depth;
+CREATE TEMP TABLE planModes AS SELECT s.path FROM files s JOIN files d
+    ON d.side = 'dest' AND d.path = s.path AND d.hash = s.hash
+    WHERE s.side = 'src' AND (s.mode != d.mode OR s.uid != d.uid
+    OR s.gid != d.gid);
+'''
+
+
+class SnapshotIndex(object):
+    '''SQLite index of the src and dest snapshots, used instead of the in
+    memory snapshots (SrcDir/SrcFile objects, existingDestFiles), once the
+    number of src entries exceeds a threshold, so that the memory use does
+    not grow with the tree size (see runIndexedCycle).
+    Files are indexed by relative path, and by hash value and size. The
+    index is kept between cycles and runs: a file, whose size,
+    modification time and inode are the same as in the last cycle, keeps
+    its hash value (the index replaces the hash cache in indexed cycles).
+    A single module level object (snapshotIndex) is used by the main loop;
+    until it is set up, it is never used.
+    '''
+
+    def __init__(self):
+        self.path = None
+        self.db = None
+        self.threshold = None # number of src entries (files and dirs)
+        self.lastCount = None # src entries found by the last cycle
+        self.unstable = [] # src relPaths being written, see holdUnstable
+
+    def setUp(self, path, threshold):
+        '''path, str, location of the index db, created once needed
+        threshold, int, src entries above which cycles are indexed
+        '''
+        self.path = path
+        self.threshold = threshold
+
+    def connect(self):
+        '''Opens (creates) the index db, if not done yet
+        '''
+        if self.db is not None:
+            return
+        self.db = sqlite3.connect(self.path)
+        # the index can always be rebuilt from the trees, so there is no
+        # need to sync it to disk on every commit
+        self.db.execute("PRAGMA synchronous = OFF")
+        self.db.execute(f"PRAGMA cache_size = -{cacheSizeKiB}")
+        self.db.execute("PRAGMA temp_store = FILE")
+        self.db.executescript(schema)
+        # src files postponed by the cycle budget (moved, if found at
+        # another path by the last cycle), see holdUnstable
+        self.db.execute("CREATE TEMP TABLE IF NOT EXISTS held (path TEXT "
+                        "PRIMARY KEY, inode INTEGER, moved INTEGER)")
+
+    def shouldUse(self, srcDirPath):
+        '''Returns True, if the next cycle is to be run on the index
+        '''
+        if self.path is None:
+            return False
+        if self.lastCount is None and os.path.exists(self.path):
+            # an index left by an earlier run
+            self.connect()
+            count = self.db.execute("SELECT COUNT(*) FROM files WHERE "
+                                    "side = 'src'").fetchone()[0]
+            if count:
+                self.lastCount = count + self.db.execute(
+                    "SELECT COUNT(*) FROM dirs WHERE side = 'src'"
+                    ).fetchone()[0]
+        if self.lastCount is None:
+            # the first cycle ever: count the entries before deciding, as
+            # an in memory cycle might not fit
+            self.lastCount = countEntries(srcDirPath)
+        return self.lastCount > self.threshold
+
+    def noteEntries(self, count):
+        '''count, int, number of src entries found by an in memory cycle
+        '''
+        self.lastCount = count
+
+    def insertBatches(self, sql, rows):
+        '''Inserts/updates rows (iterable of tuples) with sql, batchSize
+        rows per transaction
+        '''
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batchSize:
+                with self.db:
+                    self.db.executemany(sql, batch)
+                batch = []
+        if batch:
+            with self.db:
+                self.db.executemany(sql, batch)
+
+    def selectBatches(self, sql, args=()):
+        '''Yields the rows of sql (a select of rowid first, from a table
+        which is not modified meanwhile), fetched batchSize rows at a time
+        by rowid, so that no cursor is kept open across modifications
+        '''
+        lastRowId = -1
+        while True:
+            rows = self.db.execute(sql + " AND rowid > ? ORDER BY rowid "
+                                   "LIMIT ?", args + (lastRowId, batchSize)
+                                   ).fetchall()
+            if not(rows):
+                return
+            lastRowId = rows[-1][0]
+            for row in rows:
+                yield row[1:]
+
+    def scan(self, side, rootPath):
+        '''Lists rootPath(str) into the index as side ('src' or 'dest'),
+        hashing the files which are new or changed since the last cycle.
+        Src files being written (see FileStability), or postponed by the
+        cycle budget (hashed in its order, see CycleBudget), are left out,
+        and noted for holdUnstable; so are the paths, which a postponed file
+        was found at by the last cycle (same inode), if it has been moved
+        (e.g. its dir renamed).
+        Returns the number of entries (files and dirs) found
+        '''
+        with self.db:
+            self.db.execute("DELETE FROM scan")
+            self.db.execute("DELETE FROM dirs WHERE side = ?", (side,))
+        logger.info(f"Indexing the {side} dir '{rootPath}'")
+        dirCount = [0]
+        def listDirs(dirRows):
+            for relPath in dirRows:
+                dirCount[0] += 1
+                yield (side, relPath, relPath.count(os.sep))
+        dirRows = []
+        self.insertBatches("INSERT INTO scan (path, size, mtimeNs, inode, "
+                           "mode, uid, gid) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                           walkTree(side, rootPath, dirRows))
+        self.insertBatches("INSERT INTO dirs VALUES (?, ?, ?)",
+                           listDirs(dirRows))
+        with self.db:
+            self.db.execute(
+                "UPDATE scan SET hash = (SELECT f.hash FROM files f WHERE "
+                "f.side = ? AND f.path = scan.path AND f.size = scan.size AND "
+                "f.mtimeNs = scan.mtimeNs AND f.inode = scan.inode)", (side,))
+        budgeted = side == "src" and cycleBudget.isActive()
+        orderBy, orderArgs = cycleBudget.orderBy() if budgeted \
+            else ("inode" if storageProfile.rotational else "rowid", ())
+        with self.db:
+            self.db.execute("DROP TABLE IF EXISTS temp.toHash")
+            self.db.execute("CREATE TEMP TABLE toHash AS SELECT path, size, "
+                            "mtimeNs, inode FROM scan WHERE hash IS NULL "
+                            "ORDER BY " + orderBy, orderArgs)
+        toHash = self.db.execute("SELECT COUNT(*) FROM toHash").fetchone()[0]
+        logger.info(f"Hashing {toHash} new/changed {side} files")
+        hashed, vanished, held = [], [], []
+        for relPath, size, mtimeNs, inode in self.selectBatches(
+                "SELECT rowid, path, size, mtimeNs, inode FROM toHash "
+                "WHERE 1"):
+            absPath = os.path.join(rootPath, relPath)
+            if side == "src" and fileStability.isTooRecent(mtimeNs):
+                self.unstable.append(relPath)
+                vanished.append((relPath,))
+            elif budgeted and not(cycleBudget.take(relPath, size, mtimeNs)):
+                held.append((relPath, inode))
+                vanished.append((relPath,))
+            else:
+                try:
+                    f = SrcFile(absPath, hashNow=False)
+                    hashHex = f.calculateHash(os.path.dirname(absPath))
+                    after = os.stat(absPath)
+                    if side == "src" and (size, mtimeNs, inode) != \
+                            (after.st_size, after.st_mtime_ns, after.st_ino):
+                        logger.info(f"'{absPath}' was modified while being "
+                                    f"listed/hashed")
+                        self.unstable.append(relPath)
+                        vanished.append((relPath,))
+                    else:
+                        hashed.append((hashHex, relPath))
+                except OSError as e:
+                    logger.error(f"Could NOT hash '{absPath}'", exc_info=True)
+                    vanished.append((relPath,))
+            if len(hashed) + len(vanished) >= batchSize:
+                self.updateScan(hashed, vanished, held)
+                hashed, vanished, held = [], [], []
+        self.updateScan(hashed, vanished, held)
+        if budgeted:
+            cycleBudget.finish()
+            with self.db:
+                self.db.execute(
+                    "INSERT OR IGNORE INTO held SELECT f.path, f.inode, 1 "
+                    "FROM files f WHERE f.side = 'src' AND f.inode IN "
+                    "(SELECT inode FROM held) AND f.path NOT IN (SELECT path "
+                    "FROM scan)")
+        with self.db:
+            self.db.execute("DROP TABLE temp.toHash")
+            self.db.execute("DELETE FROM files WHERE side = ?", (side,))
+            self.db.execute("INSERT INTO files SELECT ?, * FROM scan",
+                            (side,))
+            self.db.execute("DELETE FROM scan")
+        fileCount = self.db.execute("SELECT COUNT(*) FROM files WHERE side = ?",
+                                    (side,)).fetchone()[0]
+        return fileCount + dirCount[0]
+
+    def updateScan(self, hashed, vanished, held):
+        with self.db:
+            self.db.executemany("UPDATE scan SET hash = ? WHERE path = ?",
+                                hashed)
+            self.db.executemany("DELETE FROM scan WHERE path = ?", vanished)
+            self.db.executemany("INSERT OR IGNORE INTO held VALUES "
+                                "(?, ?, 0)", held)
+
+    def holdUnstable(self):
+        '''Keeps the dest files at the paths of the src files being written
+        or postponed (see scan) in place, by giving those src paths the hash
+        value of the dest file (and an mtime never found, so that they are
+        hashed again next cycle). The dirs of the paths a postponed file
+        was moved from are kept as well. To be called once both sides are
+        scanned.
+        Returns the list of the src relPaths being written
+        '''
+        unstable, self.unstable = self.unstable, []
+        self.insertBatches(
+            "INSERT OR REPLACE INTO files SELECT 'src', path, hash, size, -1, "
+            "inode, mode, uid, gid FROM files WHERE side = 'dest' AND "
+            "path = ?", ((relPath,) for relPath in unstable))
+        # the inode of the src file is kept, so that it is found again, if
+        # it is still postponed next cycle
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO files SELECT 'src', d.path, d.hash, "
+                "d.size, -1, h.inode, d.mode, d.uid, d.gid FROM files d JOIN "
+                "held h ON h.path = d.path WHERE d.side = 'dest'")
+        movedFromDirs = set()
+        for (relPath,) in self.selectBatches(
+                "SELECT rowid, path FROM held WHERE moved = 1"):
+            relDir = os.path.dirname(relPath)
+            while relDir and relDir not in movedFromDirs:
+                movedFromDirs.add(relDir)
+                relDir = os.path.dirname(relDir)
+        self.insertBatches(
+            "INSERT OR IGNORE INTO dirs SELECT 'src', path, depth FROM dirs "
+            "WHERE side = 'dest' AND path = ?",
+            ((relDir,) for relDir in movedFromDirs))
+        with self.db:
+            self.db.execute("DELETE FROM held")
+        return unstable
+
+    def findInPlace(self, hashHex):
+        '''Returns the relPath (str) of a dest file with the content hashHex
+        in place (at the path of a src file with it), or None
+        '''
+        row = self.db.execute(
+            "SELECT d.path FROM files d JOIN files s ON s.side = 'src' AND "
+            "s.path = d.path AND s.hash = d.hash WHERE d.side = 'dest' AND "
+            "d.hash = ? LIMIT 1", (hashHex,)).fetchone()
+        return row[0] if row else None
+
+    def recordDestFiles(self, rows):
+        '''rows, iterable of tuples (relPath, hashHex, os.stat_result) of
+        dest files just placed
+        '''
+        self.insertBatches(
+            "INSERT OR REPLACE INTO files VALUES ('dest', ?, ?, ?, ?, ?, ?, "
+            "?, ?)", ((relPath, hashHex, st.st_size, st.st_mtime_ns,
+                       st.st_ino, stat.S_IMODE(st.st_mode), st.st_uid,
+                       st.st_gid) for relPath, hashHex, st in rows))
+
+    def forgetDestFiles(self, relPaths):
+        self.insertBatches("DELETE FROM files WHERE side = 'dest' AND "
+                           "path = ?", ((p,) for p in relPaths))
+
+
+snapshotIndex = SnapshotIndex()
+
+
+def walkTree(side, rootPath, dirRows):
+    '''Yields tuples (relPath, size, mtime ns, inode, mode, uid, gid) of the
+    files under rootPath(str), appending the dir relPaths to dirRows.
+    Symbolic links, entries excluded by pathFilter and the staging dir are
+    ignored; in dest, temp files of interrupted copies are removed.
+    '''
+    pending = [""]
+    while pending:
+        relDir = pending.pop()
+        absDir = os.path.join(rootPath, relDir) if relDir else rootPath
+        try:
+            with os.scandir(absDir) as it:
+                for entry in it:
+                    relPath = os.path.join(relDir, entry.name)
+                    # the staging dir name is reserved, also in src
+                    if entry.is_symlink() or relPath == stageDirName or \
+                            pathFilter.excludes(relPath, entry.is_dir()):
+                        continue
+                    if entry.is_dir():
+                        dirRows.append(relPath)
+                        pending.append(relPath)
+                    elif side == "dest" and \
+                            SrcFile.isTempName(entry.name):
+                        logger.warning(f"Removing temp file of an interrupted "
+                                       f"copy: '{entry.path}'")
+                        os.remove(entry.path)
+                    elif entry.is_file():
+                        st = entry.stat(follow_symlinks=False)
+                        yield (relPath, st.st_size, st.st_mtime_ns, st.st_ino,
+                               stat.S_IMODE(st.st_mode), st.st_uid, st.st_gid)
+        except OSError as e:
+            logger.error(f"Could NOT list dir '{absDir}'", exc_info=True)
+
+def countEntries(rootPath):
+    '''Returns the number of files and dirs under rootPath(str), without
+    stat-ing them
+    '''
+    count = 0
+    pending = [rootPath]
+    while pending:
+        try:
+            with os.scandir(pending.pop()) as it:
+                for entry in it:
+                    count += 1
+                    if entry.is_dir(follow_symlinks=False):
+                        pending.append(entry.path)
+        except OSError:
+            continue
+    return count
+
+def runIndexedCycle(srcDirPath, destDirPath, index=None):
+    '''Runs a sync cycle working through queries on the index (see
+    SnapshotIndex) rather than on in memory snapshots:
+        1. src and dest are listed and hashed into the index;
+        2. the plan is materialized in (on disk) tables: the dest files,
+            whose content is needed at another path (one per hash value),
+            the obsolete dest files and dirs, the missing dest dirs, the src
+            files missing in dest and the files with another mode/owner;
+        3. dest files needed elsewhere are set aside in the staging dir,
+            obsolete dest files and dirs are removed (see BulkDeleter),
+            missing dirs created;
+        4. missing files are moved from the staging dir (first path of a
+            content) or copied from src, in the order of the copy order
+            policy (see CopyOrdering), then modes/owners are fixed;
+        5. src files being written are copied by a follow-up pass, once
+            settled (see FileStability).
+    All of it is done in batches, so the memory used does not depend on
+    the tree size. Like with a remote dest, naming conflicts are resolved
+    by removing or staging whatever is in the way; hard links, dir rename
+    detection and subtree digests are not used in indexed cycles.
+    '''
+    index = index or snapshotIndex
+    index.connect()
+    srcCount = index.scan("src", srcDirPath)
+    index.scan("dest", destDirPath)
+    index.noteEntries(srcCount)
+    for relPath in index.holdUnstable():
+        try:
+            fileStability.defer(
+                SrcFile(os.path.join(srcDirPath, relPath), hashNow=False),
+                os.path.join(srcDirPath, relPath),
+                os.path.join(destDirPath, relPath))
+        except OSError as e:
+            logger.debug(f"Src file vanished: '{relPath}'", exc_info=True)
+    db = index.db
+    db.executescript(planSchema)
+    orderBy, orderArgs = placeOrderBy()
+    with db:
+        db.execute("DROP TABLE IF EXISTS temp.planPlace")
+        db.execute("CREATE TEMP TABLE planPlace AS SELECT path, hash FROM "
+                   "srcMissing ORDER BY " + orderBy, orderArgs)
+
+    logger.info("Setting aside dest files needed at other paths")
+    stageDirPath = os.path.join(destDirPath, stageDirName)
+    staged, unstaged = [], []
+    stageCount = 0
+    for hashHex, relPath in index.selectBatches(
+            "SELECT rowid, hash, path FROM planStage WHERE 1"):
+        stageCount += 1
+        stagedAbsPath = os.path.join(stageDirPath, str(stageCount))
+        try:
+            os.makedirs(stageDirPath, exist_ok=True)
+            ioThrottle.throttleOp()
+            os.rename(os.path.join(destDirPath, relPath), stagedAbsPath)
+            staged.append((stagedAbsPath, hashHex))
+        except OSError as e:
+            logger.error(f"Could NOT stage '{relPath}'", exc_info=True)
+            unstaged.append((hashHex,))
+        if len(staged) + len(unstaged) >= batchSize:
+            updateStaged(db, staged, unstaged)
+            staged, unstaged = [], []
+    updateStaged(db, staged, unstaged)
+    index.forgetDestFiles(p for (p,) in index.selectBatches(
+        "SELECT rowid, path FROM planStage WHERE 1"))
+
+    logger.info("Removing obsolete destination files")
+    for batch in batched(index.selectBatches(
+            "SELECT rowid, path FROM planRemove WHERE 1")):
+        removed = bulkDeleter.removeFiles(
+            [os.path.join(destDirPath, p) for (p,) in batch])
+        index.forgetDestFiles(os.path.relpath(p, destDirPath)
+                              for p in removed)
+    logger.info("Removing obsolete destination directories")
+    for batch in batched(index.selectBatches(
+            "SELECT rowid, path FROM planRmdir WHERE 1")):
+        bulkDeleter.removeDirs([os.path.join(destDirPath, p)
+                                for (p,) in batch])
+    for (relPath,) in index.selectBatches(
+            "SELECT rowid, path FROM planMkdir WHERE 1"):
+        absPath = os.path.join(destDirPath, relPath)
+        try:
+            os.mkdir(absPath)
+            logger.info(f"Created new dir in dest: '{absPath}'")
+            cycleMetrics.addChange("dir created")
+            changeFeed.record("created", absPath, isDir=True)
+        except OSError as e:
+            logger.error(f"Dir cannot be created: '{absPath}'", exc_info=True)
+
+    logger.info("Moving/copying the files missing in dest")
+    placed = []
+    placedNow = {} # {hashHex: relPath} placed, not yet recorded in files
+    for relPath, hashHex in index.selectBatches(
+            "SELECT rowid, path, hash FROM planPlace WHERE 1"):
+        srcAbsPath = os.path.join(srcDirPath, relPath)
+        destAbsPath = os.path.join(destDirPath, relPath)
+        try:
+            srcF = SrcFile(srcAbsPath, hashNow=False)
+        except OSError as e:
+            logger.error(f"Src file vanished: '{srcAbsPath}'", exc_info=True)
+            continue
+        srcF.hashHex = hashHex
+        stagedAbsPath = takeStaged(db, hashHex)
+        if stagedAbsPath:
+            destF = DestFile(stagedAbsPath, hashNow=False)
+            destF.hashHex = hashHex
+            synced = destF.mvFile(stagedAbsPath, destAbsPath)
+            if synced:
+                srcF.chmodChownFile(destAbsPath)
+        else:
+            fromRelPath = placedNow.get(hashHex) or \
+                index.findInPlace(hashHex)
+            synced = None
+            if fromRelPath and SrcFile.cloneMode != "none":
+                synced = srcF.wrapCloneChmodChown(
+                    os.path.join(destDirPath, fromRelPath), destAbsPath)
+            if not(synced):
+                synced = srcF.wrapCpChmodChown(srcAbsPath, destAbsPath)
+            # the index keeps the hash value, not the (in memory) cache
+            hashCache.forget(destAbsPath)
+        if synced:
+            try:
+                placed.append((relPath, hashHex, os.stat(destAbsPath)))
+                placedNow.setdefault(hashHex, relPath)
+            except OSError:
+                pass
+        if len(placed) >= batchSize:
+            index.recordDestFiles(placed)
+            placed = []
+            placedNow = {}
+    index.recordDestFiles(placed)
+
+    for (relPath,) in index.selectBatches(
+            "SELECT rowid, path FROM planModes WHERE 1"):
+        try:
+            srcF = SrcFile(os.path.join(srcDirPath, relPath), hashNow=False)
+            srcF.chmodChownFile(os.path.join(destDirPath, relPath))
+        except OSError as e:
+            logger.error(f"Could NOT fix mode of '{relPath}'", exc_info=True)
+    with db:
+        db.execute("UPDATE files SET mode = (SELECT s.mode FROM files s WHERE "
+                   "s.side = 'src' AND s.path = files.path), uid = (SELECT "
+                   "s.uid FROM files s WHERE s.side = 'src' AND s.path = "
+                   "files.path), gid = (SELECT s.gid FROM files s WHERE "
+                   "s.side = 'src' AND s.path = files.path) WHERE side = "
+                   "'dest' AND path IN (SELECT path FROM planModes)")
+
+    if os.path.isdir(stageDirPath):
+        bulkDeleter.removeFiles([os.path.join(stageDirPath, name)
+                                 for name in os.listdir(stageDirPath)])
+        bulkDeleter.removeDirs([stageDirPath])
+    # files being written, once settled
+    fileStability.runFollowUp()
+    if resource:
+        peakKiB = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        logger.info(f"Indexed cycle done, peak memory use {peakKiB} KiB")
+    logger.info("Source files considered synced, see log file for details")
+
+def placeOrderBy():
+    '''Returns a tuple (ORDER BY clause, its parameters) ordering the
+    src files missing in dest by the copy order policy (see CopyOrdering)
+    '''
+    globs = copyOrdering.priorityGlobs
+    clause = ""
+    if globs:
+        clause = "CASE " + " ".join(f"WHEN path GLOB ? THEN {i}"
+                                    for i in range(len(globs)))
+        clause += f" ELSE {len(globs)} END, "
+    if copyOrdering.policy == "recent":
+        clause += "mtimeNs DESC, "
+    elif copyOrdering.policy == "smallest":
+        clause += "size, "
+    elif copyOrdering.policy == "physical":
+        # approximated by the inode number (files created together tend to
+        # be allocated together), as the extents are not indexed
+        clause += "inode, "
+    return (clause + "path", tuple(globs))
+
+def batched(rows):
+    '''Groups rows (iterable) in lists of batchSize
+    '''
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batchSize:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def updateStaged(db, staged, unstaged):
+    with db:
+        db.executemany("UPDATE planStage SET staged = ? WHERE hash = ?",
+                       staged)
+        db.executemany("DELETE FROM planStage WHERE hash = ?", unstaged)
+
+def takeStaged(db, hashHex):
+    '''Returns the abs path of the staged dest file with hashHex, or None;
+    a staged file is taken only once
+    '''
+    row = db.execute("SELECT staged FROM planStage WHERE hash = ?",
+                     (hashHex,)).fetchone()
+    if not(row) or row[0] is None:
+        return None
+    with db:
+        db.execute("UPDATE planStage SET staged = NULL WHERE hash = ?",
+                   (hashHex,))
+    return row[0]
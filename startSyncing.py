@@ -1,16 +1,33 @@
 
 # -*- coding: utf-8 -*-
 
+import contextlib
+import io
 import logging
-import time
+import threading
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
-from helpingFuncs import printHelp, validateInput
+from helpingFuncs import printHelp, validateInput, validateOptionalInput
 from helpingFuncs import pickNewName, getCurrentTime, endSyncCycle 
 from helpingFuncs import getDirSnapshotAndAdapt
 from helpingFuncs import fetchExistingDestFiles, clearExistingDestFiles
-from helpingClasses import SrcDir
+from helpingFuncs import openDirFd, closeDirFd, parseRemoteDest
+from helpingFuncs import orderHashing, isHashingOrdered, defaultWorkers
+from helpingFuncs import optionalArgs
+from helpingClasses import SrcDir, SrcFile, SyncScheduler, ReplicaScrubber
+from helpingClasses import cycleMetrics
+from helpingClasses import hashCache, syncJournal, ioThrottle, subtreeDigests
+from helpingClasses import bulkDeleter, changeFeed, copyOrdering, pathFilter
+from helpingClasses import fileStability, cycleBudget, storageProfile
+from helpingClasses import pathNodes
+from syncPipeline import runPipelinedCycle
+from destBackends import LocalDestBackend, RemoteDestBackend
+from destBackends import syncToBackend, syncToBackends
+from snapshotIndex import snapshotIndex, runIndexedCycle
+
+logger = logging.getLogger("main")
 
 def setUpLogging(logFile):
     '''Set up for logging go console and to a log file specified as arg.
@@ -36,6 +53,559 @@ def setUpLogging(logFile):
     return logger
 
 
+def takeSnapshots(srcDirPath, destDirPath):
+    '''Takes a snapshot of the source dir, adapting the dest dir structure
+    on the way, and then a snapshot of the adapted dest dir (steps 4. and 5.
+    in main)
+    Returns tuple (srcSnap, existingDestFiles, existingDestDirs), where
+    srcSnap is a dict of {level under src: list(SrcDir objects)},
+    existingDestFiles a dict of {hashValue:list(tuples(fileAbsPath, File))}
+    and existingDestDirs a list of dest dir abs paths
+    '''
+    logger.info("Getting snapshot of the source dir and adapting dest dir")
+    srcSnap = dict()
+    srcDir = SrcDir(srcDirPath, srcDirPath)
+    if isHashingOrdered():
+        # files are hashed once all are listed, see orderHashing
+        listed = []
+        getDirSnapshotAndAdapt(srcSnap, srcDir, 0,
+                               srcDirPath, destDirPath,
+                               deferHashing=lambda f, d: listed.append((f, d)))
+        for f, dirAbsPath in orderHashing(listed, srcDirPath):
+            try:
+                f.hashFile(dirAbsPath)
+            except Exception as e:
+                lg1 = f"Could NOT hash '{f.getName()}' in '{dirAbsPath}'"
+                logger.error(lg1, exc_info=True)
+                f.postponed = True
+    else:
+        getDirSnapshotAndAdapt(srcSnap, srcDir, 0,
+                               srcDirPath, destDirPath)
+    # # printing content of directories to be synced    
+    # for depth in range(0, max(srcSnap.keys()) + 1):
+    #     for d in srcSnap[depth]:
+    #         print(d)
+
+    # subtrees identical in src and dest are left out from here on
+    skipDirs = subtreeDigests.findUnchanged(srcSnap, destDirPath)
+
+    # next phase: snapshot of dest dir after adapting, so it's up-to-date
+    logger.info("Getting snapshot of the adapted state of dest dir")
+    existingDestFiles = {}
+    existingDestDirs = []
+    fetchExistingDestFiles(destDirPath, existingDestFiles,
+                           existingDestDirs, skipDirs=skipDirs)
+    logger.debug("Existing file fetching done:")
+    fetched = ""
+    for l in existingDestFiles.values():
+        for t in l:
+            fAbsP = t[0]
+            f = t[-1]
+            fetched += f"  File path: {fAbsP}, hash value: {f.getHash()}\n"
+    logger.debug(fetched)
+    logger.debug(f"Existing dirs fetched: {existingDestDirs}")
+    return (srcSnap, existingDestFiles, existingDestDirs)
+
+
+def syncSnapshot(srcSnap, srcDirPath, destDirPath,
+                 existingDestFiles, existingDestDirs, copyFile=None):
+    '''Does the actual syncing of the files in srcSnap, by moving matching
+    dest files or copying (step 6. in main). Whatever is synced, stops being
+    tracked in existingDestFiles and existingDestDirs, so those are left
+    with the obsolete dest files/dirs only. Dirs of unchanged subtrees are
+    skipped (see SubtreeDigests). Refer to takeSnapshots for the
+    arguments.
+    copyFile (optional), function, which does the copying instead of
+        SrcFile.wrapCpChmodChown (see SrcFile.syncFile)
+    '''
+    # Start the actual synchronisation
+    logger.info("The actual syncing is now beginning")
+    # (device, inode) of hard linked src files: dest abs path of the
+    # first one synced, the others are replicated as hard links to it
+    linkedDestPaths = {}
+    # hash value: dest abs path of a content put in place this cycle; more
+    # src files with it are cloned from there, not read again from src
+    placedContent = {}
+    for lvl in srcSnap:
+        for srcD in srcSnap[lvl]:
+            if srcD.unchanged:
+                continue
+            # the abs paths of the files are put together from the (interned)
+            # nodes of their dirs, see PathNodes
+            srcNode = pathNodes.dirOf(srcDirPath, srcD.getRelPath())
+            destNode = pathNodes.dirOf(destDirPath, srcD.getRelPath())
+            # by now this sub-dir from src should have equivalent in dest
+            # (even if it is going to have a new name in dest);
+            # remove such equivalent dir from existingDestDirs list,
+            # because later those are assumed to be empty and get deleted
+            if lvl != 0: # man src/dest are not in the list
+                if srcD.getNewRelPathInDest(): # this just added
+                    dirAbsP = pathNodes.dirOf(
+                        destDirPath, srcD.getNewRelPathInDest()).absPath
+                else:
+                    dirAbsP = destNode.absPath
+                logger.debug(f"Removing for existing dirs list: {dirAbsP}")
+                existingDestDirs.remove(dirAbsP)
+            # now look into files of the src sub-dir; the src sub-dir and
+            # its dest equivalent are opened once, so that the files in
+            # them are accessed relative to the dir fds, by name only
+            srcDirFd = openDirFd(srcNode.absPath, "")
+            destDirFd = openDirFd(destNode.absPath, "")
+            try:
+                for srcF in srcD.getContainedFiles():
+                    h = srcF.getHash()
+                    linkKey = srcF.getLinkKey()
+                    fAbsPath_new = destNode.filePath(srcF.getName())
+                    if srcF.unstable or srcF.postponed:
+                        # being written (or left for a later cycle, see
+                        # CycleBudget): whatever is in dest at the same path
+                        # is kept; a copy of a file being written is deferred,
+                        # see FileStability
+                        untrackDestPath(fAbsPath_new, existingDestFiles)
+                        if srcF.unstable:
+                            fileStability.defer(
+                                srcF, srcNode.filePath(srcF.getName()),
+                                fAbsPath_new)
+                        subtreeDigests.markDirty(fAbsPath_new)
+                        continue
+                    if linkKey in linkedDestPaths:
+                        if srcF.linkFile(linkedDestPaths[linkKey],
+                                         fAbsPath_new, existingDestFiles,
+                                         destDirFd):
+                            continue
+                    # if there is at least one file in dest with the same
+                    # hash value, assume it is the same file and try to
+                    # move/rename/leave as is
+                    # in the case multiple such file exist in dest, try to
+                    # chose the most suitable one, judging by paths
+                    if existingDestFiles.get(h):
+                        lg1 = "File from source already existing in dest, "
+                        lg2 = "updating accordingly by moving/renaming..."
+                        logger.debug(lg1+lg2)
+                        # take the first duplicate file, in case it's only one
+                        fAbsPath, destF = existingDestFiles[h][0]
+                        # and try to chose a better one
+                        for t in existingDestFiles[h]:
+                            trackedFilePath = t[0]
+                            # pick existing file with potentially same path
+                            if trackedFilePath == fAbsPath_new:
+                                fAbsPath, destF = t
+                                break
+                            # file may have moved in a sub dir since last sync
+                            elif len(trackedFilePath) > len(fAbsPath_new) \
+                                    and fAbsPath_new in trackedFilePath:
+                                fAbsPath, destF = t
+                                break
+                            # file may have moved in a parent dir since last
+                            # sync
+                            elif len(trackedFilePath) < len(fAbsPath_new) \
+                                    and trackedFilePath in fAbsPath_new:
+                                fAbsPath, destF = t
+                                break
+                        # such file needs to be moved to the corresponding
+                        # location (possible naming conflicts to be dealt with)
+                        # file mode and ownership should be changed accordingly
+                        syncedAbsP = destF.handleMatchingFileSync(
+                            fAbsPath, fAbsPath_new, srcF,
+                            existingDestFiles, existingDestDirs,
+                            clearExistingDestFiles, fetchExistingDestFiles,
+                            pickUniqName=pickNewName)
+                        # what ever the outcome, file handled at best
+                        # remove from dict, otherwise it'll be deleted later
+                        duplicateFileNum = len(existingDestFiles[h])
+                        if duplicateFileNum == 1:
+                            existingDestFiles.pop(h)
+                        else:
+                            for i in range(duplicateFileNum):
+                                if existingDestFiles[h][i][0] == fAbsPath:
+                                    existingDestFiles[h].pop(i)
+                                    break
+                    elif h in placedContent and SrcFile.cloneMode != "none":
+                        # content claimed by another src file, see cloneFrom
+                        syncedAbsP = srcF.syncFile(srcD, srcDirPath,
+                                                   destDirPath,
+                                                   existingDestFiles,
+                                                   existingDestDirs,
+                                                   clearExistingDestFiles,
+                                                   fetchExistingDestFiles,
+                                                   pickNewName,
+                                                   srcDirFd, destDirFd,
+                                                   cloneFrom(placedContent[h],
+                                                             copyFile),
+                                                   srcNode, destNode)
+                    else:
+                        # hash value of src file not found in dest
+                        syncedAbsP = srcF.syncFile(srcD, srcDirPath,
+                                                   destDirPath,
+                                                   existingDestFiles,
+                                                   existingDestDirs,
+                                                   clearExistingDestFiles,
+                                                   fetchExistingDestFiles,
+                                                   pickNewName,
+                                                   srcDirFd, destDirFd,
+                                                   copyFile, srcNode,
+                                                   destNode)
+                    if linkKey and syncedAbsP:
+                        linkedDestPaths.setdefault(linkKey, syncedAbsP)
+                    if syncedAbsP and h not in placedContent and \
+                            (copyFile is None or os.path.isfile(syncedAbsP)):
+                        # in place, unless its copy is still to be done
+                        placedContent.setdefault(h, syncedAbsP)
+                    if syncedAbsP != fAbsPath_new:
+                        # not synced (in place), so no digest for this dir
+                        subtreeDigests.markDirty(fAbsPath_new)
+            finally:
+                closeDirFd(srcDirFd)
+                closeDirFd(destDirFd)
+
+    logger.info("Source files considered synced, see log file for details")
+
+
+def cloneFrom(fromAbsP, copyFile=None):
+    '''Returns a function to be passed as the copyFile of SrcFile.syncFile,
+    cloning the dest file at fromAbsP (str) with the same content (see
+    SrcFile.cloneFile), and falling back to copyFile (or a copy from src)
+    '''
+    def cloneFile(srcF, curAbsP, newAbsP, srcDirFd=None, destDirFd=None):
+        cloned = srcF.wrapCloneChmodChown(fromAbsP, newAbsP, destDirFd)
+        if cloned:
+            return cloned
+        return (copyFile or SrcFile.wrapCpChmodChown)(
+            srcF, curAbsP, newAbsP, srcDirFd, destDirFd)
+    return cloneFile
+
+
+def untrackDestPath(absPath, existingDestFiles):
+    '''Stops tracking the dest file at absPath (str), if any, in
+    existingDestFiles, so that it is neither moved, nor removed
+    '''
+    for h, tracked in existingDestFiles.items():
+        for i, (trackedPath, destF) in enumerate(tracked):
+            if trackedPath == absPath:
+                tracked.pop(i)
+                if not(tracked):
+                    existingDestFiles.pop(h)
+                return
+
+
+def removeObsoleteDest(existingDestFiles, existingDestDirs):
+    '''Removes the dest files and dirs, which are still tracked after
+    syncing (steps 7. and 8. in main), refer to BulkDeleter. Removed dirs
+    stop being tracked in existingDestDirs.
+    '''
+    logger.info("Removaing obsolete destination files")
+    bulkDeleter.removeFiles([t[0] for l in existingDestFiles.values()
+                             for t in l])
+
+    logger.info("Removing obsolete destination directories")
+    # dirs must be empty, so those are removed from the sub-most level up
+    logger.debug(f"Directories meant for deletion:\n'{existingDestDirs}'")
+    removed = set(bulkDeleter.removeDirs(existingDestDirs))
+    existingDestDirs[:] = [d for d in existingDestDirs if d not in removed]
+
+
+def getBackend(dest):
+    '''Returns the DestBackend for dest (str), a dir or tcp://HOST:PORT
+    '''
+    remoteDest = parseRemoteDest(dest)
+    if remoteDest:
+        return RemoteDestBackend(*remoteDest)
+    return LocalDestBackend(dest)
+
+
+def syncCycle(srcDirPath, destDirPaths, opts, pool=None):
+    '''Runs steps 4. to 8. of a single sync cycle, see main
+    destDirPaths, list of the destinations; several destinations are
+        synced by relative path and hash value, see syncToBackends
+    opts, dict of the optional arguments, see validateOptionalInput
+    pool (optional), ThreadPoolExecutor kept between the cycles for the
+        async pipeline, see runPipelinedCycle
+    Returns the src snapshot, as synced, or None for a remote dest, for
+    several destinations and for cycles run on the snapshot index
+    '''
+    cycleBudget.start()
+    pathNodes.reset()
+    if len(destDirPaths) > 1:
+        syncToBackends(srcDirPath, [getBackend(d) for d in destDirPaths])
+        return None
+    destDirPath = destDirPaths[0]
+    remoteDest = parseRemoteDest(destDirPath)
+    if remoteDest:
+        syncToBackend(srcDirPath, RemoteDestBackend(*remoteDest))
+        return None
+    if snapshotIndex.shouldUse(srcDirPath):
+        runIndexedCycle(srcDirPath, destDirPath)
+        return None
+    if opts["pipeline"] == "async":
+        srcSnap = runPipelinedCycle(srcDirPath, destDirPath,
+                                    syncSnapshot, removeObsoleteDest,
+                                    opts["hashWorkers"], opts["copyWorkers"],
+                                    pool)
+    else:
+        srcSnap, existingDestFiles, existingDestDirs = \
+            takeSnapshots(srcDirPath, destDirPath)
+        # copies are held back to be done in order, if so configured
+        syncSnapshot(srcSnap, srcDirPath, destDirPath,
+                     existingDestFiles, existingDestDirs,
+                     copyOrdering.defer if copyOrdering.isActive() else None)
+        copyOrdering.run(srcDirPath)
+        removeObsoleteDest(existingDestFiles, existingDestDirs)
+    # files being written, once settled
+    fileStability.runFollowUp()
+    subtreeDigests.recordSynced(srcSnap, destDirPath)
+    snapshotIndex.noteEntries(sum(len(srcD.getContainedFiles()) + 1
+                                  for lvl in srcSnap for srcD in srcSnap[lvl]))
+    return srcSnap
+
+
+class Syncer(object):
+    '''Keeps the dest dirs in sync with the src dir in process, running the
+    steps of main without its command line and logging set up, so that
+    another service can embed the syncing and trigger cycles on demand.
+    The state carried from cycle to cycle (hash cache, subtree digests,
+    snapshot index, journal, worker threads of the async pipeline) stays
+    warm between the calls. The options are set on the module level objects
+    shared by the syncing steps (see helpingClasses), so there can only be
+    a single Syncer per process at a time: creating another one, before
+    the first one is closed, raises RuntimeError.
+    srcDirPath, str, abs path of the src dir
+    destDirPaths, list of the dest dir abs paths (or tcp://HOST:PORT)
+    syncPeriod, int, seconds between two cycle starts of runForever
+    opts (optional), dict of {optional argument name without leading
+        dashes: value, as on the command line}, e.g. {'scrub': '5%'},
+        validated by validatedOpts (raising ValueError on an unknown name
+        or an invalid value); missing ones take their default values,
+        except for the journal, which is only kept if a path is given
+    indexPath (optional), str, path of the snapshot index file, used with
+        the 'indexThreshold' option
+    onProgress (optional), function called with (kind, count) for every
+        change done in a dest, e.g. ('copied', 1); it may be called by
+        worker threads
+    onMetrics (optional), function called with the metrics (dict, see
+        CycleMetrics.asDict) of every finished cycle
+    '''
+
+    # the Syncer not closed yet, if any
+    active = None
+
+    def __init__(self, srcDirPath, destDirPaths, syncPeriod, opts=None,
+                 indexPath=None, onProgress=None, onMetrics=None):
+        if Syncer.active is not None:
+            raise RuntimeError("Another Syncer is in use, a single one "
+                               "can be used at a time, see close")
+        self.srcDirPath = srcDirPath
+        self.destDirPaths = list(destDirPaths)
+        self.syncPeriod = syncPeriod
+        self.opts = self.validatedOpts(self.argsOf(opts or {}), srcDirPath,
+                                       self.destDirPaths, syncPeriod)
+        self.onMetrics = onMetrics
+        self.stopped = threading.Event()
+        self.lock = threading.Lock() # one cycle at a time
+        self.pool = None # worker threads of the async pipeline
+        cycleMetrics.onChange = onProgress
+        self.setUp(indexPath)
+        Syncer.active = self
+
+    @staticmethod
+    def argsOf(opts):
+        '''Returns the list of the optional arguments in opts (dict, see
+        Syncer), as on the command line; raises ValueError on an unknown
+        argument name
+        '''
+        av = []
+        for name, value in opts.items():
+            if "--" + str(name) not in optionalArgs:
+                raise ValueError(f"Unknown option '{name}'")
+            av += ["--" + name, str(value)]
+        return av
+
+    @staticmethod
+    def defaultOpts(srcDirPath, destDirPaths, syncPeriod):
+        '''Returns the dict of the optional arguments with their default
+        values (see validateOptionalInput), without a journal
+        '''
+        return Syncer.validatedOpts([], srcDirPath, destDirPaths, syncPeriod)
+
+    @staticmethod
+    def validatedOpts(av, srcDirPath, destDirPaths, syncPeriod, logFile=None):
+        '''Same as validateOptionalInput, for an embedding service: av is
+        the list of the optional arguments only, as on the command line
+        (e.g. ['--scrub', '5%']); without a logFile (str), there is no
+        journal unless '--journal' is given. Raises ValueError on invalid
+        input, instead of printing it and exiting.
+        Returns the dict of the optional arguments
+        '''
+        av = list(av)
+        if logFile is None and "--journal" not in av:
+            av += ["--journal", "none"]
+        printed = io.StringIO()
+        try:
+            # the validation prints what is invalid, then exits
+            with contextlib.redirect_stdout(printed):
+                return validateOptionalInput(["Syncer"] + av, srcDirPath,
+                                             destDirPaths, syncPeriod,
+                                             logFile)
+        except SystemExit:
+            lines = printed.getvalue().strip().splitlines()
+            raise ValueError(lines[0] if lines else "Invalid options") \
+                from None
+
+    def setUp(self, indexPath):
+        '''Applies the options to the objects shared by the syncing steps
+        '''
+        opts = self.opts
+        destDirPath = self.destDirPaths[0]
+        # a remote dest and several dests are synced through DestBackends
+        backendSync = len(self.destDirPaths) > 1 or \
+            parseRemoteDest(destDirPath)
+        backendKind = "several dests" if len(self.destDirPaths) > 1 \
+            else "a remote dest"
+        logger.info(f"  Scheduler: '{opts['scheduler']}'")
+        logger.info(f"  Pipeline: '{opts['pipeline']}'")
+        if backendSync and opts["pipeline"] != "sequential":
+            logger.warning(f"Pipeline option is ignored for {backendKind}")
+        self.scrubber = None
+        if opts["scrub"] and backendSync:
+            logger.warning(f"Scrub option is ignored for {backendKind}")
+        elif opts["scrub"]:
+            lg1 = "  Scrub budget per cycle (fraction, bytes): "
+            logger.info(lg1 + f"{opts['scrub']}")
+            self.scrubber = ReplicaScrubber(*opts["scrub"])
+        self.scheduler = SyncScheduler(self.syncPeriod, opts["scheduler"],
+                                       opts["maxSyncPeriod"])
+        if opts["journal"]:
+            logger.info(f"  Journal: '{opts['journal']}'")
+            replayed, interrupted = syncJournal.open(opts["journal"])
+            if interrupted:
+                lg1 = "Last sync cycle was interrupted, resuming it with "
+                lg2 = f"{replayed} journal records replayed"
+                logger.warning(lg1+lg2)
+            elif replayed:
+                lg1 = f"Hash cache restored from journal ({replayed} records)"
+                logger.info(lg1)
+        if opts["changeFeed"] and parseRemoteDest(destDirPath):
+            lg1 = "Change feed option is ignored for a remote dest, the "
+            lg2 = "receiver keeps its own (see receiveSyncing.py)"
+            logger.warning(lg1+lg2)
+        elif opts["changeFeed"]:
+            lg1 = f"  Change feed: '{opts['changeFeed']}'"
+            logger.info(lg1 + f", of the dest '{destDirPath}'")
+            changeFeed.open(opts["changeFeed"], destDirPath)
+        if opts["ioLimit"]:
+            logger.info(f"  I/O limits by time of day: {opts['ioLimit']}")
+            ioThrottle.setWindows(opts["ioLimit"])
+        localDests = [d for d in self.destDirPaths if not(parseRemoteDest(d))]
+        storageProfile.setUp(opts["storage"], self.srcDirPath, localDests)
+        for workers in ("hashWorkers", "copyWorkers", "deleteWorkers",
+                        "rangeCopyWorkers"):
+            if opts[workers] is None:
+                opts[workers] = storageProfile.workersFor(defaultWorkers)
+        if storageProfile.queueDepth:
+            lg1 = "  Non-rotational storage, workers (hash, copy, delete, "
+            lg2 = f"range copy): {opts['hashWorkers']}, {opts['copyWorkers']}"
+            logger.info(lg1 + lg2 + f", {opts['deleteWorkers']}, "
+                        f"{opts['rangeCopyWorkers']}")
+        if storageProfile.rotational and opts["copyOrder"] == "tree":
+            logger.info("  Rotational src storage, copies in physical order")
+            opts["copyOrder"] = "physical"
+        bulkDeleter.setWorkers(opts["deleteWorkers"])
+        copyOrdering.setPolicy(opts["copyOrder"], opts["priorityPaths"])
+        SrcFile.rangeCopyThreshold = opts["rangeCopyThreshold"]
+        SrcFile.rangeCopyWorkers = opts["rangeCopyWorkers"]
+        fileStability.setUp(opts["minFileAge"], opts["followUpWait"])
+        SrcFile.cloneMode = opts["cloneMode"]
+        if opts["minFileAge"]:
+            lg1 = f"  Src files modified less than {opts['minFileAge']} s "
+            logger.info(lg1 + "ago are deferred")
+        cycleBudget.setUp(*opts["cycleBudget"])
+        if cycleBudget.isActive():
+            lg1 = "  Cycle budget (seconds, bytes): "
+            logger.info(lg1 + f"{opts['cycleBudget']}")
+        pathFilter.setRules(opts["filterRules"])
+        if pathFilter.isActive():
+            rules = [("+ " if include else "- ") + pattern
+                     for include, pattern in opts["filterRules"]]
+            logger.info(f"  Include/exclude rules: {rules}")
+        if copyOrdering.isActive():
+            lg1 = f"  Copy order: '{opts['copyOrder']}', priority paths: "
+            logger.info(lg1 + f"{opts['priorityPaths']}")
+        if opts["indexThreshold"] is not None and backendSync:
+            lg1 = f"Index threshold option is ignored for {backendKind}"
+            logger.warning(lg1)
+        elif opts["indexThreshold"] is not None and indexPath:
+            lg1 = f"  Snapshot index above {opts['indexThreshold']} entries: "
+            logger.info(lg1 + f"'{indexPath}'")
+            snapshotIndex.setUp(indexPath, opts["indexThreshold"])
+
+    def syncOnce(self):
+        '''Runs a single sync cycle right away (steps 4. to 8. of main),
+        once the one running, if any, is finished.
+        Returns the metrics of the cycle (dict, see CycleMetrics.asDict)
+        '''
+        opts = self.opts
+        with self.lock:
+            logger.info("Starting new sync cycle")
+            cycleMetrics.reset()
+            syncJournal.record("cycle-start", time=str(getCurrentTime()))
+            ioThrottle.refreshLimits()
+            if opts["pipeline"] == "async" and self.pool is None:
+                self.pool = ThreadPoolExecutor(
+                    max_workers=opts["hashWorkers"] + opts["copyWorkers"] + 1)
+            srcSnap = syncCycle(self.srcDirPath, self.destDirPaths, opts,
+                                self.pool)
+            if self.scrubber and srcSnap:
+                self.scrubber.scrub(srcSnap, self.srcDirPath,
+                                    self.destDirPaths[0])
+
+            hashCache.prune()
+            syncJournal.checkpoint()
+            changeFeed.commit()
+            logger.info(f"Sync cycle finished, changes done: {cycleMetrics}")
+            if opts["lagTarget"] and cycleMetrics.maxLag > opts["lagTarget"]:
+                lg1 = f"Replication lag of {cycleMetrics.maxLag:.1f} s "
+                logger.warning(lg1 + f"exceeds the target of "
+                               f"{opts['lagTarget']} s")
+            metrics = cycleMetrics.asDict()
+        if self.onMetrics:
+            self.onMetrics(metrics)
+        return metrics
+
+    def runForever(self):
+        '''Runs sync cycles (see syncOnce) at the sync period (step 9. of
+        main), until stop is called
+        '''
+        try:
+            while not(self.stopped.is_set()):
+                currentCycleStart = getCurrentTime()
+                metrics = self.syncOnce()
+                waitingTime = endSyncCycle(currentCycleStart, self.syncPeriod,
+                                           self.scheduler,
+                                           sum(metrics["changes"].values()))
+                msg = f"Next sync cycle starts in {waitingTime} seconds\n\n\n"
+                logger.warning(msg)
+                self.stopped.wait(waitingTime)
+            logger.info("Syncing stopped")
+        finally:
+            self.stopped.clear()
+
+    def stop(self):
+        '''Makes runForever return, once the running cycle, if any, is
+        finished; to be called from another thread
+        '''
+        self.stopped.set()
+
+    def close(self):
+        '''Releases the worker threads kept between cycles, after which
+        another Syncer can be created
+        '''
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+        cycleMetrics.onChange = None
+        if Syncer.active is self:
+            Syncer.active = None
+
+
 def main():
     '''Wraps up the whole syncing process:
         1. Does some check for user input, see validateInput func;
@@ -68,6 +638,9 @@ def main():
             then the next cycle would start in 20 s. Aim is to have a cycle
             start at every n*100th second, for the sake of predictability and
             regularity.
+            NOTE: With '--scheduler adaptive', the next cycle start depends
+            on the changes done by the last cycle instead (ref to the
+            SyncScheduler class)
     '''
     # deal with user input
     cmdArgs = sys.argv
@@ -76,180 +649,30 @@ def main():
     if "-h" in cmdArgs or "--help" in cmdArgs:
         printHelp()
         sys.exit(0)
-    srcDirPath, destDirPath, syncPeriod, logFile, destCreatedNow = \
+    srcDirPath, destDirPaths, syncPeriod, logFile, destsCreatedNow = \
         validateInput(sys.argv)
+    opts = validateOptionalInput(sys.argv, srcDirPath, destDirPaths,
+                                 syncPeriod, logFile)
     
     # input validated, start logging
     logger = setUpLogging(logFile)
-    if destCreatedNow:
+    for dest in destsCreatedNow:
         msg = "Dest was not existing, but created during input validation"
-        logger.info(msg)
+        logger.info(f"{msg}: '{dest}'")
     # log intial info: user, cmd arguments
     logger.info(f"  Source directory to be synced: '{srcDirPath}'")
-    logger.info(f"  Destination directory for the sync: '{destDirPath}'")
+    for dest in destDirPaths:
+        logger.info(f"  Destination directory for the sync: '{dest}'")
     logger.info(f"  Log file: '{logFile}'")
-
+    # the options are validated once more by the Syncer, as given
+    givenOpts = {sys.argv[i][2:]: sys.argv[i+1]
+                 for i in range(1, len(sys.argv), 2)
+                 if sys.argv[i] in optionalArgs}
+    givenOpts.setdefault("journal", str(opts["journal"]))
+    syncer = Syncer(srcDirPath, destDirPaths, syncPeriod, givenOpts,
+                    indexPath=logFile + ".index")
     # syncing begings with  src dir snapshot + adapting dest dir structure
-    while True:
-        logger.info("Starting new sync cycle")
-        currentCycleStart = getCurrentTime()
-        logger.info("Getting snapshot of the source dir and adapting dest dir")
-        srcSnap = dict()
-        srcDir = SrcDir(srcDirPath, srcDirPath)
-        getDirSnapshotAndAdapt(srcSnap, srcDir, 0,
-                               srcDirPath, destDirPath)
-        # # printing content of directories to be synced    
-        # for depth in range(0, max(srcSnap.keys()) + 1):
-        #     for d in srcSnap[depth]:
-        #         print(d)
-
-        # next phase: snapshot of dest dir after adapting, so it's up-to-date
-        logger.info("Getting snapshot of the adapted state of dest dir")
-        existingDestFiles = {}
-        existingDestDirs = []
-        fetchExistingDestFiles(destDirPath, existingDestFiles,
-                               existingDestDirs)
-        logger.debug("Existing file fetching done:")
-        fetched = ""
-        for l in existingDestFiles.values():
-            for t in l:
-                fAbsP = t[0]
-                f = t[-1]
-                fetched += f"  File path: {fAbsP}, hash value: {f.getHash()}\n"
-        logger.debug(fetched)
-        logger.debug(f"Existing dirs fetched: {existingDestDirs}")
-        
-        # Start the actual synchronisation
-        logger.info("The actual syncing is now beginning")
-        for lvl in srcSnap:
-            for srcD in srcSnap[lvl]:
-                # by now this sub-dir from src should have equivalent in dest
-                # (even if it is going to have a new name in dest);
-                # remove such equivalent dir from existingDestDirs list,
-                # because later those are assumed to be empty and get deleted
-                if lvl != 0: # man src/dest are not in the list
-                    if srcD.getNewRelPathInDest(): # this just added
-                        dirAbsP = os.path.join(destDirPath,
-                                               srcD.getNewRelPathInDest())
-                    else:
-                        dirAbsP = os.path.join(destDirPath, srcD.getRelPath())
-                    dirAbsP = os.path.normpath(dirAbsP)
-                    logger.debug(f"Removing for existing dirs list: {dirAbsP}")
-                    existingDestDirs.remove(dirAbsP)
-                # now look into files of the src sub-dir
-                for srcF in srcD.getContainedFiles():
-                    h = srcF.getHash()
-                    # if there is at least one file in dest with the same
-                    # hash value, assume it is the same file and try to
-                    # move/rename/leave as is
-                    # in the case multiple such file exist in dest, try to
-                    # chose the most suitable one, judging by paths
-                    if h in existingDestFiles:
-                        lg1 = "File from source already existing in dest, "
-                        lg2 = "updating accordingly by moving/renaming..."
-                        logger.debug(lg1+lg2)
-                        fAbsPath_new = os.path.join(destDirPath,
-                                                    srcD.getRelPath(),
-                                                    srcF.getName())
-                        fAbsPath_new = os.path.normpath(fAbsPath_new)
-                        # take the first duplicate file, in case it's only one
-                        fAbsPath, destF = existingDestFiles[h][0]
-                        # and try to chose a better one
-                        for t in existingDestFiles[h]:
-                            trackedFilePath = t[0]
-                            # pick existing file with potentially same path
-                            if trackedFilePath == fAbsPath_new:
-                                fAbsPath, destF = t
-                                break
-                            # file may have moved in a sub dir since last sync
-                            elif len(trackedFilePath) > len(fAbsPath_new) \
-                                    and fAbsPath_new in trackedFilePath:
-                                fAbsPath, destF = t
-                                break
-                            # file may have moved in a parent dir since last sync
-                            elif len(trackedFilePath) < len(fAbsPath_new) \
-                                    and trackedFilePath in fAbsPath_new:
-                                fAbsPath, destF = t
-                                break
-                        # such file needs to be moved to the corresponding location
-                        # (possible naming conflicts to be dealt with)
-                        # file mode and ownership should be changed accordingly
-                        destF.handleMatchingFileSync(fAbsPath,
-                                                     fAbsPath_new,
-                                                     srcF,
-                                                     existingDestFiles,
-                                                     existingDestDirs,
-                                                     clearExistingDestFiles,
-                                                     fetchExistingDestFiles,
-                                                     pickUniqName=pickNewName)
-                        # what ever the outcome, file handled at best
-                        # remove from dict, otherwise it'll be deleted later
-                        duplicateFileNum = len(existingDestFiles[h])
-                        if duplicateFileNum == 1:
-                            existingDestFiles.pop(h)
-                        else:
-                            for i in range(duplicateFileNum):
-                                if existingDestFiles[h][i][0] == fAbsPath:
-                                    existingDestFiles[h].pop(i)
-                                    break
-                    else:
-                        # hash value of src file not found in dest
-                        srcF.syncFile(srcD, srcDirPath, destDirPath,
-                                      existingDestFiles, existingDestDirs,
-                                      clearExistingDestFiles,
-                                      fetchExistingDestFiles,
-                                      pickUniqName = pickNewName)
-                        
-        logger.info("Source files considered synced, see log file for details")
-        
-        logger.info("Removaing obsolete destination files")
-        # removing all the files left in the existing dest files dict
-        for l in existingDestFiles.values():
-            for t in l:
-                fAbsP = t[0]
-                logger.debug(f" Going to delete file now: '{fAbsP}'")
-                try:
-                    os.remove(fAbsP)
-                    logger.info(f"  File removed from destination, '{fAbsP}'")
-                except Exception as e:
-                    logger.error(f"  File cannot be removed: '{fAbsP}'",
-                                 exc_info=True)
-                
-        logger.info("Removing obsolete destination directories")
-        # dirs must be empty, so sort in such way, as to start from the
-        # sub-most. As a back up, naively assume that large length implies
-        # more sub-levels
-        # using lambda for the sorting key. '\\' seems to apply in windows...
-        if len(existingDestDirs) > 1:
-            logger.debug("Reverse sorting dest dirs to be deleted")
-            logger.debug(f"Directories meant for deletion:\n'{existingDestDirs}'")
-            logger.debug("First, reversed sort by len of the dest dirs")
-            try:
-                existingDestDirs.sort(key=(lambda b: b.count("\\")),
-                                      reverse=True)
-                logger.info("Successfully sorted as intended")
-            except Exception as e:
-                logger.error("Unable to sort dirs as intended", exc_info=True)
-                logger.debug(f"Dirs after sorting:\n'{existingDestDirs}'")
-                existingDestDirs.sort(key=len, reverse=True)
-        logger.info("Starting the actual deletion of obsolite directories")
-        for d in existingDestDirs[:]:
-            try:
-                os.rmdir(d)
-                logger.info(f"Dir removed from dest: '{d}'")
-                existingDestDirs.remove(d)
-            except Exception as e:
-                logger.error(f"Dir cannot be removed: '{d}' ", exc_info=True)
-
-        #clear snapshot variables before ending the cycle
-        del srcSnap
-        del existingDestFiles
-        del existingDestDirs
-        logger.info("Sync cycle finished")
-        waitingTime = endSyncCycle(currentCycleStart, syncPeriod)
-        msg = f"Next sync cycle starts in {waitingTime} seconds\n\n\n"
-        logger.warning(msg)
-        time.sleep(waitingTime)
+    syncer.runForever()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from helpingFuncs import getDirSnapshotAndAdapt, fetchExistingDestFiles
+from helpingFuncs import orderHashing, isHashingOrdered
+from helpingClasses import SrcDir, SrcFile, subtreeDigests, copyOrdering
+
+logger = logging.getLogger(f"main.{__name__}")
+
+# max number of batches waiting in between two stages
+queueSize = 64
+# files are handed from stage to stage in batches of up to batchSize files
+# or batchBytes bytes, as every hand-over from a thread is a round trip
+# through the event loop, which costs more than hashing a small file
+batchSize = 32
+batchBytes = 8 * 2**20
+
+def runPipelinedCycle(srcDirPath, destDirPath, syncSnapshot,
+                      removeObsoleteDest, hashWorkers=4, copyWorkers=4,
+                      pool=None):
+    '''Runs a single sync cycle as stages connected by bounded queues, so
+    that the disk is kept busy while Python does the bookkeeping, and the
+    other way round:
+        1. listing of the src dir (adapting the dest dir structure), then,
+            once its files are hashed, listing of the adapted dest dir,
+            skipping the unchanged subtrees (see SubtreeDigests), in a
+            thread;
+        2. hashing of the listed files, by hashWorkers concurrent workers,
+            while the listing goes on (or, with a cycle budget or on a
+            rotational src, once all src files are listed, see
+            orderHashing); src files which cannot be hashed are postponed;
+        3. syncing (move/copy decisions), once all files are hashed, as
+            those rely on the whole dest snapshot;
+        4. copying, by copyWorkers concurrent workers, while the syncing
+            of the following files goes on (or, with a copy order policy,
+            once all copies are known, see CopyOrdering);
+        5. cloning the further copies of a content within dest (see
+            SrcFile.cloneFile), then removing the obsolete dest files/dirs,
+            once all copies are done.
+    The outcome is the same as when running the steps one after another.
+    Returns the src snapshot, as synced (see takeSnapshots)
+    syncSnapshot, removeObsoleteDest, functions from outside module,
+        refer to startSyncing
+    hashWorkers, copyWorkers, int, per stage concurrency limits
+    pool (optional), ThreadPoolExecutor of at least hashWorkers +
+        copyWorkers + 1 threads, kept (warm) between cycles by the caller;
+        otherwise one is created for the cycle
+    '''
+    return asyncio.run(pipelinedCycle(srcDirPath, destDirPath, syncSnapshot,
+                               removeObsoleteDest, hashWorkers, copyWorkers,
+                               pool))
+
+async def pipelinedCycle(srcDirPath, destDirPath, syncSnapshot,
+                         removeObsoleteDest, hashWorkers, copyWorkers,
+                         pool=None):
+    '''Coroutine doing the work of runPipelinedCycle
+    '''
+    loop = asyncio.get_running_loop()
+    # blocking file system calls are done by threads; one for the listing
+    # or syncing stage, the others for the workers
+    ownPool = pool is None
+    if ownPool:
+        pool = ThreadPoolExecutor(max_workers=hashWorkers + copyWorkers + 1)
+    hashQueue = asyncio.Queue(maxsize=queueSize)
+    copyQueue = asyncio.Queue(maxsize=queueSize)
+    notHashed = set() # files, which could not be hashed
+    handedOver = {} # hash value: new abs path of the content being copied
+    duplicates = [] # copies to be cloned from there, once it is in place
+
+    def putFromThread(queue, item):
+        # blocks the calling thread while the queue is full
+        asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+    def batchingTo(queue):
+        # returns functions (add, flush), to be called from a thread: add
+        # takes (file, ...) items, which are put into queue as lists
+        batch = []
+        batchedBytes = [0]
+        def flush():
+            if batch:
+                putFromThread(queue, batch[:])
+                batch.clear()
+                batchedBytes[0] = 0
+        def add(*item):
+            batch.append(item)
+            batchedBytes[0] += item[0].getSize()
+            if len(batch) >= batchSize or batchedBytes[0] >= batchBytes:
+                flush()
+        return add, flush
+
+    def hashBatch(batch):
+        for f, dirAbsPath in batch:
+            try:
+                f.hashFile(dirAbsPath)
+            except Exception as e:
+                lg1 = f"Could NOT hash '{f.getName()}' in '{dirAbsPath}'"
+                logger.error(lg1, exc_info=True)
+                notHashed.add(f)
+
+    def copyBatch(batch):
+        for srcF, curAbsP, newAbsP in batch:
+            try:
+                if not(srcF.wrapCpChmodChown(curAbsP, newAbsP)):
+                    subtreeDigests.markDirty(newAbsP)
+            except Exception as e:
+                lg1 = f"Could NOT finish copy '{curAbsP}' -> '{newAbsP}'"
+                logger.error(lg1, exc_info=True)
+                subtreeDigests.markDirty(newAbsP)
+
+    async def hashStage():
+        while True:
+            batch = await hashQueue.get()
+            if batch is None:
+                return
+            await loop.run_in_executor(pool, hashBatch, batch)
+
+    async def copyStage():
+        while True:
+            batch = await copyQueue.get()
+            if batch is None:
+                return
+            await loop.run_in_executor(pool, copyBatch, batch)
+
+    def isDuplicate(srcF, curAbsP, newAbsP):
+        # the same content is copied from src once, then cloned in dest
+        fromAbsP = handedOver.setdefault(srcF.getHash(), newAbsP)
+        if fromAbsP == newAbsP or SrcFile.cloneMode == "none":
+            return False
+        duplicates.append((srcF, curAbsP, newAbsP, fromAbsP))
+        return True
+
+    def cloneDuplicates():
+        for srcF, curAbsP, newAbsP, fromAbsP in duplicates:
+            if not(srcF.wrapCloneChmodChown(fromAbsP, newAbsP) or
+                   srcF.wrapCpChmodChown(curAbsP, newAbsP)):
+                subtreeDigests.markDirty(newAbsP)
+
+    addHash, flushHashes = batchingTo(hashQueue)
+    addCopy, flushCopies = batchingTo(copyQueue)
+
+    def handOverCopy(srcF, curAbsP, newAbsP, srcDirFd, destDirFd):
+        # the dir fds are closed by the time a worker copies, so abs paths
+        # are used; hard linked files are copied right away, as the other
+        # links are going to be made to the copy
+        if copyOrdering.isActive():
+            # handed over in order, once all are known
+            return copyOrdering.defer(srcF, curAbsP, newAbsP)
+        if srcF.getLinkKey():
+            return srcF.wrapCpChmodChown(curAbsP, newAbsP)
+        if not(isDuplicate(srcF, curAbsP, newAbsP)):
+            addCopy(srcF, curAbsP, newAbsP)
+        return newAbsP
+
+    def handOverOrderedCopies():
+        for item in copyOrdering.takeOrdered(srcDirPath):
+            if not(isDuplicate(*item)):
+                addCopy(*item)
+        flushCopies()
+
+    try:
+        logger.info("Pipeline: listing and hashing src and dest dirs")
+        async def listAndHash(listFunc):
+            # hashes the files handed over by listFunc, while it goes on
+            hashers = [asyncio.create_task(hashStage())
+                       for i in range(hashWorkers)]
+            await loop.run_in_executor(pool, listFunc)
+            for h in hashers:
+                await hashQueue.put(None)
+            await asyncio.gather(*hashers)
+        srcSnap = dict()
+        def listSrc():
+            if not(isHashingOrdered()):
+                getDirSnapshotAndAdapt(
+                    srcSnap, SrcDir(srcDirPath, srcDirPath), 0,
+                    srcDirPath, destDirPath, deferHashing=addHash)
+            else:
+                listed = []
+                getDirSnapshotAndAdapt(
+                    srcSnap, SrcDir(srcDirPath, srcDirPath), 0,
+                    srcDirPath, destDirPath,
+                    deferHashing=lambda f, d: listed.append((f, d)))
+                for item in orderHashing(listed, srcDirPath):
+                    addHash(*item)
+            flushHashes()
+        await listAndHash(listSrc)
+        # src files which could not be hashed are left for a later cycle,
+        # their dest counterparts are kept (as in takeSnapshots)
+        for lvl in srcSnap:
+            for srcD in srcSnap[lvl]:
+                for f in srcD.getContainedFiles():
+                    if f in notHashed:
+                        f.postponed = True
+        # subtrees identical in src and dest are neither listed, nor
+        # hashed in dest, nor synced
+        skipDirs = subtreeDigests.findUnchanged(srcSnap, destDirPath)
+        # dest is listed only once its structure is adapted
+        destFiles = []
+        existingDestDirs = []
+        def deferDestHashing(f, dirAbsPath):
+            destFiles.append((f, dirAbsPath))
+            addHash(f, dirAbsPath)
+        def listDest():
+            fetchExistingDestFiles(destDirPath, {}, existingDestDirs,
+                                   deferHashing=deferDestHashing,
+                                   skipDirs=skipDirs)
+            flushHashes()
+        await listAndHash(listDest)
+        existingDestFiles = {}
+        for f, dirAbsPath in destFiles:
+            if f not in notHashed:
+                existingDestFiles.setdefault(f.getHash(), []).append(
+                    (os.path.join(dirAbsPath, f.getName()), f))
+
+        logger.info("Pipeline: syncing and copying")
+        copiers = [asyncio.create_task(copyStage())
+                   for i in range(copyWorkers)]
+        await loop.run_in_executor(pool, syncSnapshot, srcSnap,
+                                   srcDirPath, destDirPath,
+                                   existingDestFiles, existingDestDirs,
+                                   handOverCopy)
+        await loop.run_in_executor(pool, handOverOrderedCopies)
+        for c in copiers:
+            await copyQueue.put(None)
+        await asyncio.gather(*copiers)
+        await loop.run_in_executor(pool, cloneDuplicates)
+
+        await loop.run_in_executor(pool, removeObsoleteDest,
+                                   existingDestFiles, existingDestDirs)
+        return srcSnap
+    finally:
+        if ownPool:
+            pool.shutdown()
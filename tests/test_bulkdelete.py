@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+'''Tests of the bulk removal of obsolete dest files and dirs (see
+BulkDeleter): batches per dir, concurrent workers, dirs bottom-up.
+Run from the repo root: python -m unittest discover tests
+'''
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+repoPath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repoPath)
+
+from helpingClasses import BulkDeleter, cycleMetrics
+
+
+def writeFile(absPath, content):
+    os.makedirs(os.path.dirname(absPath), exist_ok=True)
+    with open(absPath, 'wb') as f:
+        f.write(content)
+
+
+class BulkDeleterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rootPath = tempfile.mkdtemp(prefix="syncBulkDelete_")
+        self.addCleanup(shutil.rmtree, self.rootPath)
+        self.files = []
+        self.dirs = []
+        for d in ("a", "a/b", "a/b/c", "d", "d/e"):
+            self.dirs.append(os.path.join(self.rootPath, d))
+            for i in range(10):
+                self.files.append(os.path.join(self.rootPath, d, f"f{i}"))
+                writeFile(self.files[-1], b"obsolete")
+        self.deleter = BulkDeleter(workers=3)
+        self.deleter.batchSize = 4
+        self.addCleanup(cycleMetrics.reset)
+        cycleMetrics.reset()
+
+    def testBatchesPerDir(self):
+        batches = self.deleter.makeBatches(self.files)
+        self.assertEqual(len(batches), 5 * 3)
+        for parent, names in batches:
+            self.assertLessEqual(len(names), 4)
+            self.assertIn(parent, self.dirs)
+
+    def testRemovesTreeBottomUp(self):
+        self.assertEqual(sorted(self.deleter.removeFiles(self.files)),
+                         sorted(self.files))
+        # parents first on the list, still removed after their sub-dirs
+        self.assertEqual(sorted(self.deleter.removeDirs(self.dirs)),
+                         sorted(self.dirs))
+        self.assertEqual(os.listdir(self.rootPath), [])
+        self.assertEqual(cycleMetrics.changes, {"removed": 50,
+                                                "dir removed": 5})
+
+    def testFailedRemovalIsReported(self):
+        kept = os.path.join(self.rootPath, "a", "b", "kept")
+        writeFile(kept, b"not obsolete")
+        self.deleter.removeFiles(self.files)
+        with self.assertLogs("main.helpingClasses", "ERROR"):
+            removed = self.deleter.removeDirs(self.dirs)
+        # the dirs holding it are kept, the others removed
+        self.assertEqual(sorted(removed), sorted(
+            os.path.join(self.rootPath, d) for d in ("a/b/c", "d", "d/e")))
+        self.assertTrue(os.path.isfile(kept))
+
+
+if __name__ == "__main__":
+    unittest.main()
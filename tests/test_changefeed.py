@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+'''Tests of the change feed (see --changeFeed): one coalesced record per
+changed dest path and cycle, sequence numbers going on across restarts.
+Run from the repo root: python -m unittest discover tests
+'''
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+repoPath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repoPath)
+
+from helpingClasses import ChangeFeed, changeFeed
+from startSyncing import syncCycle
+
+opts = {"pipeline": "sequential"}
+
+
+def writeFile(absPath, content):
+    os.makedirs(os.path.dirname(absPath), exist_ok=True)
+    with open(absPath, 'wb') as f:
+        f.write(content)
+
+
+class ChangeFeedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rootPath = tempfile.mkdtemp(prefix="syncFeed_")
+        self.addCleanup(shutil.rmtree, self.rootPath)
+        self.src = os.path.join(self.rootPath, "src")
+        self.dest = os.path.join(self.rootPath, "dest")
+        os.mkdir(self.dest)
+        self.feedPath = os.path.join(self.rootPath, "feed.jsonl")
+        writeFile(os.path.join(self.src, "a", "f"), b"f")
+        writeFile(os.path.join(self.src, "a", "g"), b"g")
+        writeFile(os.path.join(self.src, "h"), b"h")
+        # the syncing records into the shared feed
+        changeFeed.open(self.feedPath, self.dest)
+        self.addCleanup(self.closeFeed)
+
+    def closeFeed(self):
+        if changeFeed.file is not None:
+            changeFeed.file.close()
+        changeFeed.file = None
+        changeFeed.reset()
+
+    def cycle(self):
+        '''Runs a cycle, returns the records it fed
+        '''
+        before = os.path.getsize(self.feedPath)
+        syncCycle(self.src, [self.dest], opts)
+        changeFeed.commit()
+        with open(self.feedPath, encoding="utf-8") as f:
+            f.seek(before)
+            return [json.loads(line) for line in f]
+
+    def changes(self, records):
+        return sorted((rec["op"], rec["path"], rec.get("from"))
+                      for rec in records if rec["op"] != "cycle-end")
+
+    def testFeedsNetChanges(self):
+        records = self.cycle()
+        self.assertEqual(self.changes(records), [
+            ("created", "a", None), ("created", os.path.join("a", "f"), None),
+            ("created", os.path.join("a", "g"), None),
+            ("created", "h", None)])
+        self.assertEqual(records[-1]["op"], "cycle-end")
+        self.assertEqual(records[-1]["changes"], 4)
+        self.assertEqual([rec["seq"] for rec in records], [1, 2, 3, 4, 5])
+
+        os.rename(os.path.join(self.src, "h"), os.path.join(self.src, "i"))
+        writeFile(os.path.join(self.src, "a", "f"), b"edited")
+        os.remove(os.path.join(self.src, "a", "g"))
+        records = self.cycle()
+        self.assertEqual(self.changes(records), [
+            ("changed", os.path.join("a", "f"), None),
+            ("deleted", os.path.join("a", "g"), None),
+            ("moved", "i", "h")])
+        # nothing changed, nothing but the cycle end fed
+        self.assertEqual([rec["op"] for rec in self.cycle()], ["cycle-end"])
+
+    def testSequenceGoesOnAfterRestart(self):
+        self.cycle()
+        self.closeFeed()
+        feed = ChangeFeed()
+        feed.open(self.feedPath, self.dest)
+        self.addCleanup(feed.file.close)
+        self.assertEqual(feed.seq, 5)
+        # a partially written last line is skipped
+        feed.file.write('{"seq": 6, "op": "cre')
+        feed.file.flush()
+        self.assertEqual(feed.lastSeq(), 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+'''Tests of the cloning of a content already in dest (see --cloneMode):
+the further copies are cloned there instead of read from the src, hard
+linked with 'link', and a hard linked dest file gets a copy of its own
+before its mode changes.
+Run from the repo root: python -m unittest discover tests
+'''
+
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+repoPath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repoPath)
+
+from helpingClasses import SrcFile
+from startSyncing import syncCycle
+
+
+def writeFile(absPath, content):
+    os.makedirs(os.path.dirname(absPath), exist_ok=True)
+    with open(absPath, 'wb') as f:
+        f.write(content)
+
+def readFile(absPath):
+    with open(absPath, 'rb') as f:
+        return f.read()
+
+
+class CloneTest(unittest.TestCase):
+
+    pipeline = "sequential"
+
+    def setUp(self):
+        self.rootPath = tempfile.mkdtemp(prefix="syncClone_")
+        self.addCleanup(shutil.rmtree, self.rootPath)
+        self.src = os.path.join(self.rootPath, "src")
+        self.dest = os.path.join(self.rootPath, "dest")
+        os.mkdir(self.dest)
+        self.content = os.urandom(5000)
+        for relPath in ("a/same", "b/same", "b/again"):
+            writeFile(os.path.join(self.src, relPath), self.content)
+        self.addCleanup(setattr, SrcFile, "cloneMode", SrcFile.cloneMode)
+
+    def sync(self, cloneMode):
+        SrcFile.cloneMode = cloneMode
+        cloned = []
+        cloneFile = SrcFile.cloneFile
+        def recordingCloneFile(f, fromAbsP, newAbsP, *args, **kwargs):
+            cloned.append(newAbsP)
+            return cloneFile(f, fromAbsP, newAbsP, *args, **kwargs)
+        with mock.patch.object(SrcFile, "cloneFile", recordingCloneFile):
+            syncCycle(self.src, [self.dest], {"pipeline": self.pipeline,
+                                              "hashWorkers": 1,
+                                              "copyWorkers": 2})
+        for relPath in ("a/same", "b/same", "b/again"):
+            self.assertEqual(readFile(os.path.join(self.dest, relPath)),
+                             self.content)
+        return len(cloned)
+
+    def destStat(self, relPath):
+        return os.stat(os.path.join(self.dest, relPath))
+
+    def testClonedFromDest(self):
+        self.assertEqual(self.sync("reflink"), 2)
+
+    def testAlwaysCopiedFromSrc(self):
+        self.assertEqual(self.sync("none"), 0)
+
+    def testLinkedUntilModeChanges(self):
+        self.sync("link")
+        self.assertEqual(self.destStat("a/same").st_nlink, 3)
+        os.chmod(os.path.join(self.src, "b", "same"), 0o600)
+        self.sync("link")
+        self.assertEqual(stat.S_IMODE(self.destStat("b/same").st_mode), 0o600)
+        self.assertEqual(self.destStat("b/same").st_nlink, 1)
+        # the other copies keep their mode, and keep it in the next cycle
+        modes = [stat.S_IMODE(self.destStat(p).st_mode)
+                 for p in ("a/same", "b/again")]
+        self.assertNotIn(0o600, modes)
+        self.sync("link")
+        self.assertEqual([stat.S_IMODE(self.destStat(p).st_mode)
+                          for p in ("a/same", "b/again")], modes)
+        self.assertEqual(stat.S_IMODE(self.destStat("b/same").st_mode), 0o600)
+
+
+class PipelinedCloneTest(CloneTest):
+
+    pipeline = "async"
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,377 @@
+# -*- coding: utf-8 -*-
+
+'''Scenario tests: every option is run over several sync cycles, with the
+src changed in between, and the dest has to end up equal to the src.
+Every scenario runs in a process of its own (see Scenario), as the options
+are set on the module level objects shared by the syncing steps.
+Run from the repo root: python -m unittest discover tests
+'''
+
+import json
+import os
+import shutil
+import socket
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+repoPath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# runs a Syncer, one cycle per line read from stdin
+driver = '''
+import json, sys
+sys.path.insert(0, sys.argv[1])
+from startSyncing import Syncer, setUpLogging
+conf = json.loads(sys.argv[2])
+setUpLogging(conf["logFile"])
+args = conf["args"]
+opts = {name[2:]: value for name, value in zip(args[::2], args[1::2])}
+opts.setdefault("journal", conf["logFile"] + ".journal")
+syncer = Syncer(conf["src"], conf["dests"], 1, opts,
+                indexPath=conf["logFile"] + ".index")
+for line in sys.stdin:
+    syncer.syncOnce()
+    print("synced", flush=True)
+syncer.close()
+'''
+
+def treeState(rootPath, excluded=()):
+    '''Returns {relPath: (mode bits, content or None for a dir)} of the
+    tree at rootPath(str), leaving out the names in excluded
+    '''
+    state = {}
+    for dirPath, dirNames, fileNames in os.walk(rootPath):
+        dirNames[:] = [d for d in dirNames if d not in excluded]
+        for name in dirNames + fileNames:
+            if name in excluded:
+                continue
+            absPath = os.path.join(dirPath, name)
+            relPath = os.path.relpath(absPath, rootPath)
+            mode = stat.S_IMODE(os.lstat(absPath).st_mode)
+            if os.path.isdir(absPath):
+                state[relPath] = (mode, None)
+            else:
+                with open(absPath, 'rb') as f:
+                    state[relPath] = (mode, f.read())
+    return state
+
+def writeFile(absPath, content, ageSeconds=0):
+    os.makedirs(os.path.dirname(absPath), exist_ok=True)
+    with open(absPath, 'wb') as f:
+        f.write(content)
+    if ageSeconds:
+        ageFile(absPath, ageSeconds)
+
+def ageFile(absPath, ageSeconds):
+    past = time.time() - ageSeconds
+    os.utime(absPath, (past, past))
+
+def freePort():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class Scenario(object):
+    '''A src dir, its dest dir(s) and a syncing process with the options
+    args(list of command line arguments)
+    '''
+
+    def __init__(self, testCase, args=(), destCount=1, remote=False):
+        self.testCase = testCase
+        self.rootPath = tempfile.mkdtemp(prefix="syncScenario_")
+        self.src = os.path.join(self.rootPath, "src")
+        self.dests = [os.path.join(self.rootPath, f"dest{i}")
+                      for i in range(destCount)]
+        self.logFile = os.path.join(self.rootPath, "log.txt")
+        self.stderr = open(os.path.join(self.rootPath, "stderr.txt"), 'w+')
+        for d in [self.src] + self.dests:
+            os.mkdir(d)
+        self.receiver = None
+        dests = self.dests
+        if remote:
+            port = freePort()
+            self.receiver = subprocess.Popen(
+                [sys.executable, os.path.join(repoPath, "receiveSyncing.py"),
+                 "--dest", self.dests[0], "--port", str(port),
+                 "--logFile", os.path.join(self.rootPath, "receiver.txt")],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            self.waitForPort(port)
+            dests = [f"tcp://127.0.0.1:{port}"]
+        conf = {"src": self.src, "dests": dests, "logFile": self.logFile,
+                "args": list(args)}
+        self.process = subprocess.Popen(
+            [sys.executable, "-c", driver, repoPath, json.dumps(conf)],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=self.stderr, text=True)
+
+    def waitForPort(self, port):
+        for attempt in range(100):
+            try:
+                socket.create_connection(("127.0.0.1", port), 0.1).close()
+                return
+            except OSError:
+                time.sleep(0.05)
+        self.testCase.fail("Receiver did not start listening")
+
+    def cycle(self):
+        '''Runs a sync cycle, failing the test if the process fails
+        '''
+        self.process.stdin.write("cycle\n")
+        self.process.stdin.flush()
+        if self.process.stdout.readline().strip() != "synced":
+            self.process.wait()
+            self.testCase.fail("Sync cycle failed:\n" + self.errors())
+
+    def errors(self):
+        self.stderr.seek(0)
+        return self.stderr.read()[-5000:]
+
+    def srcPath(self, relPath):
+        return os.path.join(self.src, relPath)
+
+    def assertInSync(self, excluded=()):
+        expected = treeState(self.src, excluded)
+        for d in self.dests:
+            found = treeState(d, excluded)
+            differing = sorted(p for p in set(expected) | set(found)
+                               if expected.get(p) != found.get(p))
+            self.testCase.assertEqual(differing, [],
+                                      f"'{d}' differs from the src")
+
+    def syncUntilInSync(self, maxCycles, excluded=()):
+        '''Runs cycles until the dest is in sync, at most maxCycles
+        '''
+        expected = treeState(self.src, excluded)
+        for c in range(maxCycles):
+            self.cycle()
+            if all(treeState(d, excluded) == expected for d in self.dests):
+                return c + 1
+        self.assertInSync(excluded)
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+        if self.receiver is not None:
+            self.receiver.terminate()
+            self.receiver.wait()
+        self.stderr.close()
+        shutil.rmtree(self.rootPath)
+
+
+class ConvergenceTest(unittest.TestCase):
+    '''Three cycles, with changes of the src in between (see changeSrc):
+    the dest has to be equal to the src after every one of them
+    '''
+    args = []
+    destCount = 1
+    remote = False
+    excluded = ()
+    ageSeconds = 0 # age given to the src files written, see --minFileAge
+
+    def setUp(self):
+        self.scenario = Scenario(self, self.args, self.destCount, self.remote)
+        self.addCleanup(self.scenario.close)
+
+    def write(self, relPath, content):
+        writeFile(self.scenario.srcPath(relPath), content, self.ageSeconds)
+
+    def changeSrc(self, step):
+        '''Changes the src in a different way before every cycle
+        '''
+        src = self.scenario.srcPath
+        if step == 0:
+            for i in range(5):
+                self.write(f"a/file{i}", os.urandom(3000 + i))
+            self.write("a/b/deep", b"deep" * 100)
+            self.write("a/b/c/deeper", b"deeper")
+            self.write("c/same1", b"same content" * 50)
+            self.write("c/same2", b"same content" * 50)
+            self.write("c/empty", b"")
+            self.write("c/x/in", b"x")
+            self.write("top.tmp", b"temp")
+            self.write("a/name.syncipy-tmp", b"not a temp file")
+            os.link(src("a/file0"), src("c/linked"))
+        elif step == 1:
+            # modified in place, added, renamed, moved dir, removed, chmod
+            with open(src("a/file1"), 'r+b') as f:
+                f.write(b"changed")
+            self.write("a/new", os.urandom(5000))
+            os.rename(src("a/file2"), src("a/file2.renamed"))
+            os.rename(src("a/b"), src("c/b.moved"))
+            os.remove(src("a/file3"))
+            os.chmod(src("a/file4"), 0o600)
+        else:
+            # copied content, dir replaced by a file, swapped names, chmod
+            # of one of two files with the same content
+            shutil.copyfile(src("a/new"), src("c/new.copy"))
+            shutil.rmtree(src("c/x"))
+            self.write("c/x", b"now a file")
+            os.rename(src("a/file0"), src("swap"))
+            os.rename(src("a/file1"), src("a/file0"))
+            os.rename(src("swap"), src("a/file1"))
+            os.chmod(src("c/same2"), 0o640)
+        if self.ageSeconds:
+            for dirPath, dirNames, fileNames in os.walk(self.scenario.src):
+                for name in fileNames:
+                    ageFile(os.path.join(dirPath, name), self.ageSeconds)
+
+    def syncCycle(self):
+        self.scenario.cycle()
+        self.scenario.assertInSync(self.excluded)
+
+    def testConverges(self):
+        for step in range(3):
+            self.changeSrc(step)
+            self.syncCycle()
+
+    def testKeepsFilesNamedLikeTempFiles(self):
+        self.changeSrc(0)
+        self.syncCycle()
+        if self.remote:
+            return
+        destPath = os.path.join(self.scenario.dests[0], "a",
+                                "name.syncipy-tmp")
+        inode = os.stat(destPath).st_ino
+        self.syncCycle()
+        self.assertEqual(os.stat(destPath).st_ino, inode)
+
+    def testRepairsDestDrift(self):
+        self.changeSrc(0)
+        self.syncCycle()
+        dest = self.scenario.dests[0]
+        if self.remote:
+            return
+        # changed behind the back of the syncing, dir mtimes unchanged
+        os.chmod(os.path.join(dest, "a", "file4"), 0o600)
+        with open(os.path.join(dest, "a", "b", "deep"), 'r+b') as f:
+            f.write(b"DEEP")
+        self.syncCycle()
+
+
+class PipelineAsyncTest(ConvergenceTest):
+    args = ["--pipeline", "async"]
+
+class SchedulerAdaptiveTest(ConvergenceTest):
+    args = ["--scheduler", "adaptive"]
+
+class IoLimitTest(ConvergenceTest):
+    args = ["--ioLimit", "*=read:50M,write:50M,ops:5000"]
+
+class ScrubTest(ConvergenceTest):
+    args = ["--scrub", "100%"]
+
+class IndexTest(ConvergenceTest):
+    args = ["--indexThreshold", "0"]
+
+class ChangeFeedTest(ConvergenceTest):
+
+    def setUp(self):
+        self.feedPath = tempfile.mktemp(prefix="syncFeed_")
+        self.args = ["--changeFeed", self.feedPath]
+        ConvergenceTest.setUp(self)
+        self.addCleanup(lambda: os.path.exists(self.feedPath) and
+                        os.remove(self.feedPath))
+
+class CopyOrderRecentTest(ConvergenceTest):
+    args = ["--copyOrder", "recent", "--priorityPaths", "c/*"]
+
+class CopyOrderSmallestTest(ConvergenceTest):
+    args = ["--copyOrder", "smallest"]
+
+class RangeCopyTest(ConvergenceTest):
+    args = ["--rangeCopyThreshold", "1K", "--rangeCopyWorkers", "3"]
+
+class ExcludeTest(ConvergenceTest):
+    args = ["--exclude", "*.tmp"]
+    excluded = ("top.tmp",)
+
+class MinFileAgeTest(ConvergenceTest):
+    args = ["--minFileAge", "60", "--followUpWait", "0"]
+    ageSeconds = 120
+
+class CloneModeLinkTest(ConvergenceTest):
+    args = ["--cloneMode", "link"]
+
+class CloneModeNoneTest(ConvergenceTest):
+    args = ["--cloneMode", "none"]
+
+class StorageHddTest(ConvergenceTest):
+    args = ["--storage", "hdd"]
+
+class StorageSsdTest(ConvergenceTest):
+    args = ["--storage", "ssd"]
+
+class SeveralDestsTest(ConvergenceTest):
+    destCount = 2
+
+class RemoteDestTest(ConvergenceTest):
+    remote = True
+
+
+class CycleBudgetTest(ConvergenceTest):
+    '''With a budget, the dest catches up over several cycles
+    '''
+    args = ["--cycleBudget", "bytes:1"]
+
+    def syncCycle(self):
+        self.scenario.syncUntilInSync(40, self.excluded)
+
+class IndexedCycleBudgetTest(CycleBudgetTest):
+    args = ["--cycleBudget", "bytes:1", "--indexThreshold", "0"]
+
+class ScrubCycleBudgetTest(CycleBudgetTest):
+    args = ["--cycleBudget", "bytes:1", "--scrub", "100%"]
+
+    def testScrubKeepsToTheBudget(self):
+        self.changeSrc(0)
+        self.syncCycle()
+        # every src file changed: the scrub must neither take them as
+        # corrupt replicas, nor copy them beyond the budget
+        for dirPath, dirNames, fileNames in os.walk(self.scenario.src):
+            for name in fileNames:
+                with open(os.path.join(dirPath, name), 'ab') as f:
+                    f.write(b"+")
+        self.scenario.cycle()
+        with open(self.scenario.logFile) as f:
+            log = f.read()
+        self.assertNotIn("does not match its source", log)
+        self.syncCycle()
+
+class BudgetDirRenameTest(unittest.TestCase):
+    '''The dest files of a renamed dir, whose src files are left for later
+    cycles, are kept until then, instead of being removed and copied again
+    '''
+    args = ["--cycleBudget", "bytes:1"]
+
+    def testRenamedDirIsKept(self):
+        scenario = Scenario(self, self.args)
+        self.addCleanup(scenario.close)
+        for i in range(6):
+            writeFile(scenario.srcPath(f"d/file{i}"), os.urandom(2000 + i))
+        scenario.syncUntilInSync(20)
+        os.rename(scenario.srcPath("d"), scenario.srcPath("renamed"))
+        writeFile(scenario.srcPath("other"), os.urandom(100))
+        dest = scenario.dests[0]
+        for c in range(3):
+            scenario.cycle()
+            kept = sum(len(fileNames) for d in ("d", "renamed")
+                       for dirPath, dirNames, fileNames in
+                       os.walk(os.path.join(dest, d)))
+            self.assertGreaterEqual(kept, 6)
+        scenario.syncUntilInSync(20)
+        with open(scenario.logFile) as f:
+            self.assertNotIn(".ERROR:", f.read())
+
+class IndexedBudgetDirRenameTest(BudgetDirRenameTest):
+    args = ["--cycleBudget", "bytes:1", "--indexThreshold", "0"]
+
+class AsyncBudgetDirRenameTest(BudgetDirRenameTest):
+    args = ["--cycleBudget", "bytes:1", "--pipeline", "async"]
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+'''Tests of the ordering of the copies of a cycle (see --copyOrder and
+--priorityPaths) and of the replication lag reported for them.
+Run from the repo root: python -m unittest discover tests
+'''
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+repoPath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repoPath)
+
+from helpingClasses import SrcFile, copyOrdering, cycleMetrics
+from startSyncing import syncCycle
+
+
+def writeFile(absPath, content, mtime):
+    os.makedirs(os.path.dirname(absPath), exist_ok=True)
+    with open(absPath, 'wb') as f:
+        f.write(content)
+    os.utime(absPath, (mtime, mtime))
+
+
+class CopyOrderTest(unittest.TestCase):
+
+    pipeline = "sequential"
+
+    def setUp(self):
+        self.rootPath = tempfile.mkdtemp(prefix="syncCopyOrder_")
+        self.addCleanup(shutil.rmtree, self.rootPath)
+        self.src = os.path.join(self.rootPath, "src")
+        self.dest = os.path.join(self.rootPath, "dest")
+        os.mkdir(self.dest)
+        # (relPath, size, mtime): found in tree order a, b, c/d, c/e
+        for relPath, size, mtime in (("a", 300, 1000), ("b", 100, 3000),
+                                     ("c/d", 400, 4000), ("c/e", 200, 2000)):
+            writeFile(os.path.join(self.src, relPath),
+                      b"x" * size + relPath.encode(), mtime)
+        self.addCleanup(copyOrdering.setPolicy, "tree")
+        self.addCleanup(cycleMetrics.reset)
+
+    def copiedInOrder(self, policy, priorityGlobs=()):
+        '''Runs a cycle, returns the relPaths of the copies in order
+        '''
+        copyOrdering.setPolicy(policy, priorityGlobs)
+        copied = []
+        cpFile = SrcFile.cpFile
+        def recordingCpFile(f, curAbsP, newAbsP, *args, **kwargs):
+            copied.append(os.path.relpath(newAbsP, self.dest))
+            return cpFile(f, curAbsP, newAbsP, *args, **kwargs)
+        cycleMetrics.reset()
+        with mock.patch.object(SrcFile, "cpFile", recordingCpFile):
+            syncCycle(self.src, [self.dest], {"pipeline": self.pipeline,
+                                              "hashWorkers": 1,
+                                              "copyWorkers": 1})
+        return copied
+
+    def testRecentFirst(self):
+        self.assertEqual(self.copiedInOrder("recent"),
+                         [os.path.join("c", "d"), "b",
+                          os.path.join("c", "e"), "a"])
+
+    def testSmallestFirst(self):
+        self.assertEqual(self.copiedInOrder("smallest"),
+                         ["b", os.path.join("c", "e"), "a",
+                          os.path.join("c", "d")])
+
+    def testPriorityPathsFirst(self):
+        self.assertEqual(self.copiedInOrder("smallest", ["c/*"]),
+                         [os.path.join("c", "e"), os.path.join("c", "d"),
+                          "b", "a"])
+
+    def testReportsLag(self):
+        self.copiedInOrder("tree")
+        # the oldest src file was modified in 1970
+        self.assertGreater(cycleMetrics.maxLag, 10 ** 9)
+
+
+class PipelinedCopyOrderTest(CopyOrderTest):
+
+    pipeline = "async"
+
+
+if __name__ == "__main__":
+    unittest.main()
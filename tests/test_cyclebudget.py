@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+'''Tests of the cap of the work of a cycle (see --cycleBudget and
+CycleBudget): the src files beyond the budget are left for later cycles,
+their dest counterparts kept, and the scrub leaves them out too.
+Run from the repo root: python -m unittest discover tests
+'''
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+repoPath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repoPath)
+
+from helpingClasses import ReplicaScrubber, cycleBudget
+from helpingFuncs import parseCycleBudget
+from startSyncing import syncCycle
+
+
+def writeFile(absPath, content, mtime=1000):
+    os.makedirs(os.path.dirname(absPath), exist_ok=True)
+    with open(absPath, 'wb') as f:
+        f.write(content)
+    os.utime(absPath, (mtime, mtime))
+
+def readFile(absPath):
+    with open(absPath, 'rb') as f:
+        return f.read()
+
+def resetBudget(seconds=None, maxBytes=None):
+    cycleBudget.setUp(seconds, maxBytes)
+    cycleBudget.cursor = ""
+    cycleBudget.startNs = None
+    cycleBudget.lastStartNs = None
+
+
+class CycleBudgetTest(unittest.TestCase):
+
+    pipeline = "sequential"
+
+    def setUp(self):
+        self.rootPath = tempfile.mkdtemp(prefix="syncBudget_")
+        self.addCleanup(shutil.rmtree, self.rootPath)
+        self.src = os.path.join(self.rootPath, "src")
+        self.dest = os.path.join(self.rootPath, "dest")
+        for i in range(6):
+            writeFile(self.srcPath(f"file{i}"), bytes([i]) * 1000)
+        # the previous version of a file left for the next cycle
+        writeFile(os.path.join(self.dest, "file5"), b"previous")
+        resetBudget(maxBytes=2500)
+        self.addCleanup(resetBudget)
+
+    def srcPath(self, relPath):
+        return os.path.join(self.src, relPath)
+
+    def sync(self):
+        return syncCycle(self.src, [self.dest], {"pipeline": self.pipeline,
+                                                 "hashWorkers": 2,
+                                                 "copyWorkers": 2})
+
+    def testSpreadOverCycles(self):
+        self.sync()
+        # taken in by relative path, until the budget is spent
+        self.assertEqual(sorted(os.listdir(self.dest)),
+                         ["file0", "file1", "file2", "file5"])
+        self.assertEqual(readFile(os.path.join(self.dest, "file5")),
+                         b"previous")
+        self.assertEqual(cycleBudget.cursor, "file2")
+        self.sync()
+        self.assertEqual(cycleBudget.cursor, "")
+        for i in range(6):
+            self.assertEqual(readFile(os.path.join(self.dest, f"file{i}")),
+                             bytes([i]) * 1000)
+
+    def testRecentFilesFirst(self):
+        self.sync()
+        # modified since the last cycle started: ahead of the backlog
+        writeFile(self.srcPath("file4"), b"recent", time.time())
+        cycleBudget.setUp(None, 1)
+        self.sync()
+        self.assertEqual(readFile(os.path.join(self.dest, "file4")),
+                         b"recent")
+        self.assertFalse(os.path.exists(os.path.join(self.dest, "file3")))
+        self.assertEqual(cycleBudget.cursor, "file2")
+
+    def testScrubLeavesPostponedFilesOut(self):
+        srcSnap = self.sync()
+        # the budget is not what keeps the scrub off them
+        cycleBudget.setUp(None, None)
+        scrubber = ReplicaScrubber(1.0)
+        with self.assertNoLogs("main.helpingClasses", "WARNING"):
+            scrubber.scrub(srcSnap, self.src, self.dest)
+        self.assertEqual(readFile(os.path.join(self.dest, "file5")),
+                         b"previous")
+
+
+class PipelinedCycleBudgetTest(CycleBudgetTest):
+
+    pipeline = "async"
+
+
+class ParseCycleBudgetTest(unittest.TestCase):
+
+    def testSpecs(self):
+        self.assertEqual(parseCycleBudget("time:600,bytes:2K"),
+                         (600.0, 2048))
+        self.assertEqual(parseCycleBudget("bytes:1"), (None, 1))
+        for spec in ("time:0", "size:5", "bytes"):
+            with self.assertRaises(ValueError):
+                parseCycleBudget(spec)
+
+
+if __name__ == "__main__":
+    unittest.main()
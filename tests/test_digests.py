@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+'''Tests of the skipping of unchanged subtrees (see SubtreeDigests): only
+subtrees unchanged in src and dest are skipped, and drift of the replica
+within them is repaired.
+Run from the repo root: python -m unittest discover tests
+'''
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+repoPath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repoPath)
+
+from helpingClasses import cycleMetrics, subtreeDigests
+from startSyncing import syncCycle
+
+
+def writeFile(absPath, content):
+    os.makedirs(os.path.dirname(absPath), exist_ok=True)
+    with open(absPath, 'wb') as f:
+        f.write(content)
+
+
+class SubtreeSkipTest(unittest.TestCase):
+
+    pipeline = "sequential"
+
+    def setUp(self):
+        self.rootPath = tempfile.mkdtemp(prefix="syncDigests_")
+        self.addCleanup(shutil.rmtree, self.rootPath)
+        self.src = os.path.join(self.rootPath, "src")
+        self.dest = os.path.join(self.rootPath, "dest")
+        os.mkdir(self.dest)
+        for relPath in ("a/f", "a/g", "b/f", "b/c/f"):
+            writeFile(os.path.join(self.src, relPath), relPath.encode())
+        savedEntries = subtreeDigests.entries
+        subtreeDigests.entries = {}
+        def restore():
+            subtreeDigests.entries = savedEntries
+        self.addCleanup(restore)
+        self.addCleanup(cycleMetrics.reset)
+        self.cycle()
+
+    def cycle(self):
+        '''Runs a cycle, returns (the dest dirs skipped, the changes done)
+        '''
+        cycleMetrics.reset()
+        skipped = set()
+        findUnchanged = subtreeDigests.findUnchanged
+        def recordingFindUnchanged(*args):
+            skipped.update(findUnchanged(*args))
+            return skipped
+        with mock.patch.object(subtreeDigests, "findUnchanged",
+                               recordingFindUnchanged):
+            syncCycle(self.src, [self.dest], {"pipeline": self.pipeline,
+                                              "hashWorkers": 2,
+                                              "copyWorkers": 2})
+        return skipped, dict(cycleMetrics.changes)
+
+    def testUnchangedTreeIsSkipped(self):
+        skipped, changes = self.cycle()
+        self.assertEqual(skipped, {self.dest})
+        self.assertEqual(changes, {})
+
+    def testChangedSubtreeIsSynced(self):
+        writeFile(os.path.join(self.src, "b", "c", "f"), b"changed")
+        skipped, changes = self.cycle()
+        self.assertEqual(skipped, {os.path.join(self.dest, "a")})
+        self.assertEqual(changes["copied"], 1)
+        with open(os.path.join(self.dest, "b", "c", "f"), 'rb') as f:
+            self.assertEqual(f.read(), b"changed")
+
+    def testDestDriftIsRepaired(self):
+        destPath = os.path.join(self.dest, "a", "g")
+        os.chmod(destPath, 0o600)
+        os.chmod(os.path.join(self.src, "a", "g"), 0o640)
+        self.cycle()
+        os.chmod(destPath, 0o600)
+        skipped, changes = self.cycle()
+        self.assertNotIn(os.path.join(self.dest, "a"), skipped)
+        self.assertEqual(os.stat(destPath).st_mode & 0o777, 0o640)
+
+
+class PipelinedSubtreeSkipTest(SubtreeSkipTest):
+
+    pipeline = "async"
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+'''Tests of the scanning and syncing relative to open dir fds: the results
+are the same as with absolute paths, and no dir fd is left open.
+Run from the repo root: python -m unittest discover tests
+'''
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+repoPath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repoPath)
+
+from helpingClasses import BaseFile, SrcFile, SrcDir
+from helpingFuncs import getDirSnapshotAndAdapt, fetchExistingDestFiles
+from helpingFuncs import openDirFd, closeDirFd
+
+
+def writeFile(absPath, content):
+    os.makedirs(os.path.dirname(absPath), exist_ok=True)
+    with open(absPath, 'wb') as f:
+        f.write(content)
+
+def openFdCount():
+    return len(os.listdir("/proc/self/fd"))
+
+
+@unittest.skipUnless(BaseFile.useDirFds, "dir fds are not supported")
+class DirFdScanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rootPath = tempfile.mkdtemp(prefix="syncDirFds_")
+        self.addCleanup(shutil.rmtree, self.rootPath)
+        self.src = os.path.join(self.rootPath, "src")
+        for relPath in ("a", "b/c/d", "b/e", "f/g/h/i"):
+            writeFile(os.path.join(self.src, relPath), relPath.encode())
+        self.addCleanup(setattr, BaseFile, "useDirFds", BaseFile.useDirFds)
+
+    def scan(self, useDirFds):
+        '''Returns ({relPath of src dir: names of its files}, {hash: dest
+        relPaths}, dest dir relPaths) of a snapshot of src adapting a dest
+        dir of its own, and the dest listing
+        '''
+        BaseFile.useDirFds = useDirFds
+        dest = os.path.join(self.rootPath, f"dest{useDirFds}")
+        os.mkdir(dest)
+        writeFile(os.path.join(dest, "b", "old"), b"old")
+        srcSnap = {}
+        getDirSnapshotAndAdapt(srcSnap, SrcDir(self.src, self.src), 0,
+                               self.src, dest)
+        files = {srcD.getRelPath(): sorted(f.getName() for f in
+                                           srcD.getContainedFiles())
+                 for lvl in srcSnap for srcD in srcSnap[lvl]}
+        destFiles, destDirs = {}, []
+        fetchExistingDestFiles(dest, destFiles, destDirs)
+        destFiles = {h: sorted(os.path.relpath(t[0], dest) for t in l)
+                     for h, l in destFiles.items()}
+        destDirs = sorted(os.path.relpath(d, dest) for d in destDirs)
+        return files, destFiles, destDirs
+
+    def testSameAsAbsolutePaths(self):
+        withFds = self.scan(True)
+        self.assertEqual(withFds, self.scan(False))
+        files, destFiles, destDirs = withFds
+        self.assertEqual(files["b/c"], ["d"])
+        self.assertEqual(destDirs, ["b", "b/c", "f", "f/g", "f/g/h"])
+
+    def testNoDirFdLeftOpen(self):
+        before = openFdCount()
+        self.scan(True)
+        self.assertEqual(openFdCount(), before)
+
+    def testLinkRelativeToDirFd(self):
+        dest = os.path.join(self.rootPath, "dest")
+        os.mkdir(dest)
+        os.link(os.path.join(self.src, "a"), os.path.join(self.src, "j"))
+        shutil.copyfile(os.path.join(self.src, "a"), os.path.join(dest, "a"))
+        writeFile(os.path.join(dest, "j"), b"separate copy")
+        destDirFd = openDirFd(dest, "")
+        try:
+            linked = SrcFile(os.path.join(self.src, "j")).linkFile(
+                os.path.join(dest, "a"), os.path.join(dest, "j"), {},
+                destDirFd)
+        finally:
+            closeDirFd(destDirFd)
+        self.assertEqual(linked, os.path.join(dest, "j"))
+        self.assertEqual(os.stat(os.path.join(dest, "a")).st_ino,
+                         os.stat(os.path.join(dest, "j")).st_ino)
+        self.assertEqual(sorted(os.listdir(dest)), ["a", "j"])
+
+
+if __name__ == "__main__":
+    unittest.main()
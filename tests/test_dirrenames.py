@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+'''Tests of the detection of renamed src dirs (see DirRenameDetector): the
+dest dir is renamed as a whole, instead of being rebuilt file by file.
+Run from the repo root: python -m unittest discover tests
+'''
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+repoPath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repoPath)
+
+from helpingClasses import cycleMetrics
+from startSyncing import syncCycle
+
+opts = {"pipeline": "sequential"}
+
+
+def writeFile(absPath, content):
+    os.makedirs(os.path.dirname(absPath), exist_ok=True)
+    with open(absPath, 'wb') as f:
+        f.write(content)
+
+
+class DirRenameTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rootPath = tempfile.mkdtemp(prefix="syncDirRenames_")
+        self.addCleanup(shutil.rmtree, self.rootPath)
+        self.src = os.path.join(self.rootPath, "src")
+        self.dest = os.path.join(self.rootPath, "dest")
+        os.mkdir(self.dest)
+        for i in range(20):
+            writeFile(os.path.join(self.src, "old", f"f{i}"), os.urandom(50))
+        writeFile(os.path.join(self.src, "old", "sub", "g"), b"g")
+        self.addCleanup(cycleMetrics.reset)
+        self.cycle()
+
+    def cycle(self):
+        cycleMetrics.reset()
+        syncCycle(self.src, [self.dest], opts)
+        return dict(cycleMetrics.changes)
+
+    def testAppliedAsSingleRename(self):
+        inode = os.stat(os.path.join(self.dest, "old")).st_ino
+        os.rename(os.path.join(self.src, "old"),
+                  os.path.join(self.src, "new"))
+        changes = self.cycle()
+        self.assertEqual(changes, {"dir moved": 1})
+        self.assertFalse(os.path.lexists(os.path.join(self.dest, "old")))
+        self.assertEqual(os.stat(os.path.join(self.dest, "new")).st_ino,
+                         inode)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.dest, "new"))),
+                         sorted(os.listdir(os.path.join(self.src, "new"))))
+
+    def testDifferentContentIsNotRenamed(self):
+        inode = os.stat(os.path.join(self.dest, "old")).st_ino
+        os.rename(os.path.join(self.src, "old"),
+                  os.path.join(self.src, "new"))
+        writeFile(os.path.join(self.src, "new", "f0"), b"changed")
+        changes = self.cycle()
+        # created, only the unchanged sub-dir is renamed into it
+        self.assertEqual(changes["dir created"], 1)
+        self.assertEqual(changes["dir moved"], 1)
+        self.assertNotEqual(os.stat(os.path.join(self.dest, "new")).st_ino,
+                            inode)
+        self.assertFalse(os.path.lexists(os.path.join(self.dest, "old")))
+        with open(os.path.join(self.dest, "new", "f0"), 'rb') as f:
+            self.assertEqual(f.read(), b"changed")
+
+
+if __name__ == "__main__":
+    unittest.main()
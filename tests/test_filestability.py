@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+'''Tests of the deferred copies of src files being written (see
+--minFileAge and FileStability): their dest counterpart is kept, the copy
+is made by the follow-up pass once they settle, or by a later cycle; dest
+files are hashed whatever their age.
+Run from the repo root: python -m unittest discover tests
+'''
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+repoPath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repoPath)
+
+from helpingClasses import DestFile, fileStability
+from startSyncing import syncCycle
+
+opts = {"pipeline": "sequential"}
+
+
+def writeFile(absPath, content, ageSeconds=0):
+    os.makedirs(os.path.dirname(absPath), exist_ok=True)
+    with open(absPath, 'wb') as f:
+        f.write(content)
+    past = time.time() - ageSeconds
+    os.utime(absPath, (past, past))
+
+def readFile(absPath):
+    with open(absPath, 'rb') as f:
+        return f.read()
+
+
+class FileStabilityTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rootPath = tempfile.mkdtemp(prefix="syncStability_")
+        self.addCleanup(shutil.rmtree, self.rootPath)
+        self.src = os.path.join(self.rootPath, "src")
+        self.dest = os.path.join(self.rootPath, "dest")
+        writeFile(os.path.join(self.src, "old"), b"settled", 120)
+        writeFile(os.path.join(self.src, "a", "written"), b"new content")
+        # the previous version of the file being written
+        writeFile(os.path.join(self.dest, "a", "written"), b"previous", 120)
+        self.addCleanup(fileStability.setUp, 0, 2.0)
+
+    def testRecentFileLeftForLaterCycle(self):
+        fileStability.setUp(60, 0.1)
+        syncCycle(self.src, [self.dest], opts)
+        self.assertEqual(readFile(os.path.join(self.dest, "old")),
+                         b"settled")
+        self.assertEqual(readFile(os.path.join(self.dest, "a", "written")),
+                         b"previous")
+        fileStability.setUp(0, 0.1)
+        syncCycle(self.src, [self.dest], opts)
+        self.assertEqual(readFile(os.path.join(self.dest, "a", "written")),
+                         b"new content")
+
+    def testCopiedByFollowUpOnceSettled(self):
+        fileStability.setUp(1, 5)
+        started = time.time()
+        syncCycle(self.src, [self.dest], opts)
+        self.assertGreaterEqual(time.time() - started, 0.5)
+        self.assertEqual(readFile(os.path.join(self.dest, "a", "written")),
+                         b"new content")
+
+    def testDestFilesHashedWhateverTheirAge(self):
+        fileStability.setUp(60, 0.1)
+        destPath = os.path.join(self.dest, "recent")
+        writeFile(destPath, b"just copied")
+        destF = DestFile(destPath)
+        self.assertFalse(destF.unstable)
+        self.assertNotEqual(destF.getHash(), "")
+
+
+if __name__ == "__main__":
+    unittest.main()
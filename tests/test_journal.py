@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+'''Tests of the atomic copies and of the journal of the sync cycles (see
+--journal): replay, checkpoints and compaction.
+Run from the repo root: python -m unittest discover tests
+'''
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+repoPath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repoPath)
+
+from helpingClasses import SrcFile, SyncJournal, hashCache, subtreeDigests
+from helpingClasses import cycleBudget
+
+
+def readRecords(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+class JournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rootPath = tempfile.mkdtemp(prefix="syncJournal_")
+        self.addCleanup(shutil.rmtree, self.rootPath)
+        self.path = os.path.join(self.rootPath, "journal")
+        # the journal replays into the shared hash cache and digests
+        savedEntries = hashCache.entries
+        savedDigests = subtreeDigests.entries
+        hashCache.entries = {}
+        subtreeDigests.entries = {}
+        def restore():
+            hashCache.entries = savedEntries
+            subtreeDigests.entries = savedDigests
+        self.addCleanup(restore)
+        self.journal = SyncJournal()
+        self.addCleanup(self.closeJournal)
+
+    def closeJournal(self):
+        if self.journal.file is not None:
+            self.journal.file.close()
+
+    def reopened(self):
+        self.closeJournal()
+        hashCache.entries = {}
+        subtreeDigests.entries = {}
+        self.journal = SyncJournal()
+        return self.journal.open(self.path)
+
+    def testReplaysIntoHashCache(self):
+        self.journal.open(self.path)
+        self.journal.record("hash", path="/a", key=[1, 2, 3], hash="h1")
+        self.journal.record("copy", src="/s", path="/b", key=[4, 5, 6],
+                            hash="h2")
+        self.journal.record("move", **{"from": "/b", "to": "/c"})
+        self.journal.record("remove", path="/a")
+        replayed, interrupted = self.reopened()
+        self.assertEqual((replayed, interrupted), (4, True))
+        self.assertEqual(hashCache.entries, {"/c": ((4, 5, 6), "h2")})
+
+    def testCheckpointAppendsCycleEnd(self):
+        self.journal.open(self.path)
+        self.journal.record("hash", path="/a", key=[1, 2, 3], hash="h1")
+        self.journal.checkpoint()
+        self.journal.checkpoint()
+        ops = [rec["op"] for rec in readRecords(self.path)]
+        self.assertEqual(ops, ["hash", "cycle-end", "cycle-end"])
+        self.assertEqual(self.reopened(), (3, False))
+        self.assertEqual(hashCache.entries, {"/a": ((1, 2, 3), "h1")})
+
+    def testCompactsGrownJournal(self):
+        self.journal.compactMin = 5
+        self.journal.open(self.path)
+        for i in range(6):
+            self.journal.record("hash", path="/a", key=[i, 0, 0],
+                                hash=f"h{i}")
+        hashCache.entries = {"/a": ((5, 0, 0), "h5")}
+        self.journal.checkpoint()
+        records = readRecords(self.path)
+        self.assertEqual([rec["op"] for rec in records], ["hash", "cycle-end"])
+        self.assertEqual(records[0]["hash"], "h5")
+        self.assertEqual(self.reopened(), (2, False))
+        self.assertEqual(hashCache.entries, {"/a": ((5, 0, 0), "h5")})
+
+    def testSkipsCorruptLastLine(self):
+        self.journal.open(self.path)
+        self.journal.record("hash", path="/a", key=[1, 2, 3], hash="h1")
+        self.journal.file.write('{"op": "hash", "pa')
+        self.assertEqual(self.reopened(), (1, True))
+        self.assertEqual(hashCache.entries, {"/a": ((1, 2, 3), "h1")})
+
+    def testJournalsDigestChanges(self):
+        self.journal.open(self.path)
+        subtreeDigests.entries = {"/d": ("d1", (1, 2, "k")),
+                                  "/e": ("e1", (3, 4, "k"))}
+        self.journal.checkpoint()
+        subtreeDigests.entries = {"/d": ("d2", (5, 2, "k"))}
+        self.journal.checkpoint()
+        # unchanged digests are not journaled again
+        self.journal.checkpoint()
+        ops = [rec["op"] for rec in readRecords(self.path)]
+        self.assertEqual(ops, ["digest", "digest", "cycle-end", "digest",
+                               "remove-digest", "cycle-end", "cycle-end"])
+        self.reopened()
+        self.assertEqual(subtreeDigests.entries, {"/d": ("d2", (5, 2, "k"))})
+
+    def testKeepsBudgetCursor(self):
+        def restoreBudget(saved=(cycleBudget.seconds, cycleBudget.maxBytes,
+                                 cycleBudget.cursor, cycleBudget.startNs)):
+            cycleBudget.setUp(*saved[:2])
+            cycleBudget.cursor, cycleBudget.startNs = saved[2:]
+        self.addCleanup(restoreBudget)
+        cycleBudget.setUp(None, 100)
+        cycleBudget.cursor, cycleBudget.startNs = "d/file3", 123
+        self.journal.compactMin = 1
+        self.journal.open(self.path)
+        self.journal.record("hash", path="/a", key=[1, 2, 3], hash="h1")
+        self.journal.record("hash", path="/a", key=[1, 2, 4], hash="h2")
+        hashCache.entries = {"/a": ((1, 2, 4), "h2")}
+        # compacted, with the cursor
+        self.journal.checkpoint()
+        ops = [rec["op"] for rec in readRecords(self.path)]
+        self.assertEqual(ops, ["hash", "cursor", "cycle-end"])
+        cycleBudget.cursor, cycleBudget.startNs = "", None
+        self.reopened()
+        self.assertEqual((cycleBudget.cursor, cycleBudget.startNs),
+                         ("d/file3", 123))
+
+
+class AtomicCopyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rootPath = tempfile.mkdtemp(prefix="syncCopy_")
+        self.addCleanup(shutil.rmtree, self.rootPath)
+
+    def testCopyLeavesNoTempFile(self):
+        srcPath = os.path.join(self.rootPath, "src")
+        destPath = os.path.join(self.rootPath, "dest")
+        with open(srcPath, 'wb') as f:
+            f.write(os.urandom(10000))
+        with open(destPath, 'wb') as f:
+            f.write(b"old content")
+        self.assertTrue(SrcFile(srcPath).cpFile(srcPath, destPath))
+        with open(srcPath, 'rb') as src, open(destPath, 'rb') as dest:
+            self.assertEqual(src.read(), dest.read())
+        self.assertEqual(sorted(os.listdir(self.rootPath)), ["dest", "src"])
+
+    def testTempNames(self):
+        tmpName = os.path.basename(SrcFile.tempPathFor("/d/name"))
+        self.assertTrue(SrcFile.isTempName(tmpName))
+        self.assertFalse(SrcFile.isTempName("name" + SrcFile.tempSuffix))
+        self.assertFalse(SrcFile.isTempName("." + SrcFile.tempSuffix))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+'''Tests of the replication of the src hard links (see SrcFile.linkFile)
+and of the copies of sparse files.
+Run from the repo root: python -m unittest discover tests
+'''
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+repoPath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repoPath)
+
+from helpingClasses import SrcFile, DestFile
+
+
+def writeFile(absPath, content):
+    with open(absPath, 'wb') as f:
+        f.write(content)
+
+
+class LinkFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rootPath = tempfile.mkdtemp(prefix="syncLinks_")
+        self.addCleanup(shutil.rmtree, self.rootPath)
+        for d in ("src", "dest"):
+            os.mkdir(os.path.join(self.rootPath, d))
+        writeFile(self.path("src", "a"), b"linked content")
+        os.link(self.path("src", "a"), self.path("src", "b"))
+        shutil.copyfile(self.path("src", "a"), self.path("dest", "a"))
+        self.srcF = SrcFile(self.path("src", "b"))
+
+    def path(self, *names):
+        return os.path.join(self.rootPath, *names)
+
+    def assertSameInode(self, path, otherPath):
+        self.assertEqual(os.stat(path).st_ino, os.stat(otherPath).st_ino)
+
+    def testSharesInodeOfLinkedFile(self):
+        self.assertEqual(self.srcF.getLinkKey(),
+                         SrcFile(self.path("src", "a")).getLinkKey())
+        linked = self.srcF.linkFile(self.path("dest", "a"),
+                                    self.path("dest", "b"), {})
+        self.assertEqual(linked, self.path("dest", "b"))
+        self.assertSameInode(self.path("dest", "a"), self.path("dest", "b"))
+        self.assertEqual(os.stat(self.path("dest", "a")).st_nlink, 2)
+
+    def testReplacesSeparateCopy(self):
+        writeFile(self.path("dest", "b"), b"separate copy")
+        occupying = DestFile(self.path("dest", "b"))
+        destFiles = {occupying.getHash():
+                     [(self.path("dest", "b"), occupying)]}
+        self.srcF.linkFile(self.path("dest", "a"), self.path("dest", "b"),
+                           destFiles)
+        self.assertSameInode(self.path("dest", "a"), self.path("dest", "b"))
+        # no longer tracked, so not removed as obsolete
+        self.assertEqual(destFiles, {})
+        self.assertEqual(sorted(os.listdir(self.path("dest"))), ["a", "b"])
+
+    def testLinkAlreadyInPlace(self):
+        os.link(self.path("dest", "a"), self.path("dest", "b"))
+        inode = os.stat(self.path("dest", "b")).st_ino
+        linked = self.srcF.linkFile(self.path("dest", "a"),
+                                    self.path("dest", "b"), {})
+        self.assertEqual(linked, self.path("dest", "b"))
+        self.assertEqual(os.stat(self.path("dest", "b")).st_ino, inode)
+
+    def testDirIsNotReplaced(self):
+        os.mkdir(self.path("dest", "b"))
+        self.assertIsNone(self.srcF.linkFile(self.path("dest", "a"),
+                                             self.path("dest", "b"), {}))
+        self.assertTrue(os.path.isdir(self.path("dest", "b")))
+
+
+class SparseCopyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rootPath = tempfile.mkdtemp(prefix="syncSparse_")
+        self.addCleanup(shutil.rmtree, self.rootPath)
+
+    def testCopyKeepsHoles(self):
+        srcPath = os.path.join(self.rootPath, "sparse")
+        destPath = os.path.join(self.rootPath, "copy")
+        size = 64 * 2**20
+        with open(srcPath, 'wb') as f:
+            f.truncate(size)
+            f.seek(size // 2)
+            f.write(b"data in the middle")
+        srcF = SrcFile(srcPath)
+        if not(srcF.isSparse()):
+            self.skipTest("holes are not supported by the file system")
+        self.assertTrue(srcF.cpFile(srcPath, destPath))
+        copied = os.stat(destPath)
+        self.assertEqual(copied.st_size, size)
+        self.assertLess(copied.st_blocks * 512, size // 2)
+        with open(srcPath, 'rb') as src, open(destPath, 'rb') as dest:
+            self.assertEqual(src.read(), dest.read())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+'''Tests of the syncing of one source to several destinations (see
+syncToBackends): every destination ends up as the source, and a failing
+destination does not stop the others.
+Run from the repo root: python -m unittest discover tests
+'''
+
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import unittest
+
+repoPath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repoPath)
+
+from startSyncing import syncCycle
+
+opts = {"pipeline": "sequential"}
+
+
+def writeFile(absPath, content):
+    os.makedirs(os.path.dirname(absPath), exist_ok=True)
+    with open(absPath, 'wb') as f:
+        f.write(content)
+
+def treeState(rootPath):
+    state = {}
+    for dirPath, dirNames, fileNames in os.walk(rootPath):
+        for name in dirNames + fileNames:
+            absPath = os.path.join(dirPath, name)
+            relPath = os.path.relpath(absPath, rootPath)
+            if os.path.isdir(absPath):
+                state[relPath] = None
+            else:
+                with open(absPath, 'rb') as f:
+                    state[relPath] = f.read()
+    return state
+
+def closedPort():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class MultiDestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rootPath = tempfile.mkdtemp(prefix="syncMultiDest_")
+        self.addCleanup(shutil.rmtree, self.rootPath)
+        self.src = os.path.join(self.rootPath, "src")
+        self.dests = [os.path.join(self.rootPath, d) for d in ("r1", "r2")]
+        for dest in self.dests:
+            os.mkdir(dest)
+        for i in range(10):
+            writeFile(os.path.join(self.src, f"d{i % 2}", f"f{i}"),
+                      os.urandom(100))
+        # content already in r2, at another path
+        shutil.copytree(os.path.join(self.src, "d0"),
+                        os.path.join(self.dests[1], "old"))
+
+    def testAllDestsSynced(self):
+        syncCycle(self.src, self.dests, opts)
+        for dest in self.dests:
+            self.assertEqual(treeState(dest), treeState(self.src))
+        os.rename(os.path.join(self.src, "d1"),
+                  os.path.join(self.src, "d0", "d1"))
+        os.remove(os.path.join(self.src, "d0", "f0"))
+        syncCycle(self.src, self.dests, opts)
+        for dest in self.dests:
+            self.assertEqual(treeState(dest), treeState(self.src))
+
+    def testFailingDestDoesNotStopOthers(self):
+        dests = [f"tcp://127.0.0.1:{closedPort()}"] + self.dests
+        with self.assertLogs("main.destBackends", "ERROR"):
+            syncCycle(self.src, dests, opts)
+        for dest in self.dests:
+            self.assertEqual(treeState(dest), treeState(self.src))
+
+
+if __name__ == "__main__":
+    unittest.main()
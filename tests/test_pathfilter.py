@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+'''Tests of the include/exclude rules (see PathFilter): the first matching
+rule wins, --include goes before --exclude and both before the rules of
+--filterFile; excluded entries are neither synced, nor removed from dest.
+Run from the repo root: python -m unittest discover tests
+'''
+
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+repoPath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repoPath)
+
+from helpingClasses import PathFilter, pathFilter
+from helpingFuncs import validateInput, validateOptionalInput
+from startSyncing import syncCycle
+
+
+def writeFile(absPath, content):
+    os.makedirs(os.path.dirname(absPath), exist_ok=True)
+    with open(absPath, 'wb') as f:
+        f.write(content)
+
+
+class PathFilterTest(unittest.TestCase):
+
+    def filterOf(self, rules):
+        pathFilter = PathFilter()
+        pathFilter.setRules(rules)
+        return pathFilter
+
+    def testFirstMatchingRuleWins(self):
+        f = self.filterOf([(True, "keep.log"), (False, "*.log"),
+                           (True, "*.log")])
+        self.assertFalse(f.excludes("a/keep.log"))
+        self.assertTrue(f.excludes("a/other.log"))
+        self.assertFalse(f.excludes("a/other.txt"))
+
+    def testPatterns(self):
+        f = self.filterOf([(False, "build/"), (False, "docs/*.tmp"),
+                           (False, "re:cache/[0-9]+")])
+        # a trailing '/' matches dirs only
+        self.assertTrue(f.excludes("a/build", True))
+        self.assertFalse(f.excludes("a/build"))
+        # with a '/', the whole relative path is matched
+        self.assertTrue(f.excludes("docs/x.tmp"))
+        self.assertFalse(f.excludes("a/docs/x.tmp"))
+        self.assertTrue(f.excludes("cache/12"))
+        self.assertFalse(f.excludes("cache/12a"))
+        self.assertTrue(f.excludesTree("a/build/sub/file"))
+
+    def testInvalidFilterFileLines(self):
+        self.assertEqual(PathFilter.parseRules(["# comment", "",
+                                                "+ *.txt", "- tmp/"]),
+                         [(True, "*.txt"), (False, "tmp/")])
+        with self.assertRaises(ValueError):
+            PathFilter.parseRules(["*.txt"])
+
+
+class FilterOptionsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rootPath = os.path.realpath(tempfile.mkdtemp(
+            prefix="syncFilter_"))
+        self.addCleanup(shutil.rmtree, self.rootPath)
+        self.src = os.path.join(self.rootPath, "src")
+        self.dest = os.path.join(self.rootPath, "dest")
+        os.mkdir(self.src)
+        self.filterFile = os.path.join(self.rootPath, "rules")
+        with open(self.filterFile, 'w', encoding="utf-8") as f:
+            f.write("# tried after the options\n- *.txt\n+ tmp/\n- *.bak\n")
+        self.addCleanup(pathFilter.setRules, [])
+
+    def rulesOf(self, *optional):
+        av = ["startSyncing.py", "--src", self.src, "--dest", self.dest,
+              "--logFile", os.path.join(self.rootPath, "log"),
+              "--syncPeriod", "10"] + list(optional)
+        with contextlib.redirect_stdout(io.StringIO()):
+            src, dests, p, logF, created = validateInput(av)
+            return validateOptionalInput(av, src, dests, p,
+                                         logF)["filterRules"]
+
+    def testRuleOrder(self):
+        rules = self.rulesOf("--exclude", "tmp/,*.log", "--include",
+                             "keep.log", "--filterFile", self.filterFile)
+        self.assertEqual(rules, [(True, "keep.log"), (False, "tmp/"),
+                                 (False, "*.log"), (False, "*.txt"),
+                                 (True, "tmp/"), (False, "*.bak")])
+        pathFilter.setRules(rules)
+        writeFile(os.path.join(self.src, "keep.log"), b"synced")
+        writeFile(os.path.join(self.src, "other.log"), b"excluded")
+        writeFile(os.path.join(self.src, "tmp", "a"), b"excluded")
+        writeFile(os.path.join(self.src, "notes.txt"), b"excluded")
+        writeFile(os.path.join(self.src, "data"), b"synced")
+        # excluded in dest as well, so it is kept
+        writeFile(os.path.join(self.dest, "old.bak"), b"kept")
+        syncCycle(self.src, [self.dest], {"pipeline": "sequential"})
+        self.assertEqual(sorted(os.listdir(self.dest)),
+                         ["data", "keep.log", "old.bak"])
+
+    def testInvalidRules(self):
+        with self.assertRaises(SystemExit):
+            self.rulesOf("--exclude", "re:(")
+        with open(self.filterFile, 'a', encoding="utf-8") as f:
+            f.write("no sign\n")
+        with self.assertRaises(SystemExit):
+            self.rulesOf("--filterFile", self.filterFile)
+
+
+if __name__ == "__main__":
+    unittest.main()
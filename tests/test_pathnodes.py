@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+'''Tests of the interned dir nodes the sync loop puts the file paths
+together from (see PathNodes): the same paths as os.path.join/normpath,
+one node per dir, dropped between cycles.
+Run from the repo root: python -m unittest discover tests
+'''
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+repoPath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repoPath)
+
+from helpingClasses import PathNodes, pathNodes
+from startSyncing import syncCycle
+
+
+class PathNodesTest(unittest.TestCase):
+
+    def testSamePathsAsJoined(self):
+        nodes = PathNodes()
+        for rootPath in ("/data/src", "/data/src/", "/"):
+            for relPath in (".", "a", os.path.join("a", "b"),
+                            os.path.join(".", "a", "b")):
+                node = nodes.dirOf(rootPath, relPath)
+                self.assertEqual(node.absPath, os.path.normpath(
+                    os.path.join(rootPath, relPath)))
+                self.assertEqual(node.filePath("f"), os.path.normpath(
+                    os.path.join(rootPath, relPath, "f")))
+
+    def testInterned(self):
+        nodes = PathNodes()
+        node = nodes.dirOf("/data/src", os.path.join("a", "b"))
+        self.assertIs(nodes.dirOf("/data/src", os.path.join("a", "b")), node)
+        self.assertIs(node.parent, nodes.dirOf("/data/src", "a"))
+        self.assertEqual(node.name, "b")
+        nodes.reset()
+        self.assertIsNot(nodes.dirOf("/data/src", os.path.join("a", "b")),
+                         node)
+
+
+class NodesDroppedBetweenCyclesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rootPath = tempfile.mkdtemp(prefix="syncPathNodes_")
+        self.addCleanup(shutil.rmtree, self.rootPath)
+        self.src = os.path.join(self.rootPath, "src")
+        self.dest = os.path.join(self.rootPath, "dest")
+        os.makedirs(os.path.join(self.src, "a", "b"))
+        os.mkdir(self.dest)
+        with open(os.path.join(self.src, "a", "b", "f"), 'wb') as f:
+            f.write(b"content")
+
+    def testSyncsAfterDirsChange(self):
+        opts = {"pipeline": "sequential"}
+        syncCycle(self.src, [self.dest], opts)
+        self.assertTrue(os.path.isfile(os.path.join(self.dest, "a", "b",
+                                                    "f")))
+        # the dir nodes of the last cycle do not outlive it
+        os.rename(os.path.join(self.src, "a"), os.path.join(self.src, "c"))
+        os.mkdir(os.path.join(self.src, "a"))
+        syncCycle(self.src, [self.dest], opts)
+        self.assertEqual(sorted(os.listdir(self.dest)), ["a", "c"])
+        self.assertEqual(os.listdir(os.path.join(self.dest, "a")), [])
+        self.assertTrue(os.path.isfile(os.path.join(self.dest, "c", "b",
+                                                    "f")))
+        self.assertIn(self.src, pathNodes.roots)
+
+
+if __name__ == "__main__":
+    unittest.main()
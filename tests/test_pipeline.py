@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+'''Tests of the async pipeline (see --pipeline): a cycle syncs the same as
+the sequential one, also with more files than fit in a batch, and the
+dest copies of src files which cannot be hashed are kept.
+Run from the repo root: python -m unittest discover tests
+'''
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+repoPath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repoPath)
+
+import syncPipeline
+from helpingClasses import SrcFile, DestFile
+from startSyncing import syncSnapshot, removeObsoleteDest
+
+
+def writeFile(absPath, content):
+    os.makedirs(os.path.dirname(absPath), exist_ok=True)
+    with open(absPath, 'wb') as f:
+        f.write(content)
+
+def treeState(rootPath):
+    state = {}
+    for dirPath, dirNames, fileNames in os.walk(rootPath):
+        for name in dirNames + fileNames:
+            absPath = os.path.join(dirPath, name)
+            relPath = os.path.relpath(absPath, rootPath)
+            if os.path.isdir(absPath):
+                state[relPath] = None
+            else:
+                with open(absPath, 'rb') as f:
+                    state[relPath] = f.read()
+    return state
+
+
+class PipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rootPath = tempfile.mkdtemp(prefix="syncPipeline_")
+        self.addCleanup(shutil.rmtree, self.rootPath)
+        self.src = os.path.join(self.rootPath, "src")
+        self.dest = os.path.join(self.rootPath, "dest")
+        os.mkdir(self.src)
+        os.mkdir(self.dest)
+
+    def cycle(self):
+        syncPipeline.runPipelinedCycle(self.src, self.dest, syncSnapshot,
+                                       removeObsoleteDest, 3, 3)
+
+    def testSyncsMoreFilesThanABatch(self):
+        for i in range(3 * syncPipeline.batchSize + 1):
+            writeFile(os.path.join(self.src, f"d{i % 4}", f"f{i}"),
+                      os.urandom(100 + i))
+        writeFile(os.path.join(self.dest, "obsolete", "old"), b"old")
+        self.cycle()
+        self.assertEqual(treeState(self.dest), treeState(self.src))
+        # moved in src: moved in dest as well
+        os.rename(os.path.join(self.src, "d1"),
+                  os.path.join(self.src, "d0", "moved"))
+        self.cycle()
+        self.assertEqual(treeState(self.dest), treeState(self.src))
+
+    def testKeepsDestOfUnhashableSrcFile(self):
+        writeFile(os.path.join(self.src, "d", "locked"), b"old content")
+        writeFile(os.path.join(self.src, "d", "other"), b"other")
+        self.cycle()
+        writeFile(os.path.join(self.src, "d", "locked"), b"new content")
+        hashFile = SrcFile.hashFile
+        def failingHashFile(f, dirAbsPath, *args):
+            if f.getName() == "locked" and not(isinstance(f, DestFile)):
+                raise PermissionError("cannot read")
+            return hashFile(f, dirAbsPath, *args)
+        with mock.patch.object(SrcFile, "hashFile", failingHashFile):
+            with self.assertLogs("main.syncPipeline", "ERROR"):
+                self.cycle()
+        with open(os.path.join(self.dest, "d", "locked"), 'rb') as f:
+            self.assertEqual(f.read(), b"old content")
+        # synced once it can be hashed
+        self.cycle()
+        self.assertEqual(treeState(self.dest), treeState(self.src))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+'''Tests of the copies of large files as byte ranges (see
+--rangeCopyThreshold): same content, whether the kernel copies the ranges
+or the pread/pwrite fallback does, and a shrinking source fails.
+Run from the repo root: python -m unittest discover tests
+'''
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+repoPath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repoPath)
+
+from helpingClasses import SrcFile
+
+
+@unittest.skipUnless(hasattr(os, "pwrite"), "pread/pwrite not supported")
+class RangeCopyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rootPath = tempfile.mkdtemp(prefix="syncRangeCopy_")
+        self.addCleanup(shutil.rmtree, self.rootPath)
+        self.srcPath = os.path.join(self.rootPath, "src")
+        self.destPath = os.path.join(self.rootPath, "dest")
+        # not a multiple of the range size
+        self.content = os.urandom(10 * 4096 + 123)
+        with open(self.srcPath, 'wb') as f:
+            f.write(self.content)
+        for name, value in (("rangeCopyThreshold", 4096),
+                            ("rangeSize", 4096), ("rangeCopyWorkers", 3)):
+            self.addCleanup(setattr, SrcFile, name, getattr(SrcFile, name))
+            setattr(SrcFile, name, value)
+
+    def copy(self):
+        srcF = SrcFile(self.srcPath)
+        self.assertTrue(srcF.isForRangeCopy())
+        with mock.patch.object(SrcFile, "copyRange",
+                               wraps=srcF.copyRange) as copyRange:
+            self.assertTrue(srcF.cpFile(self.srcPath, self.destPath))
+        with open(self.destPath, 'rb') as f:
+            self.assertEqual(f.read(), self.content)
+        return copyRange.call_count
+
+    def testCopiedAsRanges(self):
+        self.assertEqual(self.copy(), 11)
+
+    def testFallbackToPreadPwrite(self):
+        def unsupported(*args):
+            raise OSError("not supported")
+        with mock.patch.object(os, "copy_file_range", unsupported,
+                               create=True):
+            self.assertEqual(self.copy(), 11)
+
+    def testBelowThresholdNotRanges(self):
+        SrcFile.rangeCopyThreshold = len(self.content) + 1
+        self.assertFalse(SrcFile(self.srcPath).isForRangeCopy())
+        SrcFile.rangeCopyThreshold = None
+        self.assertFalse(SrcFile(self.srcPath).isForRangeCopy())
+
+    def testShrinkingSourceFails(self):
+        srcF = SrcFile(self.srcPath)
+        with open(self.srcPath, 'rb') as src, open(self.destPath, 'wb') as dest:
+            with self.assertRaises(OSError):
+                srcF.copyRange(src.fileno(), dest.fileno(),
+                               len(self.content) - 100, 200)
+
+
+if __name__ == "__main__":
+    unittest.main()
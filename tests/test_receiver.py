@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+'''Tests of the receiver daemon protocol (see SyncReceiver): failing
+requests are replied to with an error, and the requests after them are
+still served.
+Run from the repo root: python -m unittest discover tests
+'''
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+repoPath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repoPath)
+
+from destBackends import SyncReceiver, RemoteDestBackend
+from destBackends import getSrcManifest, stageDirName
+
+
+class ReceiverTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rootPath = tempfile.mkdtemp(prefix="syncReceiver_")
+        self.addCleanup(shutil.rmtree, self.rootPath)
+        self.dest = os.path.join(self.rootPath, "dest")
+        os.mkdir(self.dest)
+        self.receiver = SyncReceiver(self.dest, "127.0.0.1", 0)
+        self.addCleanup(self.receiver.server.close)
+        port = self.receiver.server.getsockname()[1]
+        self.served = threading.Thread(target=self.serveOne)
+        self.served.start()
+        self.sender = RemoteDestBackend("127.0.0.1", port, timeout=10)
+        self.sender.open()
+        self.addCleanup(self.closeSender)
+
+    def serveOne(self):
+        conn, address = self.receiver.server.accept()
+        with conn:
+            self.finished = self.receiver.serveSender(conn)
+
+    def closeSender(self):
+        self.sender.close()
+        self.served.join(10)
+
+    def assertErrorReply(self, op, args):
+        self.sender.request(op, args)
+        with self.assertLogs("main.destBackends", "ERROR"):
+            with self.assertRaises(RuntimeError):
+                self.sender.collect()
+
+    def testInvalidRequests(self):
+        self.assertErrorReply("unknown", {})
+        self.assertErrorReply("index", {})
+        self.assertEqual(self.sender.makeDirs(["a"]), [])
+        self.assertTrue(os.path.isdir(os.path.join(self.dest, "a")))
+
+    def testFailingRequest(self):
+        with open(os.path.join(self.dest, "f"), 'wb') as f:
+            f.write(b"content")
+        # the staging dir cannot be created
+        with open(os.path.join(self.dest, stageDirName), 'wb') as f:
+            pass
+        self.assertErrorReply("stage", {"items": ["f"]})
+        files, dirs = self.sender.fetchIndex()
+        self.assertEqual(sorted(files), ["f"])
+        self.sender.request("finish", {})
+        self.sender.collect()
+        self.closeSender()
+        self.assertTrue(self.finished)
+
+
+class SrcManifestTest(unittest.TestCase):
+
+    def testStageDirNameIsNotSynced(self):
+        src = tempfile.mkdtemp(prefix="syncManifest_")
+        self.addCleanup(shutil.rmtree, src)
+        os.mkdir(os.path.join(src, stageDirName))
+        with open(os.path.join(src, stageDirName, "f"), 'wb') as f:
+            f.write(b"content")
+        os.mkdir(os.path.join(src, "d"))
+        with self.assertLogs("main.destBackends", "WARNING"):
+            files, dirs = getSrcManifest(src)
+        self.assertEqual((files, dirs), ({}, {"d"}))
+
+
+if __name__ == "__main__":
+    unittest.main()
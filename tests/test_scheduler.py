@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+'''Tests of the waiting times picked by SyncScheduler (see --scheduler) and
+of the change counting of CycleMetrics.
+Run from the repo root: python -m unittest discover tests
+'''
+
+import os
+import sys
+import unittest
+
+repoPath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repoPath)
+
+from helpingClasses import SyncScheduler, CycleMetrics
+
+
+class FixedSchedulerTest(unittest.TestCase):
+
+    def testWaitsUntilNextMultipleOfPeriod(self):
+        scheduler = SyncScheduler(60)
+        self.assertEqual(scheduler.nextWaitingTime(10.5, 0), 50)
+        self.assertEqual(scheduler.nextWaitingTime(10.5, 3), 50)
+        # a cycle overrunning the period loses almost a whole one
+        self.assertEqual(scheduler.nextWaitingTime(61, 0), 59)
+
+    def testWarnsAboutConsistentOverruns(self):
+        scheduler = SyncScheduler(10, overrunWindow=2)
+        with self.assertLogs("main.helpingClasses", "WARNING"):
+            scheduler.nextWaitingTime(11, 0)
+            scheduler.nextWaitingTime(12, 0)
+
+
+class AdaptiveSchedulerTest(unittest.TestCase):
+
+    def testBacksOffWhileIdle(self):
+        scheduler = SyncScheduler(60, "adaptive", maxPeriod=200)
+        waits = [scheduler.nextWaitingTime(0, 0) for i in range(4)]
+        self.assertEqual(waits, [60, 120, 200, 200])
+
+    def testHalvesPeriodAfterChanges(self):
+        scheduler = SyncScheduler(60, "adaptive")
+        for i in range(3):
+            scheduler.nextWaitingTime(0, 0)
+        self.assertEqual(scheduler.nextWaitingTime(10, 5), 20)
+        # idle again: back to the period, measured from the cycle start
+        self.assertEqual(scheduler.nextWaitingTime(10, 0), 50)
+
+    def testStartsRightAwayAfterLongCycle(self):
+        scheduler = SyncScheduler(60, "adaptive")
+        self.assertEqual(scheduler.nextWaitingTime(100, 1), 0)
+
+
+class CycleMetricsTest(unittest.TestCase):
+
+    def testCountsChangesByKind(self):
+        metrics = CycleMetrics()
+        self.assertEqual(str(metrics), "no changes")
+        metrics.addChange("copied")
+        metrics.addChange("moved", 2)
+        metrics.addChange("copied")
+        self.assertEqual(metrics.getChangeCount(), 4)
+        self.assertEqual(str(metrics), "copied: 2, moved: 2")
+        metrics.reset()
+        self.assertEqual(metrics.getChangeCount(), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+'''Tests of the rolling scrub of the replica (see --scrub): a share of the
+replica per cycle in rotating order, and corrupted files copied again.
+Run from the repo root: python -m unittest discover tests
+'''
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+repoPath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repoPath)
+
+from helpingClasses import ReplicaScrubber
+from helpingFuncs import parseScrubBudget
+from startSyncing import syncCycle
+
+opts = {"pipeline": "sequential"}
+
+
+def writeFile(absPath, content):
+    os.makedirs(os.path.dirname(absPath), exist_ok=True)
+    with open(absPath, 'wb') as f:
+        f.write(content)
+
+
+class ScrubTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rootPath = tempfile.mkdtemp(prefix="syncScrub_")
+        self.addCleanup(shutil.rmtree, self.rootPath)
+        self.src = os.path.join(self.rootPath, "src")
+        self.dest = os.path.join(self.rootPath, "dest")
+        os.mkdir(self.dest)
+        for name in ("a", "b", "d/c", "d/e"):
+            writeFile(os.path.join(self.src, name), name.encode() * 100)
+        self.srcSnap = syncCycle(self.src, [self.dest], opts)
+
+    def corrupt(self, relPath):
+        '''Flips the content of a dest file, keeping its size and
+        modification time, so that the hash cache does not notice
+        '''
+        absPath = os.path.join(self.dest, relPath)
+        stat = os.stat(absPath)
+        with open(absPath, 'r+b') as f:
+            f.write(b"X")
+        os.utime(absPath, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+    def testRotatesThroughTheReplica(self):
+        scrubber = ReplicaScrubber(byteBudget=150)
+        cursors = []
+        with self.assertLogs("main.helpingClasses", "INFO"):
+            for i in range(5):
+                scrubber.scrub(self.srcSnap, self.src, self.dest)
+                cursors.append(scrubber.cursor)
+        # a single file of 100 bytes fits the budget
+        self.assertEqual(cursors, ["a", "b", "d/c", "d/e", "a"])
+        self.assertEqual(scrubber.passes, 1)
+
+    def testCopiesCorruptedFileAgain(self):
+        self.corrupt("d/c")
+        scrubber = ReplicaScrubber(fraction=1.0)
+        with self.assertLogs("main.helpingClasses", "WARNING"):
+            scrubber.scrub(self.srcSnap, self.src, self.dest)
+        with open(os.path.join(self.dest, "d", "c"), 'rb') as f:
+            self.assertEqual(f.read(), b"d/c" * 100)
+
+    def testBudgetSpecs(self):
+        self.assertEqual(parseScrubBudget("5%"), (0.05, None))
+        self.assertEqual(parseScrubBudget("2M"), (None, 2 * 2**20))
+        for spec in ("0%", "150%", "0", "-1K", "many"):
+            with self.assertRaises(ValueError):
+                parseScrubBudget(spec)
+
+
+if __name__ == "__main__":
+    unittest.main()
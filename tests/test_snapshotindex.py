@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+'''Tests of the cycles run on the SQLite snapshot index (see
+runIndexedCycle): same outcome as the in memory cycles, content moved
+rather than copied again, and the staging dir name reserved.
+Run from the repo root: python -m unittest discover tests
+'''
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+repoPath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repoPath)
+
+from helpingClasses import cycleMetrics
+from destBackends import stageDirName
+from snapshotIndex import SnapshotIndex, runIndexedCycle
+
+
+def writeFile(absPath, content):
+    os.makedirs(os.path.dirname(absPath), exist_ok=True)
+    with open(absPath, 'wb') as f:
+        f.write(content)
+
+def treeState(rootPath):
+    state = {}
+    for dirPath, dirNames, fileNames in os.walk(rootPath):
+        for name in dirNames + fileNames:
+            absPath = os.path.join(dirPath, name)
+            relPath = os.path.relpath(absPath, rootPath)
+            if os.path.isdir(absPath):
+                state[relPath] = None
+            else:
+                with open(absPath, 'rb') as f:
+                    state[relPath] = f.read()
+    return state
+
+
+class IndexedCycleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rootPath = tempfile.mkdtemp(prefix="syncIndex_")
+        self.addCleanup(shutil.rmtree, self.rootPath)
+        self.src = os.path.join(self.rootPath, "src")
+        self.dest = os.path.join(self.rootPath, "dest")
+        os.mkdir(self.dest)
+        for i in range(30):
+            writeFile(os.path.join(self.src, f"d{i % 3}", f"f{i}"),
+                      os.urandom(64))
+        writeFile(os.path.join(self.dest, "obsolete", "old"), b"old")
+        self.index = SnapshotIndex()
+        self.index.setUp(os.path.join(self.rootPath, "index.db"), 0)
+        self.addCleanup(self.closeIndex)
+        self.addCleanup(cycleMetrics.reset)
+
+    def closeIndex(self):
+        if self.index.db is not None:
+            self.index.db.close()
+
+    def cycle(self):
+        cycleMetrics.reset()
+        runIndexedCycle(self.src, self.dest, self.index)
+        return dict(cycleMetrics.changes)
+
+    def testSyncsTree(self):
+        self.cycle()
+        self.assertEqual(treeState(self.dest), treeState(self.src))
+        self.assertEqual(self.cycle(), {})
+
+    def testMovesInsteadOfCopying(self):
+        self.cycle()
+        os.rename(os.path.join(self.src, "d1"),
+                  os.path.join(self.src, "d0", "moved"))
+        os.rename(os.path.join(self.src, "d2", "f2"),
+                  os.path.join(self.src, "f2"))
+        changes = self.cycle()
+        self.assertNotIn("copied", changes)
+        self.assertEqual(treeState(self.dest), treeState(self.src))
+
+    def testStageDirNameIsNotSynced(self):
+        writeFile(os.path.join(self.src, stageDirName, "f"), b"reserved")
+        self.cycle()
+        self.assertFalse(os.path.lexists(os.path.join(self.dest,
+                                                      stageDirName)))
+        expected = treeState(self.src)
+        for relPath in (stageDirName, os.path.join(stageDirName, "f")):
+            expected.pop(relPath)
+        self.assertEqual(treeState(self.dest), expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+
+'''Tests of the adaptation of the I/O to the storage (see --storage and
+StorageProfile): physical order of the reads on a rotational src, more
+workers on non-rotational storage.
+Run from the repo root: python -m unittest discover tests
+'''
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+repoPath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repoPath)
+
+from helpingClasses import SrcFile, StorageProfile, copyOrdering, hashCache
+from helpingClasses import storageProfile
+from startSyncing import Syncer
+
+
+def writeFile(absPath, content):
+    os.makedirs(os.path.dirname(absPath), exist_ok=True)
+    with open(absPath, 'wb') as f:
+        f.write(content)
+
+
+class StorageProfileTest(unittest.TestCase):
+
+    def profile(self, mode, detected):
+        profile = StorageProfile()
+        with mock.patch.object(StorageProfile, "detect",
+                               side_effect=detected):
+            profile.setUp(mode, "/src", ["/dest"])
+        return profile
+
+    def testDetected(self):
+        hdd = self.profile("auto", [(True, 128), (False, 256)])
+        self.assertTrue(hdd.rotational)
+        self.assertEqual(hdd.workersFor(4), 4)
+        ssd = self.profile("auto", [(False, 256), (False, 64)])
+        self.assertFalse(ssd.rotational)
+        # the shallowest queue of src and dests
+        self.assertEqual(ssd.workersFor(4), 8)
+        # a dest of unknown storage is not taken as an SSD
+        unknown = self.profile("auto", [(False, 256), (None, None)])
+        self.assertEqual(unknown.workersFor(4), 4)
+
+    def testGiven(self):
+        self.assertTrue(self.profile("hdd", [(None, None)] * 2).rotational)
+        ssd = self.profile("ssd", [(None, None)] * 2)
+        self.assertEqual(ssd.workersFor(4), StorageProfile.ssdQueueDepth // 8)
+        none = self.profile("none", [])
+        self.assertFalse(none.rotational)
+        self.assertEqual(none.workersFor(4), 4)
+
+
+class ReadOrderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rootPath = tempfile.mkdtemp(prefix="syncStorage_")
+        self.addCleanup(shutil.rmtree, self.rootPath)
+        self.files = []
+        for name in ("a", "b", "c"):
+            writeFile(os.path.join(self.rootPath, name), name.encode() * 100)
+            self.files.append((SrcFile(os.path.join(self.rootPath, name),
+                                       hashNow=False), self.rootPath))
+        self.addCleanup(setattr, hashCache, "entries", hashCache.entries)
+        hashCache.entries = {}
+
+    def namesInOrder(self, profile):
+        return [f.getName() for f, d in profile.orderReads(self.files)]
+
+    def testPhysicalOrderOnRotationalSrc(self):
+        profile = StorageProfile()
+        self.assertEqual(self.namesInOrder(profile), ["a", "b", "c"])
+        profile.rotational = True
+        locations = {"a": (0, 300), "b": (0, 100), "c": (1, 5)}
+        with mock.patch.object(StorageProfile, "locationOf",
+                               lambda p, absPath, inode=0:
+                               locations[os.path.basename(absPath)]):
+            self.assertEqual(self.namesInOrder(profile), ["b", "a", "c"])
+            # not read again, so first
+            f = self.files[2][0]
+            hashCache.store(os.path.join(self.rootPath, "c"),
+                            f.getStatKey(), "h")
+            self.assertEqual(self.namesInOrder(profile), ["c", "b", "a"])
+
+
+class SyncerStorageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rootPath = tempfile.mkdtemp(prefix="syncStorage_")
+        self.addCleanup(shutil.rmtree, self.rootPath)
+        self.src = os.path.join(self.rootPath, "src")
+        os.mkdir(self.src)
+        self.addCleanup(storageProfile.setUp, "none", self.src)
+        self.addCleanup(copyOrdering.setPolicy, "tree")
+
+    def opts(self, **given):
+        syncer = Syncer(self.src, [os.path.join(self.rootPath, "dest")], 1,
+                        given)
+        syncer.close()
+        return syncer.opts
+
+    def testPhysicalCopyOrderOnHdd(self):
+        self.assertEqual(self.opts(storage="hdd")["copyOrder"], "physical")
+        self.assertEqual(self.opts(storage="hdd", copyOrder="recent")[
+            "copyOrder"], "recent")
+        self.assertEqual(self.opts(storage="none")["copyOrder"], "tree")
+
+    def testWorkersOnSsd(self):
+        with mock.patch.object(StorageProfile, "detect",
+                               return_value=(False, 256)):
+            opts = self.opts(storage="ssd")
+            self.assertEqual(opts["hashWorkers"], 32)
+            self.assertEqual(self.opts(storage="ssd", hashWorkers=2)[
+                "hashWorkers"], 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+'''Tests of the Syncer class, for a service embedding the syncing: options
+validated as on the command line, one Syncer at a time, syncOnce and
+runForever/stop, progress and metrics callbacks.
+Run from the repo root: python -m unittest discover tests
+'''
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+repoPath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repoPath)
+
+from startSyncing import Syncer
+
+
+def writeFile(absPath, content):
+    os.makedirs(os.path.dirname(absPath), exist_ok=True)
+    with open(absPath, 'wb') as f:
+        f.write(content)
+
+
+class SyncerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rootPath = tempfile.mkdtemp(prefix="syncSyncer_")
+        self.addCleanup(shutil.rmtree, self.rootPath)
+        self.src = os.path.join(self.rootPath, "src")
+        self.dest = os.path.join(self.rootPath, "dest")
+        os.mkdir(self.dest)
+        for i in range(3):
+            writeFile(os.path.join(self.src, "a", f"file{i}"), os.urandom(100))
+
+    def syncer(self, opts=None, **kwargs):
+        syncer = Syncer(self.src, [self.dest], 1, opts, **kwargs)
+        self.addCleanup(syncer.close)
+        return syncer
+
+    def testInvalidOptions(self):
+        with self.assertRaises(ValueError):
+            self.syncer({"unknown": "1"})
+        with self.assertRaises(ValueError):
+            self.syncer({"scrub": "lots"})
+        # a valid one once the invalid ones are refused
+        self.assertEqual(self.syncer({"scrub": "5%"}).opts["scrub"][0], 0.05)
+
+    def testSingleSyncerAtATime(self):
+        syncer = self.syncer()
+        with self.assertRaises(RuntimeError):
+            self.syncer()
+        syncer.close()
+        self.syncer()
+
+    def testSyncOnceWithCallbacks(self):
+        progress, reported = [], []
+        syncer = self.syncer({"pipeline": "async"},
+                             onProgress=lambda kind, count:
+                             progress.append(kind),
+                             onMetrics=reported.append)
+        metrics = syncer.syncOnce()
+        self.assertEqual(sorted(os.listdir(os.path.join(self.dest, "a"))),
+                         ["file0", "file1", "file2"])
+        self.assertEqual(metrics["changes"]["copied"], 3)
+        self.assertEqual(progress.count("copied"), 3)
+        self.assertEqual(reported, [metrics])
+        # the worker threads stay warm between the cycles
+        pool = syncer.pool
+        self.assertEqual(syncer.syncOnce()["changes"], {})
+        self.assertIs(syncer.pool, pool)
+
+    def testRunForeverUntilStopped(self):
+        cycles = []
+        syncer = self.syncer(onMetrics=cycles.append)
+        runner = threading.Thread(target=syncer.runForever)
+        runner.start()
+        while not cycles:
+            syncer.stopped.wait(0.01)
+        syncer.stop()
+        runner.join(10)
+        self.assertFalse(runner.is_alive())
+        self.assertTrue(os.path.isdir(os.path.join(self.dest, "a")))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+'''Tests of the I/O throttling (see --ioLimit): the token bucket rate and
+the time of day windows.
+Run from the repo root: python -m unittest discover tests
+'''
+
+import datetime as dt
+import os
+import sys
+import unittest
+from unittest import mock
+
+repoPath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repoPath)
+
+import helpingClasses
+from helpingClasses import TokenBucket, IOThrottle
+from helpingFuncs import parseIOLimits
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(helpingClasses.time, "sleep")
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def testBurstOfOneSecond(self):
+        bucket = TokenBucket(1000)
+        self.assertEqual(bucket.consume(1000), 0.0)
+        self.sleep.assert_not_called()
+
+    def testSleepsOffTheDebt(self):
+        bucket = TokenBucket(1000)
+        bucket.consume(1000)
+        waited = bucket.consume(500)
+        # a few tokens may have been added in between
+        self.assertAlmostEqual(waited, 0.5, delta=0.05)
+        self.sleep.assert_called_once_with(waited)
+
+    def testUnlimited(self):
+        for rate in (None, 0):
+            self.assertEqual(TokenBucket(rate).consume(10 ** 12), 0.0)
+        self.sleep.assert_not_called()
+
+
+class TimeWindowTest(unittest.TestCase):
+    '''The limits in effect at a given time of day (see setWindows)
+    '''
+
+    def limitsAt(self, hour, minute, spec):
+        now = dt.datetime(2024, 1, 1, hour, minute)
+        with mock.patch.object(helpingClasses.dt, "datetime") as datetime:
+            datetime.now.return_value = now
+            throttle = IOThrottle()
+            throttle.setWindows(parseIOLimits(spec))
+        return throttle.activeLimits, \
+            {k: b.rate for k, b in throttle.buckets.items()}
+
+    def testFirstMatchingWindowApplies(self):
+        spec = "08:00-20:00=read:20M,ops:200;*=read:1K"
+        limits, rates = self.limitsAt(12, 0, spec)
+        self.assertEqual(limits, {"read": 20 * 2**20, "ops": 200})
+        self.assertEqual(rates, {"read": 20 * 2**20, "write": None,
+                                 "ops": 200})
+        self.assertEqual(self.limitsAt(20, 0, spec)[0], {"read": 1024})
+
+    def testWindowSpanningMidnight(self):
+        spec = "22:00-06:00=write:5M"
+        for hour, minute in ((23, 0), (0, 0), (5, 59)):
+            self.assertEqual(self.limitsAt(hour, minute, spec)[0],
+                             {"write": 5 * 2**20})
+        for hour, minute in ((6, 0), (12, 0), (21, 59)):
+            self.assertEqual(self.limitsAt(hour, minute, spec)[0], {})
+
+    def testInvalidSpecs(self):
+        for spec in ("25:00-26:00=read:1M", "*=speed:1M", "*=read:0"):
+            with self.assertRaises(ValueError):
+                parseIOLimits(spec)
+
+
+if __name__ == "__main__":
+    unittest.main()
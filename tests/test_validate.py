@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+'''Tests of the validation of the src, dest and log/journal/feed locations
+(see validateInput): paths are compared by whole path components, remote
+dests by host and port.
+Run from the repo root: python -m unittest discover tests
+'''
+
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+repoPath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repoPath)
+
+from helpingFuncs import isInside, validateInput, validateOptionalInput
+
+
+class IsInsideTest(unittest.TestCase):
+
+    def testWholeComponents(self):
+        self.assertTrue(isInside("/data/src", "/data/src"))
+        self.assertTrue(isInside("/data/src/a", "/data/src"))
+        self.assertFalse(isInside("/data/src2", "/data/src"))
+        self.assertFalse(isInside("/data", "/data/src"))
+
+
+class ValidateLocationsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rootPath = os.path.realpath(tempfile.mkdtemp(
+            prefix="syncValidate_"))
+        self.addCleanup(shutil.rmtree, self.rootPath)
+        self.src = self.path("data")
+        os.mkdir(self.src)
+        self.logF = self.path("log")
+
+    def path(self, *names):
+        return os.path.join(self.rootPath, *names)
+
+    def validate(self, *dests, logF=None, optional=()):
+        av = ["startSyncing.py", "--src", self.src, "--logFile",
+              logF or self.logF, "--syncPeriod", "10"]
+        for dest in dests:
+            av += ["--dest", dest]
+        av += list(optional)
+        with contextlib.redirect_stdout(io.StringIO()):
+            src, dests, p, logF, created = validateInput(av)
+            return validateOptionalInput(av, src, dests, p, logF)
+
+    def assertRejected(self, *dests, **kwargs):
+        with self.assertRaises(SystemExit):
+            self.validate(*dests, **kwargs)
+
+    def testSiblingsSharingAPrefix(self):
+        # "data" is a prefix of "data2" and "data.journal", but no parent
+        self.validate(self.path("data2"), self.path("data3"),
+                      logF=self.path("data2.log"),
+                      optional=("--journal", self.path("data.journal")))
+
+    def testNestedDirs(self):
+        self.assertRejected(self.path("data", "replica"))
+        self.assertRejected(self.rootPath)
+        self.assertRejected(self.path("r"), self.path("r", "s"))
+        self.assertRejected(self.path("r"), logF=self.path("r", "log"))
+
+    def testJournalInDest(self):
+        os.mkdir(self.path("r"))
+        self.assertRejected(self.path("r"), optional=(
+            "--journal", self.path("r", "journal")))
+
+    def testRemoteDests(self):
+        self.validate("tcp://host:9000", "tcp://host:9001",
+                      "tcp://other:9000", self.path("r"))
+        self.assertRejected("tcp://host:9000", "tcp://host:9000")
+
+
+if __name__ == "__main__":
+    unittest.main()